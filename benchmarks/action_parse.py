@@ -0,0 +1,81 @@
+"""
+This file benchmarks parsing LLM outputs into actions, comparing splicing
+each output into its domain template and parsing the whole domain with
+against parsing only the action with parse_action. The outputs are the
+ground truth actions of data/domainNL along with randomly mutated copies, so
+that both valid and invalid PDDL is timed.
+
+Run from the repository root with: python -m benchmarks.action_parse
+"""
+
+#Standard Libs
+import csv
+import glob
+import time
+import random
+import argparse
+
+#Internal Libs
+from nl2pddl.parse_llm_outputs import DOMAIN_TEMPLATES, domain_parser, \
+    action_context, parse_action, syntax_check
+
+DOMAIN_NL_DIR = "data/domainNL"
+
+def mutate(action_str : str, rng : random.Random) -> str:
+    """Returns action_str with a random character deleted or inserted"""
+    i = rng.randrange(len(action_str))
+    if rng.random() < 0.5:
+        return action_str[:i] + action_str[i + 1:]
+    return action_str[:i] + rng.choice("()?- abc") + action_str[i:]
+
+def outputs(num_outputs : int) -> list[tuple[str, str]]:
+    """Returns num_outputs (domain name, action string) pairs to parse"""
+    rows = []
+    for path in sorted(glob.glob(f"{DOMAIN_NL_DIR}/*.csv")):
+        with open(path, "r", encoding="utf-8") as csv_file:
+            rows += [(row["domain"], row["pddl"])
+                     for row in csv.DictReader(csv_file)]
+    rng = random.Random(0)
+    cases = []
+    while len(cases) < num_outputs:
+        domain_name, action_str = rows[len(cases) % len(rows)]
+        if rng.random() < 0.5:
+            action_str = mutate(action_str, rng)
+        action_str = syntax_check(action_str)[0]
+        if action_str is not None:
+            cases.append((domain_name, action_str))
+    return cases
+
+def parse_in_template(action_str : str, domain_name : str) -> None:
+    """Parses an action by parsing its domain template filled with it"""
+    domain_parser()(DOMAIN_TEMPLATES[domain_name].format(action=action_str))
+
+def time_parses(parse, cases : list[tuple[str, str]]) -> float:
+    """Returns the seconds it takes parse to run on every case"""
+    start = time.perf_counter()
+    for domain_name, action_str in cases:
+        try:
+            parse(action_str, domain_name)
+        except Exception:  # pylint: disable=broad-exception-caught
+            pass
+    return time.perf_counter() - start
+
+def main() -> None:
+    """Runs the benchmark and prints the time per 1k outputs"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--outputs", type=int, default=5000,
+                        help="number of outputs to parse")
+    args = parser.parse_args()
+    cases = outputs(args.outputs)
+    #Build parsers, templates and contexts up front so only parsing is timed
+    for domain_name in {domain_name for domain_name, _ in cases}:
+        parse_in_template("", domain_name)
+        action_context(domain_name)
+    for name, parse in (("domain template", parse_in_template),
+                        ("parse_action", parse_action)):
+        elapsed = time_parses(parse, cases)
+        print(f"{name:18}{1000 * elapsed / len(cases) * 1000:10.1f}ms "
+              "per 1k outputs")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+This file benchmarks how long it takes a fresh interpreter to import the
+nl2pddl module and to get hold of pipeline functions, and which heavy
+dependencies each step loads. Every measurement runs in its own process so
+nothing is already imported.
+
+Run from the repository root with: python -m benchmarks.import_time
+"""
+
+#Standard Libs
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+#Heavy dependencies a step should only load if it needs them
+HEAVY_MODULES = ("matplotlib", "pandas", "genai", "lark", "tqdm")
+
+#Code run after `import nl2pddl` in each measured step
+STEPS = {
+    "import nl2pddl" : "",
+    "compute_metrics" : "nl2pddl.compute_metrics",
+    "parse_llm_outputs_from_file" : "nl2pddl.parse_llm_outputs_from_file",
+    "eval_llm_on_prompts" : "nl2pddl.eval_llm_on_prompts",
+    "plot_all" : "nl2pddl.plot_all",
+}
+
+MEASURE = """
+import sys, json, time
+start = time.perf_counter()
+import nl2pddl
+{step}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [m for m in {heavy!r} if m in sys.modules]]))
+"""
+
+def measure(step : str) -> tuple[float, list[str]]:
+    """Runs step in a fresh interpreter, returns its time and heavy imports"""
+    code = MEASURE.format(step=step, heavy=HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, "-c", code])
+    elapsed, loaded = json.loads(output.decode().strip().splitlines()[-1])
+    return elapsed, loaded
+
+def main() -> None:
+    """Runs the benchmark and prints a table of median import times"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="number of fresh interpreters per step")
+    args = parser.parse_args()
+    for name, step in STEPS.items():
+        runs = [measure(step) for _ in range(args.repeats)]
+        median = statistics.median(elapsed for elapsed, _ in runs)
+        print(f"{name:30}{1000 * median:10.1f}ms  loads: "
+              f"{', '.join(runs[0][1]) or '-'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+This file benchmarks the throughput of the generation stage offline, running
+call_llm_async against the local stand-in server in mock_llm_server.py at
+several concurrency levels. It reports prompts per second, which includes the
+backoff of retried requests, and the median and tail latency of single
+requests, for a given server latency and error rate. With --stream, prompts
+are streamed and cancelled once their action is closed; together with
+--pad, which makes the server generate up to max_new_tokens, the tokens
+column shows how many generated tokens this saves.
+
+Run from the repository root with: python -m benchmarks.llm_throughput
+"""
+
+#Standard Libs
+import time
+import asyncio
+import argparse
+from typing import Any, AsyncIterator
+
+#Internal Libs
+from nl2pddl.call_llm import DEFAULT_MODEL, DEFAULT_PARAMS
+from nl2pddl.utils.llm_client import call_llm_async, RateLimiter
+from nl2pddl.utils.llm_backends import GenAIBackend, OpenAIBackend
+from nl2pddl.utils.mock_llm_server import MockLLMServer, load_replay, \
+    DEFAULT_REPLAY_PATH
+from nl2pddl.utils.task_io import iter_tasks
+
+class TimedBackend:
+    """Wraps a backend, recording the seconds until each output arrived"""
+    def __init__(self, backend : Any):
+        self.backend = backend
+        self.model_name = backend.model_name
+        self.generation_parameters = backend.generation_parameters
+        #Outputs replayed by the stand-in server are never cached
+        self.cache_namespace = None
+        self.latencies : list[float] = []
+
+    async def generate(self, batch : list[tuple[int, str]]) \
+    -> AsyncIterator[tuple[int, str]]:
+        """Generates with the wrapped backend, timing each output"""
+        start = time.perf_counter()
+        async for request_id, text in self.backend.generate(batch):
+            self.latencies.append(time.perf_counter() - start)
+            yield request_id, text
+
+    async def stream(self, prompt : str) -> AsyncIterator[tuple[str, int]]:
+        """Streams with the wrapped backend, timing the whole output"""
+        start = time.perf_counter()
+        try:
+            async for chunk in self.backend.stream(prompt):
+                yield chunk
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    async def close(self) -> None:
+        """Closes the wrapped backend"""
+        await self.backend.close()
+
+def percentile(values : list[float], fraction : float) -> float:
+    """Returns the value below which fraction of values lie"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+async def run(args : argparse.Namespace) -> None:
+    """Runs the benchmark at every concurrency level and prints a table"""
+    server = MockLLMServer(load_replay(args.replay), args.latency,
+                           args.error_rate, token_latency=args.token_latency,
+                           pad=args.pad)
+    api_url = await server.start(port=args.port)
+    prompt_tasks = [{"prompt" : task["prompt"], "results" : []}
+                    for task in iter_tasks(args.replay)]
+    tasks = [prompt_tasks[i % len(prompt_tasks)] for i in range(args.prompts)]
+    print(f"{'concurrency':>12}{'prompts/s':>12}{'p50 ms':>10}"
+          f"{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'tokens':>10}")
+    try:
+        for concurrency in args.concurrency:
+            if args.backend == "genai":
+                backend = GenAIBackend(DEFAULT_MODEL, DEFAULT_PARAMS, api_url,
+                                       "mock")
+            else:
+                backend = OpenAIBackend(DEFAULT_MODEL, DEFAULT_PARAMS, api_url)
+            backend = TimedBackend(backend)
+            num_tokens = server.num_tokens
+            start = time.perf_counter()
+            outputs = await call_llm_async(tasks, backend, None, concurrency,
+                                           RateLimiter(None, None),
+                                           batch_size=args.batch_size,
+                                           use_cache=False, stream=args.stream)
+            elapsed = time.perf_counter() - start
+            num_tokens = server.num_tokens - num_tokens
+            errors = sum(task["results"][-1]["error"] for task in outputs)
+            latencies = backend.latencies
+            print(f"{concurrency:12}{len(tasks) / elapsed:12.1f}"
+                  f"{1000 * percentile(latencies, 0.5):10.1f}"
+                  f"{1000 * percentile(latencies, 0.95):10.1f}"
+                  f"{1000 * percentile(latencies, 0.99):10.1f}{errors:8}"
+                  f"{num_tokens:10}")
+    finally:
+        await server.stop()
+
+def main() -> None:
+    """Parses the benchmark arguments and runs it"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--replay", default=DEFAULT_REPLAY_PATH,
+                        help="task file the server replays outputs from")
+    parser.add_argument("--prompts", type=int, default=1000,
+                        help="number of prompts sent at each level")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="mean seconds the server takes per request")
+    parser.add_argument("--error-rate", type=float, default=0.02,
+                        help="fraction of requests the server fails")
+    parser.add_argument("--concurrency", type=int, nargs="+",
+                        default=[1, 4, 16, 64])
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--token-latency", type=float, default=0.0,
+                        help="seconds the server takes per generated token")
+    parser.add_argument("--pad", action="store_true",
+                        help="make the server generate up to max_new_tokens")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream and stop once the action is closed")
+    parser.add_argument("--backend", choices=("genai", "openai"),
+                        default="genai")
+    parser.add_argument("--port", type=int, default=8911)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+This file benchmarks the per result overhead of fetching a domain's cached
+original plans in heuristic_equiv, comparing unpickling the plan cache on
+every lookup with the once per process plan_store, in both its pickle and
+memory mapped modes. It also compares building the VAL text of a domain's
+plans with plan_to_string against the text precomputed in PlanSets.
+
+Run from the repository root with: python -m benchmarks.plan_store
+"""
+
+#Standard Libs
+import os
+import time
+import argparse
+
+#Internal Libs
+from nl2pddl.utils import plan_cache
+from nl2pddl.utils.plan_cache import load_original_plan_map, plan_store
+from nl2pddl.utils.plan_and_val import plan_to_string
+
+def time_lookups(lookup, domain_names : list[str], num_results : int) -> float:
+    """Returns the mean seconds per result of looking up a domain's plans"""
+    start = time.perf_counter()
+    for i in range(num_results):
+        _ = lookup(domain_names[i % len(domain_names)])
+    return (time.perf_counter() - start) / num_results
+
+def main() -> None:
+    """Runs the benchmark and prints a table of per result overheads"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--results", type=int, default=200,
+                        help="number of simulated results")
+    args = parser.parse_args()
+    domain_names = list(load_original_plan_map().keys())
+    if os.path.exists(plan_cache.PLAN_STORE_PATH):
+        os.remove(plan_cache.PLAN_STORE_PATH)
+    start = time.perf_counter()
+    plan_store(mmap_mode=True)
+    print(f"write store file: {1000 * (time.perf_counter() - start):.1f}ms")
+    cases = {
+        "unpickle per result": lambda d: load_original_plan_map()[d],
+        "plan_store, pickle": lambda d: plan_store(mmap_mode=False)[d],
+        "plan_store, mmap": lambda d: plan_store(mmap_mode=True)[d],
+    }
+    for name, lookup in cases.items():
+        #Drop loaded stores so the one time load is part of the measurement
+        plan_cache._plan_stores.clear()  # pylint: disable=protected-access
+        per_result = time_lookups(lookup, domain_names, args.results)
+        print(f"{name:26}{1e6 * per_result:12.1f}us per result")
+    plan_map = load_original_plan_map()
+    store = plan_store(mmap_mode=True)
+    cases = {
+        "VAL text, plan_to_string": lambda d: [
+            [plan_to_string(plan) for plan in plans_obj["plans"]]
+            for plans_obj in plan_map[d]],
+        "VAL text, PlanSet": lambda d: [
+            [plan_set.val_text(i) for i in range(len(plan_set))]
+            for plan_set in store[d]],
+    }
+    for name, lookup in cases.items():
+        per_result = time_lookups(lookup, domain_names, args.results)
+        print(f"{name:26}{1e6 * per_result:12.1f}us per result")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+This file checks the in process validator strips_val, the default
+validator, against VAL. It runs heuristic_equiv with the
+"cross-check" validator, which validates every plan with both and raises
+on any disagreement, over the distinct new domains of a parsed outputs file,
+and writes a JSON report of the domains checked and every disagreement.
+
+Original plans are not replayed first and the equivalence store is
+bypassed, so every K* plan of every problem is checked by both validators.
+VAL has to be built, see setup.sh.
+
+Run from the repository root with:
+python -m benchmarks.validator_cross_check parsed.json --report cross_check.json
+"""
+
+#Standard Libs
+import os
+import json
+import time
+import argparse
+from typing import Any
+
+#Internal Libs
+from nl2pddl.compute_metrics import heuristic_equiv, recons_action_err, \
+    ValidatorDisagreement
+from nl2pddl.parse_llm_outputs import materialize_domain
+from nl2pddl.utils import equiv_store
+from nl2pddl.utils.plan_and_val import VAL_PATH
+from nl2pddl.utils.pddl_properties import canonical_action_str
+from nl2pddl.utils.task_io import iter_tasks
+
+def distinct_jobs(parsed_path : str, limit : int = None) \
+-> list[tuple[str, str, str]]:
+    """
+    Returns a (domain name, action text, new domain) job for each distinct
+    new domain of the results in a parsed outputs file that parse, up to
+    limit jobs.
+    """
+    jobs = {}
+    for task in iter_tasks(parsed_path):
+        for result in task["results"]:
+            if result["error"]:
+                continue
+            action, _, result_class, _, _ = recons_action_err(task, result)
+            if result_class != "":
+                continue
+            #Actions without a canonical form are told apart by their text
+            key = (task["domain"], canonical_action_str(action) or
+                   result.get("newAction") or result["newDomain"])
+            if key not in jobs:
+                jobs[key] = (task["domain"], result.get("newAction", ""),
+                             materialize_domain(result))
+            if limit is not None and len(jobs) >= limit:
+                return list(jobs.values())
+    return list(jobs.values())
+
+def cross_check(jobs : list[tuple[str, str, str]]) -> dict[str, Any]:
+    """Runs every job with the cross-check validator, returns the report"""
+    report = {"checked" : 0, "outcomes" : {}, "disagreements" : []}
+    for domain_name, action_text, new_domain in jobs:
+        try:
+            result = heuristic_equiv(domain_name, new_domain,
+                                     validator="cross-check",
+                                     replay_first=False)
+            outcome = result[1] + (f"/{result[2]}" if result[2] else "")
+        except ValidatorDisagreement as err:
+            outcome = "Disagreement"
+            report["disagreements"].append({
+                "domain" : domain_name,
+                "newAction" : action_text,
+                "problem" : err.problem_path,
+                "native" : err.native,
+                "val" : err.val,
+            })
+        report["checked"] += 1
+        report["outcomes"][outcome] = report["outcomes"].get(outcome, 0) + 1
+    return report
+
+def main() -> None:
+    """Cross checks the validators on a parsed outputs file"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("parsed", help="parsed outputs file to check")
+    parser.add_argument("--report", default="cross_check.json",
+                        help="where to write the JSON report")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="check at most this many distinct domains")
+    args = parser.parse_args()
+    if not os.path.exists(VAL_PATH):
+        parser.error(f"VAL was not found at {VAL_PATH}, run setup.sh")
+    #Stored outcomes would skip the validators entirely
+    equiv_store.set_store_path(None)
+    start = time.perf_counter()
+    jobs = distinct_jobs(args.parsed, args.limit)
+    report = {"parsedOutputs" : args.parsed, "valPath" : VAL_PATH,
+              **cross_check(jobs),
+              "seconds" : round(time.perf_counter() - start, 1)}
+    with open(args.report, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"Checked {report['checked']} domains, "
+          f"{len(report['disagreements'])} disagreements, "
+          f"outcomes {report['outcomes']}")
+
+if __name__ == "__main__":
+    main()
@@ -5,26 +5,71 @@ generate prompts, evaluate a language model on those prompts,
 parse the outputs of the language model, compute metrics on
 the parsed outputs, and plot figures and tables based on the
 metric results.
+
+Functions are imported from their submodule on first access, so importing
+the module is cheap and e.g. a metrics worker never loads matplotlib or the
+LLM client. The PDDL and plan caches are generated the first time they are
+needed if they do not exist.
 """
-import os
-
-# Cache Generation
-from .utils.pddl_cache import generate_pddl_cache
-from .utils.plan_cache import generate_plan_cache, load_original_plan_map
-
-# Import all functions the module exposes
-from .generate_prompts import generate_prompts
-from .call_llm import eval_llm_on_prompts, save_llm_outputs_file
-from .parse_llm_outputs import parse_llm_outputs_from_file, save_parsed_outputs_file
-from .compute_metrics import compute_metrics, compute_metrics_from_file, save_metrics_results_file
-from .parse_metric_results import parse_metric_results_to_file
-from .plot_figures_and_tables import plot_all
-
-#Generate PDDL and Plan Cache if they do not exist
-if not os.path.exists("pddl_cache.pkl"):
-    print("Generating PDDL Cache")
-    generate_pddl_cache()
-
-if not os.path.exists("plan_cache.pkl"):
-    print("Generating Plan Cache")
-    generate_plan_cache()
+import sys
+import types
+import importlib
+
+#Map of each function the module exposes to the submodule defining it
+_EXPORTS = {
+    # Cache Generation
+    "generate_pddl_cache" : ".utils.pddl_cache",
+    "generate_plan_cache" : ".utils.plan_cache",
+    "load_original_plan_map" : ".utils.plan_cache",
+    # Pipeline
+    "generate_prompts" : ".generate_prompts",
+    "eval_llm_on_prompts" : ".call_llm",
+    "call_lmm_concurrent" : ".call_llm",
+    "call_lmm_models" : ".call_llm",
+    "eval_llms_on_prompts" : ".call_llm",
+    "save_llm_outputs_file" : ".call_llm",
+    "parse_llm_outputs_from_file" : ".parse_llm_outputs",
+    "save_parsed_outputs_file" : ".parse_llm_outputs",
+    "compute_metrics" : ".compute_metrics",
+    "compute_metrics_from_file" : ".compute_metrics",
+    "save_metrics_results_file" : ".compute_metrics",
+    "parse_metric_results_to_file" : ".parse_metric_results",
+    "plot_all" : ".plot_figures_and_tables",
+    # Streaming Pipeline
+    "iter_llm_outputs_on_prompts" : ".call_llm",
+    "iter_parsed_outputs_from_file" : ".parse_llm_outputs",
+    "iter_metrics_from_file" : ".compute_metrics",
+}
+
+__all__ = list(_EXPORTS)
+
+#Exposed functions named after their submodule (compute_metrics,
+#generate_prompts), which importing the submodule would bind over
+_SHADOWED = frozenset(name for name, submodule in _EXPORTS.items()
+                      if submodule == "." + name)
+
+class _Package(types.ModuleType):
+    """
+    The type of this module, which keeps the import system from binding a
+    submodule over the function of the same name, so e.g.
+    nl2pddl.compute_metrics is always the function, whichever of the two
+    was imported first.
+    """
+    def __setattr__(self, name : str, value) -> None:
+        if name in _SHADOWED and isinstance(value, types.ModuleType):
+            return
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _Package
+
+def __getattr__(name : str):
+    """Imports an exposed function from its submodule on first access"""
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    """Lists the exposed functions along with the loaded attributes"""
+    return sorted(set(globals()) | set(__all__))
@@ -7,9 +7,10 @@ and saving the raw model outputs.
 #Standard Libs
 import os
 import time
-import json
 import copy
-from typing import Any
+import asyncio
+import itertools
+from typing import Any, Iterable, Iterator, Union
 
 #External Libs
 from dotenv import load_dotenv
@@ -17,6 +18,12 @@ from genai.model import Credentials, Model
 from genai.schemas import GenerateParams
 
 from .generate_prompts import generate_prompts
+from .utils.task_io import iter_tasks, write_tasks
+from .utils.llm_client import call_llm_async, fan_out_async, RateLimiter, \
+    MAX_CONCURRENCY, REQUESTS_PER_SECOND, TOKENS_PER_SECOND
+from .utils.llm_backends import Backend, GenAIBackend
+from .utils.response_cache import cacheable, cache_namespace, \
+    lookup_response, store_response
 
 # These defaults are used if no other model or parameters are provided
 DEFAULT_MODEL = "bigcode/starcoder"
@@ -28,19 +35,50 @@ DEFAULT_PARAMS = {
     "temperature" : 0.1,
 }
 
+#How many prompts iter_call_llm submits to the API at a time
+LLM_BATCH_SIZE = 1000
+
 def call_lmm(
     tasks : dict[str, Any], model_name = DEFAULT_MODEL,
-    generation_parameters = None
+    generation_parameters = None, use_cache : bool = True
 ) -> list[dict[str, Any]]:
     """
     Run the LLM provided by `model_name` with the given parameters 
     `generation_parameters` on the given prompts provided by `tasks`.
     returns a list of tasks with the LLMs outputs appended to the results.
-    for ach  
+    Outputs cached in utils/response_cache.py are reused instead of
+    requested again, unless use_cache is False.
+    """
+    return list(iter_call_llm(tasks, model_name, generation_parameters,
+                              batch_size=max(len(tasks), 1),
+                              use_cache=use_cache))
+
+def _llm_result(model_name : str, generation_parameters : dict[str, Any],
+                output : str, err_msg : str = "") -> dict[str, Any]:
+    """Returns the result entry call_lmm appends to a task"""
+    return {
+        "model" : model_name,
+        "parameters" : generation_parameters,
+        "output" : output,
+        "error" : err_msg != "",
+        "errorMsg" : err_msg
+    }
+
+def iter_call_llm(
+    tasks : Iterable[dict[str, Any]], model_name = DEFAULT_MODEL,
+    generation_parameters = None, batch_size : int = LLM_BATCH_SIZE,
+    use_cache : bool = True
+) -> Iterator[dict[str, Any]]:
+    """
+    call_lmm as a generator, tasks are consumed `batch_size` at a time and
+    each task is yielded as soon as its output arrives, so at most one batch
+    of tasks is held in memory.
     """
     #PEP8 way of handling default dict arguments
     if generation_parameters is None:
         generation_parameters = DEFAULT_PARAMS
+    #Sampling without a pinned seed is never served from the cache
+    use_cache = use_cache and cacheable(generation_parameters)
 
     #Setup GenAI API credentials and settings
     load_dotenv()
@@ -49,31 +87,116 @@ def call_lmm(
     creds = Credentials(api_key, api_endpoint)
     params : GenerateParams = GenerateParams(**generation_parameters)
     model : Model = Model(model_name, params=params, credentials=creds)
-    task_results = []
-    prompts = [t["prompt"] for t in tasks]
-    #Note the unorthodox use of zip here to associate
-    #prompt data with an asynchronous generator result.
-    #The prompts still match with the correct task.
-    for task, result in zip(tasks, model.generate_async(prompts)):
-        task_copy = copy.deepcopy(task)
-        try:
-            task_copy["results"].append({
-                "model" : model_name,
-                "parameters" : generation_parameters,
-                "output" : result.generated_text,
-                "error" : False,
-                "errorMsg" : ""
-            })
-        except AttributeError as e:
-            task_copy["results"].append({
-                "model" : model_name,
-                "parameters" : generation_parameters,
-                "output" : "",
-                "error" : True,
-                "errorMsg" : str(e)
-            })
-        task_results.append(task_copy)
-    return task_results
+    #Shared with GenAIBackend, as both query the same service
+    namespace = cache_namespace("genai", api_endpoint)
+    tasks = iter(tasks)
+    num_cached = num_requested = 0
+    while True:
+        batch = list(itertools.islice(tasks, batch_size))
+        if not batch:
+            break
+        outputs = [lookup_response(namespace, model_name,
+                                   generation_parameters, t["prompt"])
+                   if use_cache else None for t in batch]
+        misses = [i for i, output in enumerate(outputs) if output is None]
+        num_cached += len(batch) - len(misses)
+        num_requested += len(misses)
+        prompts = [batch[i]["prompt"] for i in misses]
+        #generate_async yields outputs as they arrive unless ordered, which
+        #makes them follow the order of misses so they match the right task
+        generated = iter(model.generate_async(prompts, ordered=True)
+                         if prompts else ())
+        for i, task in enumerate(batch):
+            task_copy = copy.deepcopy(task)
+            if outputs[i] is not None:
+                task_copy["results"].append(
+                    _llm_result(model_name, generation_parameters, outputs[i]))
+                yield task_copy
+                continue
+            result = next(generated, None)
+            try:
+                task_copy["results"].append(
+                    _llm_result(model_name, generation_parameters,
+                                result.generated_text))
+                if use_cache:
+                    store_response(namespace, model_name,
+                                   generation_parameters, task["prompt"],
+                                   result.generated_text)
+            except AttributeError as e:
+                task_copy["results"].append(
+                    _llm_result(model_name, generation_parameters, "", str(e)))
+            yield task_copy
+    print(f"LLM responses for {model_name}: {num_cached} cached, "
+          f"{num_requested} requested")
+
+def call_lmm_concurrent(
+    tasks : list[dict[str, Any]], model_name = DEFAULT_MODEL,
+    generation_parameters = None, outputs_path : str = None,
+    concurrency : int = MAX_CONCURRENCY,
+    requests_per_second : float = REQUESTS_PER_SECOND,
+    tokens_per_second : float = TOKENS_PER_SECOND,
+    api_url : str = None, backend : Backend = None, batch_size : int = 1,
+    use_cache : bool = True, stream : bool = False
+) -> list[dict[str, Any]]:
+    """
+    call_lmm through the asyncio client in utils/llm_client.py, with at
+    most `concurrency` requests of batch_size prompts in flight under the
+    given rate limits, and transient failures retried with backoff.
+
+    Finished tasks are appended to outputs_path, a JSON lines file, as they
+    arrive, and a rerun with the same tasks and outputs_path resumes from
+    it. The GenAI API is used unless another backend from
+    utils/llm_backends.py is given, api_url defaults to GENAI_API. Cached
+    outputs are reused as in call_lmm.
+
+    With stream, outputs are streamed and each request is cancelled as soon
+    as the action it generates is closed, instead of running on until a
+    stop sequence or max_new_tokens. Results then record the tokens
+    received and saved, see utils/llm_client.call_llm_async.
+    """
+    #PEP8 way of handling default dict arguments
+    if generation_parameters is None:
+        generation_parameters = DEFAULT_PARAMS
+    if backend is None:
+        backend = GenAIBackend(model_name, generation_parameters, api_url)
+    limiter = RateLimiter(requests_per_second, tokens_per_second)
+    return asyncio.run(call_llm_async(tasks, backend, outputs_path,
+                                      concurrency, limiter,
+                                      batch_size=batch_size,
+                                      use_cache=use_cache, stream=stream))
+
+def call_lmm_models(
+    tasks : list[dict[str, Any]],
+    configs : list[tuple[str, dict[str, Any]]] = None,
+    outputs_path : str = None,
+    concurrency : Union[int, list[int]] = MAX_CONCURRENCY,
+    requests_per_second : float = REQUESTS_PER_SECOND,
+    tokens_per_second : float = TOKENS_PER_SECOND,
+    api_url : str = None, backends : list[Backend] = None,
+    batch_size : int = 1, use_cache : bool = True, stream : bool = False
+) -> list[dict[str, Any]]:
+    """
+    call_lmm_concurrent for several (model name, generation parameters)
+    configs at once, all sent concurrently over the one set of tasks, each
+    with its own concurrency cap and rate limits. Results are appended to
+    the results of tasks in place, in the order of configs, instead of
+    copying the tasks per model. backends may be given instead of configs.
+
+    Each result is appended to outputs_path, a JSON lines file of taskId
+    and result records, as it arrives, and a rerun with the same tasks and
+    outputs_path resumes from it, see utils/llm_client.fan_out_async.
+    """
+    if backends is None:
+        backends = [GenAIBackend(model_name, generation_parameters
+                                 if generation_parameters is not None
+                                 else DEFAULT_PARAMS, api_url)
+                    for model_name, generation_parameters in configs]
+    limiters = [RateLimiter(requests_per_second, tokens_per_second)
+                for _ in backends]
+    return asyncio.run(fan_out_async(tasks, backends, outputs_path,
+                                     concurrency, limiters,
+                                     batch_size=batch_size,
+                                     use_cache=use_cache, stream=stream))
 
 def eval_llm_on_prompts(
     prompts_file_path : str,
@@ -83,21 +206,45 @@ def eval_llm_on_prompts(
     """
     call_lmm except takes a json file task instead of a task list
     """
-    #PEP8 way of handling default dict arguments
-    if generation_parameters is None:
-        generation_parameters = DEFAULT_PARAMS
-    with open(prompts_file_path, "r", encoding="utf-8") as prompts_file:
-        prompts_data = json.load(prompts_file)
-        return call_lmm(prompts_data, model_name, generation_parameters)
+    return call_lmm(list(iter_tasks(prompts_file_path)), model_name,
+                    generation_parameters)
 
-def save_llm_outputs_file(outputs : list[dict[str, Any]]) -> None:
+def eval_llms_on_prompts(
+    prompts_file_path : str,
+    configs : list[tuple[str, dict[str, Any]]],
+    outputs_path : str = None,
+    concurrency : Union[int, list[int]] = MAX_CONCURRENCY
+) -> list[dict[str, Any]]:
+    """
+    call_lmm_models except takes a json file task instead of a task list,
+    read once for all the models
+    """
+    return call_lmm_models(list(iter_tasks(prompts_file_path)), configs,
+                           outputs_path, concurrency)
+
+def iter_llm_outputs_on_prompts(
+    prompts_file_path : str,
+    model_name : str = DEFAULT_MODEL,
+    generation_parameters = None
+) -> Iterator[dict[str, Any]]:
+    """
+    eval_llm_on_prompts as a generator, the prompts file (a JSON array or
+    JSON lines) is read incrementally, see iter_call_llm.
+    """
+    return iter_call_llm(iter_tasks(prompts_file_path), model_name,
+                         generation_parameters)
+
+def save_llm_outputs_file(outputs : Iterable[dict[str, Any]],
+                          outputs_path : str = None) -> None:
     """
     Given a list of tasks with LLM outputs, save the outputs to a file.
+    outputs may be a generator, tasks are written as they are produced,
+    and an outputs_path ending in .jsonl writes JSON lines.
     """
-    timestamp = int(time.time())
-    outfile_name = f"outputs-{timestamp}.json"
-    with open("llmOutputs/" + outfile_name, "w", encoding="utf-8") as outfile:
-        json.dump(outputs, outfile, indent=2)
+    if outputs_path is None:
+        timestamp = int(time.time())
+        outputs_path = "llmOutputs/" + f"outputs-{timestamp}.json"
+    write_tasks(outputs, outputs_path)
 
 #This is what is called to actually generate the prompts
 if __name__ == "__main__":
@@ -109,14 +256,11 @@ if __name__ == "__main__":
         "stop_sequences": ["Input:", "Allowed Predicates:"],
         "temperature" : 0.1,
     }
-    results = call_lmm(prompt_tasks, "bigcode/starcoder", greedy_params)
-    save_llm_outputs_file(results)
-    results = call_lmm(results, "meta-llama/llama-2-7b", greedy_params)
-    results = call_lmm(results, "meta-llama/llama-2-7b-chat", greedy_params)
-    save_llm_outputs_file(results)
-    results = call_lmm(results, "meta-llama/llama-2-13b", greedy_params)
-    results = call_lmm(results, "meta-llama/llama-2-13b-chat", greedy_params)
-    save_llm_outputs_file(results)
-    results = call_lmm(results, "meta-llama/llama-2-70b-chat", greedy_params)
-    results = call_lmm(results, "meta-llama/llama-2-70b", greedy_params)
+    models = ["bigcode/starcoder", "meta-llama/llama-2-7b",
+              "meta-llama/llama-2-7b-chat", "meta-llama/llama-2-13b",
+              "meta-llama/llama-2-13b-chat", "meta-llama/llama-2-70b-chat",
+              "meta-llama/llama-2-70b"]
+    results = call_lmm_models(prompt_tasks,
+                              [(model, greedy_params) for model in models],
+                              "llmOutputs/outputs-fan-out.jsonl")
     save_llm_outputs_file(results)
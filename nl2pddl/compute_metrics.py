@@ -6,23 +6,37 @@ Heuristic Domain Equivalence Metric.
 """
 
 #Standard Libs
+import os
 import json
 import copy
 import time
-from typing import Any
+import asyncio
+import itertools
+from typing import Any, Iterable, Iterator
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 #External Libs
 from tqdm import tqdm     #For progress bar
-from pddl.core import Action, Formula
+from pddl.core import Action, Formula, Domain, Problem
 from pddl.logic.terms import Variable
 from pddl.logic.predicates import Predicate
 
 #Internal Libs
-from .parse_llm_outputs import str_to_action
-from .utils.plan_cache import load_original_plan_map
-from .utils.pddl_cache import domainProblemPathMap, domainPathMap
-from .utils.pddl_properties import preds_pos_neg, names_with_params
-from .utils.plan_and_val import plan_str, can_apply_plan, plan_to_string
+from .parse_llm_outputs import str_to_action, action_cache_info, \
+    materialize_domain
+from .utils.plan_cache import plan_store, PlanSet
+from .utils.pddl_cache import domainProblemPathMap, domainPathMap, \
+    domainProblemMap, domainObjMap, registry
+from .utils import strips_val
+from .utils.pddl_properties import preds_pos_neg, names_with_params, \
+    canonical_action_str
+from .utils.plan_and_val import plan_str, validate_plans, new_pipe, \
+    plan_str_async, validate_plans_async, PLANNER_CONFIG
+from .utils.equiv_store import content_key, file_digest, lookup, store
+from .utils.task_io import iter_tasks, write_tasks
+from .utils.checkpoint import Journal, task_id
+from .utils.scratch import scratch_slot
 
 #Action Reconstruction Error Metric ============================================
 
@@ -134,72 +148,469 @@ def task_action_recons_err(task : list[dict[str, Any]], result ) \
     This function wraps the action_recons_err function to compute the difference
     between the original action and the reconstructed action in a task
     """
+    return recons_action_err(task, result)[1:]
+
+def recons_action_err(task : list[dict[str, Any]], result) \
+-> tuple[Action, int, str, str, str]:
+    """
+    task_action_recons_err, but also returns the reconstructed action
+    parsed from the result output, or None if it could not be parsed.
+    """
     ast, err1, err2, err_msg = str_to_action(result["output"], task["domain"])
     if ast is None:
-        return float('nan'), err1, err2, err_msg
+        return None, float('nan'), err1, err2, err_msg
     correct_ast, err1, err2, err_msg = str_to_action(task["pddl"], task["domain"])
     if correct_ast is None:
         print("Original PDDL Tree failure, THIS SHOULD NEVER HAPPEN")
         raise RuntimeError()
     are_score = action_recons_err(correct_ast, ast)
-    return are_score, "", "", ""
+    return ast, are_score, "", "", ""
 
 #Heuristic Domain Equivalence Metric ===========================================
 
-def heuristic_equiv(domain_name : str, new_domain : str) \
+#Plan validators heuristic_equiv can use, "native" simulates plans in process
+#with strips_val, "val" calls VAL, and "cross-check" runs both and raises if
+#they disagree. Domains strips_val does not support always use VAL.
+VALIDATORS = ("native", "val", "cross-check")
+#Domains strips_val supports are validated in process, saving a VAL fork per
+#plan, benchmarks/validator_cross_check.py checks it against VAL
+DEFAULT_VALIDATOR = "native"
+
+class ValidatorDisagreement(RuntimeError):
+    """Raised by the cross-check validator when strips_val and VAL disagree"""
+    def __init__(self, domain_path : str, problem_path : str,
+                 native : list[bool], val : list[bool]):
+        super().__init__(f"Validators disagree on {domain_path} "
+                         f"{problem_path}: native {native}, VAL {val}")
+        self.domain_path = domain_path
+        self.problem_path = problem_path
+        self.native = native
+        self.val = val
+
+def _check_agreement(domain_path : str, problem_path : str,
+                     native_results : list[tuple[bool, str]],
+                     val_results : list[tuple[bool, str]]) -> None:
+    """Raises ValidatorDisagreement if the validators' verdicts differ"""
+    native = [valid for valid, _ in native_results]
+    val = [valid for valid, _ in val_results]
+    if native != val:
+        raise ValidatorDisagreement(domain_path, problem_path, native, val)
+
+def _equiv_key(domain_name : str, new_domain : str, k : int,
+               validator : str, replay_first : bool) -> str:
+    """The equivalence store key of a heuristic_equiv evaluation"""
+    problem_paths = domainProblemPathMap[domain_name]
+    #Only replay_first results are keyed apart, as they may be classified
+    #differently, so existing entries stay valid
+    mode = ("replay-first",) if replay_first else ()
+    return content_key("equiv", domain_name,
+                       file_digest(domainPathMap[domain_name]), new_domain,
+                       [(p, file_digest(p)) for p in problem_paths],
+                       k, PLANNER_CONFIG, validator, *mode)
+
+def heuristic_equiv(domain_name : str, new_domain : str, k : int = 100,
+                    validator : str = DEFAULT_VALIDATOR,
+                    replay_first : bool = False) \
 -> tuple[int, str, str, str]:
     """
     Returns a tuple of 
+    0) the number of original and new plans that worked
     1) the result class string (EqDomain or DifDomain)
     2) An optional subclass string of the error if DifDomain
     3) An optional error message about why the domains are different
+
+    replay_first is a fast path that changes the classification of some
+    domains: the cached original plans of every problem are replayed in the
+    new domain before K* is run at all, and a domain an original plan fails
+    in is DifDomain/OriginalToNew with 0 working plans without ever being
+    planned. Planning first could have classified it as NoPlan, k diff error
+    or NewToOriginal instead, or counted working plans. Domains every
+    original plan replays in are classified exactly as without it.
+
+    Results are looked up in and saved to the equivalence store, so a new
+    domain that was scored before is never replanned.
+    """
+    assert validator in VALIDATORS
+    key = _equiv_key(domain_name, new_domain, k, validator, replay_first)
+    stored = lookup("equiv", key)
+    if stored is not None:
+        return tuple(stored)
+    with scratch_slot() as slot:
+        new_domain_path = new_pipe(slot, "new_domain.pddl", new_domain)
+        result = _heuristic_equiv(domain_name, new_domain, new_domain_path,
+                                  k, validator, replay_first)
+    if result[1] != "PlanError":
+        store("equiv", key, result)
+    return result
+
+def _validate(domain : Domain, domain_path : str, problem : Problem,
+              problem_path : str, plans : PlanSet, num_plans : int,
+              validator : str) -> list[tuple[bool, str]]:
     """
+    Validates the first num_plans plans on a domain, given as object (None if
+    it could not be parsed) and path, and problem with the chosen validator.
+    Returns a (valid, error message) tuple for each plan.
+    """
+    native = validator != "val" and domain is not None and \
+        strips_val.supported(domain, problem)
+    if native:
+        results = strips_val.validate_plans(
+            domain, problem, [plans.actions(i) for i in range(num_plans)])
+    if not native or validator == "cross-check":
+        val_results = validate_plans(domain_path, problem_path,
+                                     [plans.val_text(i) for i in range(num_plans)])
+        if native:
+            _check_agreement(domain_path, problem_path, results, val_results)
+        results = val_results
+    return results
+
+def _heuristic_equiv(domain_name : str, new_domain : str, new_domain_path : str,
+                     k : int, validator : str, replay_first : bool) \
+-> tuple[int, str, str, str]:
+    """heuristic_equiv without consulting the equivalence store"""
     num_working = 0 #the number of plans that worked
-    original_domain_plans : list[dict[str, Any]] = \
-        load_original_plan_map()[domain_name]
-    for problem_path, original_plans_obj in \
-    zip(domainProblemPathMap[domain_name], original_domain_plans):
-        plans_obj, err1, err2, err_msg = plan_str(new_domain, problem_path)
+    original_domain_plans : list[PlanSet] = plan_store()[domain_name]
+    original_domain = domainObjMap[domain_name]
+    original_domain_path = domainPathMap[domain_name]
+    #Only parse the new domain if it can be validated in process
+    new_domain_obj = None
+    if validator != "val":
+        new_domain_obj = strips_val.parse_domain(new_domain)
+    problems = list(zip(domainProblemPathMap[domain_name],
+                        domainProblemMap[domain_name], original_domain_plans))
+    #Verdicts of replaying the original plans of each problem in the new domain
+    replays : list[list[tuple[bool, str]]] = [None] * len(problems)
+    #A new domain that does not parse natively is left to K*, which reports
+    #why, rather than replayed with VAL
+    if replay_first and (validator == "val" or new_domain_obj is not None):
+        for i, (problem_path, problem, original_plans) in enumerate(problems):
+            replays[i] = _validate(new_domain_obj, new_domain_path, problem,
+                                   problem_path, original_plans,
+                                   len(original_plans), validator)
+            original_err = next((err for valid, err in replays[i]
+                                 if not valid), None)
+            if original_err is not None:
+                return 0, "DifDomain", "OriginalToNew", original_err
+    for i, (problem_path, problem, original_plans) in enumerate(problems):
+        plans_obj, err1, err2, err_msg = plan_str(new_domain, problem_path, k)
         if plans_obj is None:
             return 0, err1, err2, err_msg
-        plans = plans_obj["plans"]
-        original_plans = original_plans_obj["plans"]
+        plans = PlanSet.from_json(plans_obj)
         if len(plans) != len(original_plans):
             #The size of a cached len(original_plans) plans list did
             #not match the size of generated plans len(plans) list for the
             #this means the domains were different
             return num_working, "DifDomain", "OriginalToNew", "k diff error"
-        for original_plan, new_plan in zip(original_plans, plans):
-            #convert the plan to a format VAL can accept it in
-            can_apply, err1, err2, err_msg = \
-                can_apply_plan(domainPathMap[domain_name] , new_domain, \
-                               problem_path, plan_to_string(original_plan), \
-                               plan_to_string(new_plan))
-            if not can_apply:
-                if err2 == "OriginalToNew":
-                    num_working += 1
-                return num_working, err1, err2, err_msg
+        if replays[i] is None:
+            replays[i] = _validate(new_domain_obj, new_domain_path, problem,
+                                   problem_path, original_plans,
+                                   len(original_plans), validator)
+        #Plans after the first failing replay can not change the result
+        num_checked = next((j + 1 for j, (valid, _) in enumerate(replays[i])
+                            if not valid), len(plans))
+        forward = _validate(original_domain, original_domain_path, problem,
+                            problem_path, plans, num_checked, validator)
+        for (new_valid, new_err), (original_valid, original_err) in \
+        zip(forward, replays[i]):
+            #Forward direction, plans from the new domain in the original domain
+            if not new_valid:
+                return num_working, "DifDomain", "NewToOriginal", new_err
             num_working += 1
+            #Backward direction, plans from the original domain in the new domain
+            if not original_valid:
+                return num_working, "DifDomain", "OriginalToNew", original_err
+    return num_working, "EqDomain", "", ""
+
+async def heuristic_equiv_async(domain_name : str, new_domain : str,
+                                k : int = 100,
+                                validator : str = DEFAULT_VALIDATOR,
+                                replay_first : bool = False) \
+-> tuple[int, str, str, str]:
+    """
+    The asyncio counterpart of heuristic_equiv, giving the same result and
+    sharing its equivalence store entries.
+
+    The problems of the domain are planned and checked concurrently, and as
+    soon as one problem proves the domains different the problems after it
+    are cancelled, killing their K* and VAL processes, as they can no longer
+    change the result.
+    """
+    assert validator in VALIDATORS
+    key = _equiv_key(domain_name, new_domain, k, validator, replay_first)
+    stored = lookup("equiv", key)
+    if stored is not None:
+        return tuple(stored)
+    with scratch_slot() as slot:
+        new_domain_path = new_pipe(slot, "new_domain.pddl", new_domain)
+        result = await _heuristic_equiv_async(domain_name, new_domain,
+                                              new_domain_path, k, validator,
+                                              replay_first)
+    if result[1] != "PlanError":
+        store("equiv", key, result)
+    return result
+
+async def _validate_plans_async(domain : Domain, domain_path : str,
+                                problem : Problem, problem_path : str,
+                                plans : PlanSet, num_plans : int,
+                                validator : str) -> list[tuple[bool, str]]:
+    """
+    _validate running VAL through the asyncio engine, raising TimeoutError
+    if a VAL run exceeds its timeout.
+    """
+    native = validator != "val" and domain is not None and \
+        strips_val.supported(domain, problem)
+    if native:
+        results = strips_val.validate_plans(
+            domain, problem, [plans.actions(i) for i in range(num_plans)])
+    if not native or validator == "cross-check":
+        val_results = await validate_plans_async(
+            domain_path, problem_path,
+            [plans.val_text(i) for i in range(num_plans)])
+        if native:
+            _check_agreement(domain_path, problem_path, results, val_results)
+        results = val_results
+    return results
+
+async def _problem_equiv_async(
+    new_domain : str, new_domain_obj : Domain, new_domain_path : str,
+    domain_name : str, problem_path : str, problem : Problem,
+    original_plans : PlanSet, replay : list[tuple[bool, str]], k : int,
+    validator : str
+) -> tuple[int, tuple[str, str, str]]:
+    """
+    Checks a single problem for _heuristic_equiv_async. Returns the number
+    of plans of the problem that worked, and the (class, subclass, message)
+    the problem proves the domains different with or None. A number of None
+    means the result does not count the plans of earlier problems either.
+    """
+    plans_obj, err1, err2, err_msg = await plan_str_async(new_domain,
+                                                          problem_path, k)
+    if plans_obj is None:
+        return None, (err1, err2, err_msg)
+    plans = PlanSet.from_json(plans_obj)
+    if len(plans) != len(original_plans):
+        return 0, ("DifDomain", "OriginalToNew", "k diff error")
+    try:
+        if replay is None:
+            replay = await _validate_plans_async(
+                new_domain_obj, new_domain_path, problem, problem_path,
+                original_plans, len(original_plans), validator)
+        #Plans after the first failing replay can not change the result
+        num_checked = next((j + 1 for j, (valid, _) in enumerate(replay)
+                            if not valid), len(plans))
+        forward = await _validate_plans_async(
+            domainObjMap[domain_name], domainPathMap[domain_name], problem,
+            problem_path, plans, num_checked, validator)
+    except asyncio.TimeoutError as err:
+        #Like a K* timeout, a PlanError that is never saved
+        return None, ("PlanError", "Timeout", str(err))
+    num_working = 0
+    for (new_valid, new_err), (original_valid, original_err) in \
+    zip(forward, replay):
+        if not new_valid:
+            return num_working, ("DifDomain", "NewToOriginal", new_err)
+        num_working += 1
+        if not original_valid:
+            return num_working, ("DifDomain", "OriginalToNew", original_err)
+    return num_working, None
+
+async def _heuristic_equiv_async(domain_name : str, new_domain : str,
+                                 new_domain_path : str, k : int,
+                                 validator : str, replay_first : bool) \
+-> tuple[int, str, str, str]:
+    """heuristic_equiv_async without consulting the equivalence store"""
+    original_domain_plans : list[PlanSet] = plan_store()[domain_name]
+    new_domain_obj = None
+    if validator != "val":
+        new_domain_obj = strips_val.parse_domain(new_domain)
+    problems = list(zip(domainProblemPathMap[domain_name],
+                        domainProblemMap[domain_name], original_domain_plans))
+    replays : list[list[tuple[bool, str]]] = [None] * len(problems)
+    if replay_first and (validator == "val" or new_domain_obj is not None):
+        for i, (problem_path, problem, original_plans) in enumerate(problems):
+            try:
+                replays[i] = await _validate_plans_async(
+                    new_domain_obj, new_domain_path, problem, problem_path,
+                    original_plans, len(original_plans), validator)
+            except asyncio.TimeoutError as err:
+                return 0, "PlanError", "Timeout", str(err)
+            original_err = next((err for valid, err in replays[i]
+                                 if not valid), None)
+            if original_err is not None:
+                return 0, "DifDomain", "OriginalToNew", original_err
+    tasks = [asyncio.create_task(_problem_equiv_async(
+        new_domain, new_domain_obj, new_domain_path, domain_name, problem_path,
+        problem, original_plans, replays[i], k, validator))
+        for i, (problem_path, problem, original_plans) in enumerate(problems)]
+    index = {task : i for i, task in enumerate(tasks)}
+    outcomes : list[tuple[int, tuple[str, str, str]]] = [None] * len(tasks)
+    #The first problem known to prove the domains different
+    first_dif = len(tasks)
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                i = index[task]
+                outcomes[i] = task.result()
+                if outcomes[i][1] is not None and i < first_dif:
+                    first_dif = i
+                    for later in tasks[i + 1:]:
+                        later.cancel()
+            #Only problems before the first difference can change the result
+            pending = {task for task in pending if index[task] < first_dif}
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    num_working = 0
+    for count, dif in outcomes[:first_dif + 1]:
+        if dif is not None:
+            return (0 if count is None else num_working + count), *dif
+        num_working += count
     return num_working, "EqDomain", "", ""
 
 # Evaluation ===================================================================
 
-def compute_metrics(tasks : list[dict[str, Any]]) -> list[dict[str, Any]]:
+#Number of results needing a heuristic_equiv evaluation at which
+#compute_metrics switches to a process pool when workers is not given
+PARALLEL_THRESHOLD = 64
+#How many tasks iter_compute_metrics evaluates at a time
+METRICS_WINDOW = 1000
+
+def _equiv_job(job : tuple[str, str], validator : str = DEFAULT_VALIDATOR,
+               replay_first : bool = False) -> tuple[int, str, str, str]:
+    """Unpacks a (domain name, new domain) job for heuristic_equiv"""
+    domain_name, new_domain = job
+    return heuristic_equiv(domain_name, new_domain, validator=validator,
+                           replay_first=replay_first)
+
+def run_equiv_jobs(jobs : list[tuple[str, str]], workers : int = None,
+                   validator : str = DEFAULT_VALIDATOR,
+                   replay_first : bool = False) \
+-> list[tuple[int, str, str, str]]:
+    """
+    Runs heuristic_equiv on each (domain name, new domain) job and returns
+    the results in the same order as jobs. If workers is None a process
+    pool with one worker per core is used when there are at least
+    PARALLEL_THRESHOLD jobs, otherwise jobs are run serially.
+    """
+    return list(iter_equiv_jobs(jobs, workers, validator, replay_first))
+
+def iter_equiv_jobs(jobs : list[tuple[str, str]], workers : int = None,
+                    validator : str = DEFAULT_VALIDATOR,
+                    replay_first : bool = False) \
+-> Iterator[tuple[int, str, str, str]]:
+    """
+    run_equiv_jobs as a generator, yields the result of each job in the
+    same order as jobs as soon as it and every job before it finished.
+    """
+    if workers is None:
+        workers = os.cpu_count() if len(jobs) >= PARALLEL_THRESHOLD else 1
+    equiv_job = partial(_equiv_job, validator=validator,
+                        replay_first=replay_first)
+    if workers <= 1 or len(jobs) <= 1:
+        for job in tqdm(jobs, "Equivalence"):
+            yield equiv_job(job)
+        return
+    #Load the domains and plans once here so forked workers share them
+    registry.warm({domain_name for domain_name, _ in jobs})
+    plan_store()
+    #Each worker writes its temp files to its own scratch directory
+    with ProcessPoolExecutor(workers) as pool:
+        #map yields in submission order, so results line up with jobs
+        yield from tqdm(pool.map(equiv_job, jobs), "Equivalence",
+                        total=len(jobs))
+
+async def run_equiv_jobs_async(jobs : list[tuple[str, str]],
+                               validator : str = DEFAULT_VALIDATOR,
+                               replay_first : bool = False) \
+-> list[tuple[int, str, str, str]]:
+    """
+    run_equiv_jobs on the asyncio engine, all jobs are evaluated
+    concurrently in this process with MAX_PROCESSES bounding how many K* and
+    VAL processes run at once. Returns the results in the same order as jobs.
+    """
+    return list(await asyncio.gather(*(
+        heuristic_equiv_async(domain_name, new_domain, validator=validator,
+                              replay_first=replay_first)
+        for domain_name, new_domain in jobs)))
+
+def dedupe_report(keys_by_model : dict[str, list[Any]]) \
+-> dict[str, tuple[int, int, float]]:
     """
-    Adds metric computations to the plan objects
+    Given the heuristic_equiv job keys of results grouped by model, return
+    a map of model names to the number of results, the number of distinct
+    jobs among them, and the dedupe ratio, the fraction of evaluations
+    saved by sharing jobs.
     """
+    report = {}
+    for model, keys in keys_by_model.items():
+        num_distinct = len(set(keys))
+        report[model] = (len(keys), num_distinct, 1 - num_distinct / len(keys))
+    return report
+
+def compute_metrics(tasks : list[dict[str, Any]], workers : int = None,
+                    dedupe : bool = True, validator : str = DEFAULT_VALIDATOR,
+                    replay_first : bool = False,
+                    journal_path : str = None) -> list[dict[str, Any]]:
+    """
+    Adds metric computations to the plan objects.
+
+    Action reconstruction errors are computed first, then every result that
+    still needs a heuristic domain equivalence check is evaluated by
+    run_equiv_jobs, in parallel over `workers` processes for large inputs.
+    The returned tasks are in input order and identical to a serial run.
+
+    If dedupe is set, results of the same domain whose actions have the same
+    canonical_action_str share a single heuristic_equiv evaluation, and the
+    dedupe ratio of each model is printed.
+
+    validator selects how plans are validated, one of VALIDATORS, and
+    replay_first enables the classification changing fast path of
+    heuristic_equiv that only plans domains the original plans replay in.
+
+    If journal_path is given, each result is checkpointed to the journal
+    there as soon as it is finished, and results already in the journal
+    from an earlier run on the same input are restored instead of evaluated.
+    """
+    if journal_path is None:
+        return _compute_metrics(tasks, workers, dedupe, validator,
+                                replay_first, None)
+    with Journal(journal_path) as journal:
+        return _compute_metrics(tasks, workers, dedupe, validator,
+                                replay_first, journal)
+
+def _compute_metrics(tasks : list[dict[str, Any]], workers : int,
+                     dedupe : bool, validator : str, replay_first : bool,
+                     journal : Journal) -> list[dict[str, Any]]:
+    """compute_metrics checkpointing to an open journal if it is not None"""
     updated = []
+    #Results awaiting heuristic domain equivalence, with their job key
+    #and (task id, result index) in the journal
+    pending : list[tuple[tuple[str, str], dict[str, Any], str, int]] = []
+    #Map of job keys to (domain name, new domain) jobs
+    jobs : dict[tuple[str, str], tuple[str, str]] = {}
+    num_restored = 0
     for task in tqdm(tasks, "Tasks"):
+        tid = task_id(task) if journal is not None else None
         task_copy = copy.deepcopy(task)
         domain_name = task_copy["domain"]
-        for result in task_copy["results"]:
+        for index, result in enumerate(task_copy["results"]):
             #result["planDif"] = float('nan')
             result["actionDif"] = float('nan')
             result["workingPlans"] = 0
+            if journal is not None:
+                fields = journal.get(tid, index)
+                if fields is not None:
+                    result.update(fields)
+                    num_restored += 1
+                    continue
             if not result["error"]:
                 #Compute Action Reconstruction Error
-                are_score, result_class, result_subclass, err_msg = \
-                    task_action_recons_err(task_copy, result)
+                action, are_score, result_class, result_subclass, err_msg = \
+                    recons_action_err(task_copy, result)
                 if result_class == "":
                     result["actionDif"] = are_score
                 else:
@@ -207,39 +618,121 @@ def compute_metrics(tasks : list[dict[str, Any]]) -> list[dict[str, Any]]:
                     result["resultClass"] = result_class
                     result["errorSubclass"] = result_subclass
                     result["errorMsg"] = err_msg
+                    if journal is not None:
+                        journal.record(tid, index, result)
                     continue
-                #Determine Heuristic Domain Equivalence
-                new_domain = result["newDomain"]
-                work_count, result_class, result_subclass, err_msg = \
-                    heuristic_equiv(domain_name, new_domain)
-                result["workingPlans"] = work_count
-                result["resultClass"] = result_class
-                result["errorSubclass"] = result_subclass
-                result["errorMsg"] = err_msg
-                result["error"] = not result_class == "EqDomain"
+                canonical = canonical_action_str(action) if dedupe else None
+                job_key = (domain_name, canonical or
+                           result.get("newAction") or result["newDomain"])
+                #Only the first result of each job needs its domain text
+                if job_key not in jobs:
+                    jobs[job_key] = (domain_name, materialize_domain(result))
+                pending.append((job_key, result, tid, index))
+            elif journal is not None:
+                journal.record(tid, index, result)
         updated.append(task_copy)
+    if journal is not None:
+        print(f"Restored {num_restored} results from {journal.path}")
+    cache_info = action_cache_info()
+    print(f"Action parses: {cache_info['hits']} cached, "
+          f"{cache_info['misses']} parsed, hit rate {cache_info['hitRate']:.2f}")
+    if dedupe and pending:
+        keys_by_model : dict[str, list[Any]] = {}
+        for job_key, result, _, _ in pending:
+            keys_by_model.setdefault(result["model"], []).append(job_key)
+        for model, (num_results, num_distinct, ratio) in \
+        dedupe_report(keys_by_model).items():
+            print(f"{model}: {num_results} results, {num_distinct} distinct,"
+                  f" dedupe ratio {ratio:.2f}")
+        print(f"Evaluating {len(jobs)} distinct domains for "
+              f"{len(pending)} results")
+    #Determine Heuristic Domain Equivalence
+    waiting : dict[tuple[str, str], list[tuple[dict[str, Any], str, int]]] = {}
+    for job_key, result, tid, index in pending:
+        waiting.setdefault(job_key, []).append((result, tid, index))
+    job_keys = list(jobs.keys())
+    for job_key, equiv in zip(job_keys, iter_equiv_jobs(
+            [jobs[key] for key in job_keys], workers, validator, replay_first)):
+        work_count, result_class, result_subclass, err_msg = equiv
+        #Fill in and journal the results of each job as it finishes
+        for result, tid, index in waiting[job_key]:
+            result["workingPlans"] = work_count
+            result["resultClass"] = result_class
+            result["errorSubclass"] = result_subclass
+            result["errorMsg"] = err_msg
+            result["error"] = not result_class == "EqDomain"
+            if journal is not None:
+                journal.record(tid, index, result)
     return updated
 
-def compute_metrics_from_file(parsed_outputs_file_path : str) \
+def iter_compute_metrics(tasks : Iterable[dict[str, Any]],
+                         workers : int = None, dedupe : bool = True,
+                         validator : str = DEFAULT_VALIDATOR,
+                         replay_first : bool = False,
+                         window : int = METRICS_WINDOW,
+                         journal_path : str = None) \
+-> Iterator[dict[str, Any]]:
+    """
+    compute_metrics as a generator, tasks are consumed and yielded in
+    windows of `window` tasks so at most one window is held in memory.
+
+    Deduplication only shares evaluations within a window, repeats across
+    windows are answered from the equivalence store instead. All windows
+    checkpoint to the same journal at journal_path, see compute_metrics.
+    """
+    journal = Journal(journal_path) if journal_path is not None else None
+    try:
+        tasks = iter(tasks)
+        while True:
+            batch = list(itertools.islice(tasks, window))
+            if not batch:
+                return
+            yield from _compute_metrics(batch, workers, dedupe, validator,
+                                        replay_first, journal)
+    finally:
+        if journal is not None:
+            journal.close()
+
+def compute_metrics_from_file(parsed_outputs_file_path : str,
+                              workers : int = None, dedupe : bool = True,
+                              validator : str = DEFAULT_VALIDATOR,
+                              replay_first : bool = False,
+                              journal_path : str = None) \
 -> list[dict[str, Any]]:
     """
     Given a file path to parsed file outputs, use them to compute the metrics
     and return the updated task list.
     """
-    with open(parsed_outputs_file_path, "r", encoding="utf-8") as json_file:
-        results = json.load(json_file)
-    return compute_metrics(results)
+    results = list(iter_tasks(parsed_outputs_file_path))
+    return compute_metrics(results, workers, dedupe, validator, replay_first,
+                           journal_path)
+
+def iter_metrics_from_file(parsed_outputs_file_path : str,
+                           workers : int = None, dedupe : bool = True,
+                           validator : str = DEFAULT_VALIDATOR,
+                           replay_first : bool = False,
+                           window : int = METRICS_WINDOW,
+                           journal_path : str = None) \
+-> Iterator[dict[str, Any]]:
+    """
+    compute_metrics_from_file as a generator, the parsed outputs file (a
+    JSON array or JSON lines) is read incrementally, see iter_compute_metrics.
+    """
+    return iter_compute_metrics(iter_tasks(parsed_outputs_file_path), workers,
+                                dedupe, validator, replay_first, window,
+                                journal_path)
 
-def save_metrics_results_file(metric_results : list[dict[str, Any]], \
+def save_metrics_results_file(metric_results : Iterable[dict[str, Any]], \
                               metrics_file_path : str = None) -> None:
     """
-    Save the metric results to a file at an optional metrics_file_path
+    Save the metric results to a file at an optional metrics_file_path.
+    metric_results may be a generator, tasks are written as they are
+    produced, and a path ending in .jsonl writes JSON lines.
     """
     if metrics_file_path is None:
         timestamp = int(time.time())
         metrics_file_path = f"results/metrics-{timestamp}.json"
-    with open(metrics_file_path, "w", encoding="utf-8") as outfile:
-        json.dump(metric_results, outfile, indent=2)
+    write_tasks(metric_results, metrics_file_path)
 
 #For Testing
 if __name__ == "__main__":
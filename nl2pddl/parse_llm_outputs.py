@@ -10,20 +10,30 @@ computations.
 # pylint: disable=W0212,W0718
 
 #Standard Libs
+import re
 import time
-import json
 import copy
-from typing import Any
+import base64
+import pickle
+import textwrap
+from typing import Any, Iterable, Iterator
+from functools import lru_cache
+from collections.abc import Mapping
 
 #External Libs
+from lark import Lark
+from lark.exceptions import VisitError
 from pddl.core import Action, Domain
-from pddl.parser.domain import DomainParser
+from pddl.parser import DOMAIN_GRAMMAR_FILE, PARSERS_DIRECTORY
+from pddl.parser.domain import DomainParser, DomainTransformer
 from pddl.formatter import domain_to_string
 from tqdm import tqdm
 
 #Internal Libs
 #from .utils.pddl_properties import *
-from .utils.pddl_cache import domainObjMap
+from .utils.pddl_cache import domainObjMap, domainPathMap, PDDL_VERSION
+from .utils.equiv_store import content_key, file_digest, lookup, store
+from .utils.task_io import iter_tasks, write_tasks
 
 def template_domain(domain : Domain):
     """ Creates a templated domain string for a single action in a domain """
@@ -32,24 +42,132 @@ def template_domain(domain : Domain):
     domain_copy_str = domain_to_string(domain_copy)
     return domain_copy_str[:-2] + "{action})"
 
-DOMAIN_TEMPLATES = {domain_name : template_domain(domain_obj) \
-                    for domain_name, domain_obj in domainObjMap.items()}
-DOMAIN_PARSER = DomainParser()
+class _DomainTemplates(Mapping):
+    """ Map of domain names to their templates, each built on first lookup """
+    def __init__(self):
+        self._templates : dict[str, str] = {}
+
+    def __getitem__(self, domain_name : str) -> str:
+        if domain_name not in self._templates:
+            self._templates[domain_name] = \
+                template_domain(domainObjMap[domain_name])
+        return self._templates[domain_name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(domainObjMap)
+
+    def __len__(self) -> int:
+        return len(domainObjMap)
+
+DOMAIN_TEMPLATES : Mapping[str, str] = _DomainTemplates()
+
+_domain_parser : DomainParser = None
+
+def domain_parser() -> DomainParser:
+    """ Returns the shared DomainParser, building its grammar on first use """
+    global _domain_parser  # pylint: disable=global-statement
+    if _domain_parser is None:
+        _domain_parser = DomainParser()
+    return _domain_parser
+
+class _ActionContext(DomainTransformer):
+    """
+    A DomainTransformer that has transformed a domain template without
+    actions, leaving it with the template's requirements, constants, and
+    predicates as state, and that keeps the arguments of its domain rule.
+    Actions of the domain can then be transformed on their own, and checked
+    by building the domain with just that action like a full parse would.
+    """
+    def domain(self, args):
+        self.domain_args = args
+        return super().domain(args)
+
+_action_lark : Lark = None
+#Map of domain names to their action contexts
+_action_contexts : dict[str, _ActionContext] = {}
+
+def action_lark() -> Lark:
+    """
+    Returns a parser for the PDDL domain grammar that can start at either a
+    whole domain or a single action definition
+    """
+    global _action_lark  # pylint: disable=global-statement
+    if _action_lark is None:
+        _action_lark = Lark(DOMAIN_GRAMMAR_FILE.read_text(), parser="lalr",
+                            start=["start", "action_def"],
+                            import_paths=[PARSERS_DIRECTORY])
+    return _action_lark
+
+def action_context(domain_name : str) -> _ActionContext:
+    """ Returns the action context of a domain, built on first use """
+    if domain_name not in _action_contexts:
+        context = _ActionContext()
+        context.transform(action_lark().parse(
+            DOMAIN_TEMPLATES[domain_name].format(action=""), start="start"))
+        _action_contexts[domain_name] = context
+    return _action_contexts[domain_name]
+
+def parse_action(action_str : str, domain_name : str) -> Action:
+    """
+    Parses a single action of a domain without reparsing the rest of the
+    domain. Raises the same errors as DomainParser on the domain template
+    with the action filled in, lark parse errors for malformed PDDL and a
+    VisitError for actions the domain rejects.
+    """
+    context = action_context(domain_name)
+    tree = action_lark().parse(action_str, start="action_def")
+    action = context.transform(tree)
+    args = context.domain_args
+    try:
+        DomainTransformer.domain(context, args[:-1] + [action] + args[-1:])
+    except Exception as e:
+        #lark wraps errors raised while building the domain the same way
+        raise VisitError("domain", tree, e) from e
+    return action
+
+def __getattr__(name : str) -> Any:
+    #DOMAIN_PARSER is built on first access
+    if name == "DOMAIN_PARSER":
+        return domain_parser()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+_PAREN = re.compile(r"[()]")
+
+class ParenScanner:
+    """
+    matching_closing_paren run incrementally over text arriving in chunks,
+    such as a streamed model output. Finds where the first ( of the text is
+    closed, which is where syntax_check stops reading.
+    """
+    def __init__(self):
+        self.length = 0
+        self.depth = 0
+        self.started = False
+        self.end : int = None
+
+    def feed(self, chunk : str) -> int:
+        """
+        Scans the next chunk of text, returns the length of the text up to
+        and including the matching ) once it has been seen, None before.
+        """
+        if self.end is None:
+            for match in _PAREN.finditer(chunk):
+                if match.group() == "(":
+                    self.started = True
+                    self.depth += 1
+                elif self.started:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        self.end = self.length + match.end()
+                        break
+            self.length += len(chunk)
+        return self.end
 
 def matching_closing_paren(s : str) -> int:
     """ Returns the index of the closing ) for the ( at the first pos """
     assert s[0] == '('
-    count = 1
-    i = 1
-    while i < len(s):
-        if s[i] == ')':
-            count -= 1
-        elif s[i] == '(':
-            count += 1
-        if count == 0:
-            return i
-        i += 1
-    return None
+    end = ParenScanner().feed(s)
+    return None if end is None else end - 1
 
 def syntax_check(model_output : str) -> tuple[str, str, str, str]:
     """
@@ -84,36 +202,184 @@ def str_to_action(model_output : str, domain_name : str) \
 -> tuple[Action, str, str, str]:
     """
     Converts a string to a PDDL action object. 
+
+    Parses are memoized on the domain and the extracted action text, see
+    cached_parse_action, so the returned action is shared and must not be
+    modified.
     """
     action_str, result_class, result_subclass, err_msg = \
         syntax_check(model_output)
     if action_str is None:
         return action_str, result_class, result_subclass, err_msg
-    action_domain = DOMAIN_TEMPLATES[domain_name].format(action=action_str)
+    return cached_parse_action(domain_name, action_str)
+
+#Number of parsed actions kept in memory
+ACTION_CACHE_SIZE = 65536
+#If parses are also kept in the persistent equivalence store
+_action_disk_cache : bool = False
+#Number of parses found in the persistent store
+_action_disk_hits : int = 0
+
+def set_action_disk_cache(enabled : bool) -> None:
+    """
+    Sets if parsed actions are also kept in the persistent equivalence
+    store, so separate runs and pipeline stages share them.
+    """
+    global _action_disk_cache  # pylint: disable=global-statement
+    _action_disk_cache = enabled
+
+def _parse_action_result(domain_name : str, action_str : str) \
+-> tuple[Action, str, str, str]:
+    """ parse_action with errors returned as str_to_action does """
     try:
-        tree = DOMAIN_PARSER(action_domain)
-        for action in tree.actions:
-            return action, "", "", ""
+        return parse_action(action_str, domain_name), "", "", ""
     except Exception as e:
         return None, "SyntaxError", "ParseError", repr(e)
 
+@lru_cache(maxsize=ACTION_CACHE_SIZE)
+def cached_parse_action(domain_name : str, action_str : str) \
+-> tuple[Action, str, str, str]:
+    """
+    Returns the (action, error class, error subclass, error message) result
+    of parsing action_str in the domain, parsing each distinct action once.
+    Results are kept in a bounded LRU cache and, if enabled with
+    set_action_disk_cache, in the equivalence store keyed by a hash of the
+    domain file, pddl version and action text.
+    """
+    global _action_disk_hits  # pylint: disable=global-statement
+    if not _action_disk_cache:
+        return _parse_action_result(domain_name, action_str)
+    key = content_key("action", domain_name,
+                      file_digest(domainPathMap[domain_name]), PDDL_VERSION,
+                      action_str)
+    stored = lookup("actions", key)
+    if stored is not None:
+        _action_disk_hits += 1
+        return pickle.loads(base64.b64decode(stored))
+    result = _parse_action_result(domain_name, action_str)
+    store("actions", key, base64.b64encode(pickle.dumps(result)).decode())
+    return result
+
+def action_cache_info() -> dict[str, Any]:
+    """
+    Returns the hits, misses, and hit rate of the action parse cache, the
+    number of misses that were found in the persistent store, and the
+    number of cached parses
+    """
+    info = cached_parse_action.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "hits" : info.hits,
+        "misses" : info.misses,
+        "diskHits" : _action_disk_hits,
+        "hitRate" : info.hits / lookups if lookups else 0.0,
+        "size" : info.currsize,
+    }
+
+@lru_cache(maxsize=None)
+def action_index(domain_name : str) -> dict[str, Action]:
+    """ Returns a map of the lowercase action names of a domain to its actions """
+    return {action.name.lower() : action
+            for action in domainObjMap[domain_name].actions}
+
 def get_modified_domain(domain_name : str, new_action : Action) \
 -> tuple[Domain, str, str, str]:
     """
     Return a new domain with the new action generated by the LLM
+
+    The new domain is a shallow copy of the cached domain, so everything but
+    its set of actions is shared with it and must not be modified.
     """
-    domain_copy : Domain = copy.deepcopy(domainObjMap[domain_name])
+    domain : Domain = domainObjMap[domain_name]
     action_name : str = new_action.name
-    #linear search for action name since can't const time lookup the set
-    for original_action in domain_copy.actions:
-        if new_action.name.lower() == original_action.name.lower():
-            new_action._name = original_action.name.lower()
-            domain_copy._actions = domain_copy.actions.difference({original_action})
-            domain_copy._actions = domain_copy.actions.union({new_action})
-            return domain_copy, "", "", ""
-    #The action name is wrong
-    return None, "SemanticError", "DifActionName", "Domain creation error, no match for" +\
-          f"{action_name.lower()} in {domain_copy.name}"
+    original_action = action_index(domain_name).get(action_name.lower())
+    if original_action is None:
+        #The action name is wrong
+        return None, "SemanticError", "DifActionName", "Domain creation error, no match for" +\
+              f"{action_name.lower()} in {domain.name}"
+    #Parsed actions are shared through the parse cache, so rename a copy
+    new_action = copy.copy(new_action)
+    new_action._name = original_action.name.lower()
+    domain_copy = copy.copy(domain)
+    domain_copy._actions = domain.actions.difference({original_action})
+    domain_copy._actions = domain_copy.actions.union({new_action})
+    return domain_copy, "", "", ""
+
+def _remove_empty_lines(s : str) -> str:
+    """ Removes whitespace only lines like the pddl formatter does """
+    return "\n".join(filter(str.strip, s.splitlines()))
+
+@lru_cache(maxsize=None)
+def _domain_text_parts(domain_name : str) -> tuple[str, dict[int, str]]:
+    """
+    Returns the text domain_to_string gives a domain up to its actions, and
+    a map of the ids of its actions to their text
+    """
+    domain = domainObjMap[domain_name]
+    domain_copy = copy.copy(domain)
+    domain_copy._actions = set()
+    head = domain_to_string(domain_copy).rsplit("\n", 1)[0]
+    return head, {id(action) : str(action) + "\n" for action in domain.actions}
+
+def _stitch_domain_text(head : str, texts : list[str]) -> str:
+    """ Joins a domain head and action texts as domain_to_string does """
+    #Actions are formatted sorted by their text as in domain_to_string
+    actions = _remove_empty_lines(textwrap.indent(" ".join(sorted(texts)),
+                                                  " " * 4))
+    return head + ("\n" + actions if actions else "") + "\n)"
+
+@lru_cache(maxsize=None)
+def base_domain_hash(domain_name : str) -> str:
+    """
+    Returns a hash of the text of the original domain, recorded with action
+    deltas so they are never applied to a domain that has since changed.
+    """
+    head, action_texts = _domain_text_parts(domain_name)
+    text = _stitch_domain_text(head, list(action_texts.values()))
+    return content_key("domain", text)
+
+def action_delta(domain_name : str, new_domain : Domain) -> dict[str, str]:
+    """
+    Returns the fields that describe a domain returned by get_modified_domain
+    relative to the original domain: the text of the replacement action,
+    and the name and hash of the domain it replaces an action in.
+    """
+    _, action_texts = _domain_text_parts(domain_name)
+    new_actions = [action for action in new_domain.actions
+                   if id(action) not in action_texts]
+    return {
+        "newAction": str(new_actions[0]) if new_actions else "",
+        "baseDomain": domain_name,
+        "baseDomainHash": base_domain_hash(domain_name),
+    }
+
+def domain_with_action_text(domain_name : str, action_text : str) -> str:
+    """
+    Returns the text of the original domain with the action of the same name
+    replaced by action_text, the str of an action. This is identical to
+    domain_to_string of the get_modified_domain domain the action came from,
+    reusing the cached text of every other action.
+    """
+    head, action_texts = _domain_text_parts(domain_name)
+    action_name = action_text[len("(:action "):].split(None, 1)[0]
+    replaced = id(action_index(domain_name)[action_name.lower()])
+    texts = [text for action_id, text in action_texts.items()
+             if action_id != replaced]
+    return _stitch_domain_text(head, texts + [action_text + "\n"])
+
+def materialize_domain(result : dict[str, Any]) -> str:
+    """
+    Returns the text of the new domain of a parsed result. Results store
+    the new action and a reference to their base domain, older parsed
+    outputs that store the whole newDomain are still accepted.
+    """
+    if "newDomain" in result:
+        return result["newDomain"]
+    domain_name = result["baseDomain"]
+    if result["baseDomainHash"] != base_domain_hash(domain_name):
+        raise RuntimeError(f"The {domain_name} domain changed since this "
+                           "result was parsed, parse its outputs again")
+    return domain_with_action_text(domain_name, result["newAction"])
 
 def parse_lmm_outputs(results : list[dict[str, Any]]) \
 -> list[dict[str, Any]]:
@@ -122,15 +388,26 @@ def parse_lmm_outputs(results : list[dict[str, Any]]) \
     Marks items that can not be parsed with an syntax or semantic error flag,
     which will prevent it from being evaluated upstream.
     """
-    parsed_results = []
-    for task in tqdm(results):
+    return list(iter_parse_llm_outputs(tqdm(results)))
+
+def iter_parse_llm_outputs(results : Iterable[dict[str, Any]]) \
+-> Iterator[dict[str, Any]]:
+    """
+    parse_lmm_outputs as a generator, parses and yields one task at a time
+    so only the task being parsed is held in memory.
+    """
+    for task in results:
         task_copy = copy.deepcopy(task)
         for result in task_copy["results"]:
             result["resultClass"] = ""
             result["errorSubclass"] = ""
-            result["newDomain"] = ""
+            result["newAction"] = ""
+            result["baseDomain"] = task["domain"]
+            result["baseDomainHash"] = ""
             if result["error"]:
-                raise f"Model Error, for {task.model}"
+                #The model call failed, errorMsg holds why
+                result["resultClass"] = "ModelError"
+                continue
             domain_name = task["domain"]
             action, err1, err2, err_msg = str_to_action(result["output"], domain_name)
             if action is None:
@@ -146,9 +423,8 @@ def parse_lmm_outputs(results : list[dict[str, Any]]) \
                 result["errorSubclass"] = err2
                 result["errorMsg"] = err_msg
                 continue
-            result["newDomain"] = domain_to_string(new_domain)
-        parsed_results.append(task_copy)
-    return parsed_results
+            result.update(action_delta(domain_name, new_domain))
+        yield task_copy
 
 
 def parse_llm_outputs_from_file(results_file_path : str) -> list[dict[str, Any]]:
@@ -156,20 +432,26 @@ def parse_llm_outputs_from_file(results_file_path : str) -> list[dict[str, Any]]
     Given the tasks file generated by call_llm.py, parse the LLM outputs,
     and return the updated tasks file.
     """
-    with open(results_file_path, "r", encoding="utf-8") as raw_llm_outputs_file:
-        results = json.load(raw_llm_outputs_file)
-    return parse_lmm_outputs(results)
+    return parse_lmm_outputs(list(iter_tasks(results_file_path)))
+
+def iter_parsed_outputs_from_file(results_file_path : str) \
+-> Iterator[dict[str, Any]]:
+    """
+    parse_llm_outputs_from_file as a generator, the tasks file (a JSON array
+    or JSON lines) is read incrementally and each task is yielded once parsed.
+    """
+    return iter_parse_llm_outputs(tqdm(iter_tasks(results_file_path)))
 
 def save_parsed_outputs_file(parsed_results, parsed_outputs_path = None):
     """
     Given the parsed llm output task results, save them to a file with an optional
-    path.
+    path. parsed_results may be a generator, tasks are written as they are
+    produced, and a path ending in .jsonl writes JSON lines.
     """
     if parsed_outputs_path is None:
         timestamp = int(time.time())
         parsed_outputs_path = f"parsedOutputs/parsed-{timestamp}.json"
-    with open(parsed_outputs_path, "w", encoding="utf-8") as outfile:
-        json.dump(parsed_results, outfile, indent=2)
+    write_tasks(parsed_results, parsed_outputs_path)
 
 #By default run on the greedy all outputs.
 if __name__ == "__main__":
@@ -0,0 +1,88 @@
+"""
+This file contains the append-only journal compute_metrics uses to
+checkpoint long metric runs. Every result is journaled as soon as its
+metrics are known, keyed by the id of its task and its index in the task's
+results, so a run restarted on the same input after a crash or Ctrl-C
+restores finished results from the journal instead of evaluating them again.
+
+Like the equivalence store, the journal never records a PlanError, e.g. a
+K* timeout, so a restarted run evaluates those results again.
+
+The journal is a JSON lines file. A record cut short by a crash is ignored
+when the journal is loaded, so at worst the result being written when the
+run died is evaluated again.
+"""
+
+#Standard Libs
+import os
+import json
+from typing import Any
+
+#Internal Libs
+from .equiv_store import content_key
+
+#The result fields compute_metrics sets, which are all a journal records
+METRIC_FIELDS = ("actionDif", "workingPlans", "resultClass", "errorSubclass",
+                 "errorMsg", "error")
+
+def task_id(task : dict[str, Any]) -> str:
+    """
+    Returns an id for a task of the metrics input, the hash of its
+    contents, which is the same across runs on the same input.
+    """
+    return content_key("task", task)
+
+class Journal:
+    """
+    An append-only journal of the metric fields of finished results,
+    loaded from path if it exists.
+    """
+    def __init__(self, path : str):
+        self.path = path
+        self.records : dict[tuple[str, int], dict[str, Any]] = {}
+        line = "\n"
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        #A partial record left by a crash mid write
+                        continue
+                    self.records[(record["task"], record["index"])] = \
+                        record["fields"]
+        self._file = open(path, "a", encoding="utf-8")  # pylint: disable=R1732
+        #Start on a fresh line if the last record was cut short
+        if not line.endswith("\n"):
+            self._file.write("\n")
+
+    def __enter__(self) -> "Journal":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def get(self, task : str, index : int) -> dict[str, Any]:
+        """Returns the journaled fields of a result or None"""
+        return self.records.get((task, index))
+
+    def record(self, task : str, index : int, result : dict[str, Any]) -> None:
+        """
+        Journals the metric fields of a finished result and flushes them,
+        unless the result is a PlanError, which is evaluated again on resume.
+        """
+        if result.get("resultClass") == "PlanError":
+            return
+        fields = {field : result[field] for field in METRIC_FIELDS
+                  if field in result}
+        self.records[(task, index)] = fields
+        self._file.write(json.dumps({"task" : task, "index" : index,
+                                     "fields" : fields}) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        """Closes the journal file"""
+        self._file.close()
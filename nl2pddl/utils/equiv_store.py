@@ -0,0 +1,112 @@
+"""
+Planning and validating generated domains is by far the most expensive part
+of computing metrics, and the same generated domain is often scored in
+several experiments. This file contains a persistent, content addressed store
+for K* plan sets, VAL outcomes, heuristic domain equivalence results,
+parsed LLM actions and LLM responses, so that reruns only pay for domains
+and prompts they have not seen before.
+
+Entries are keyed by a hash of everything the result depends on (domain
+text, problem file contents, k, planner configuration, ...). The store is a
+single SQLite file, each process opens its own connection in WAL mode so
+several metric workers can read and write it concurrently.
+"""
+
+#Standard Libs
+import os
+import json
+import sqlite3
+import hashlib
+from typing import Any
+from functools import lru_cache
+
+#Internal Libs
+from .scratch import in_scratch
+
+#Default location of the store, None disables it
+EQUIV_STORE_PATH = "equiv_store.sqlite"
+
+#Tables of the store, all map a content key to a json value
+STORE_TABLES = ("plans", "validations", "equiv", "actions", "responses")
+
+#How many file digests to memoize, the data files are only a few thousand
+FILE_DIGEST_MEMO_SIZE = 8192
+
+_store_path : str = EQUIV_STORE_PATH
+#Map of (process id, store path) to that process's connection
+_connections : dict[tuple[int, str], sqlite3.Connection] = {}
+
+def set_store_path(path : str) -> None:
+    """
+    Sets the path of the store used by subsequent lookups, a path of None
+    disables the store entirely.
+    """
+    global _store_path  # pylint: disable=global-statement
+    _store_path = path
+
+def content_key(*parts : Any) -> str:
+    """Returns a hex sha256 digest of the json serializable parts"""
+    encoded = json.dumps(parts, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+def _hash_file(path : str) -> str:
+    """Hashes the file contents"""
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+@lru_cache(maxsize=FILE_DIGEST_MEMO_SIZE)
+def _file_digest(path : str, _mtime_ns : int, _size : int) -> str:
+    """Hashes the file contents, memoized on its path, mtime and size"""
+    return _hash_file(path)
+
+def file_digest(path : str) -> str:
+    """
+    Returns a hex sha256 digest of the contents of the file at path.
+    Scratch files are always hashed, as a file rewritten in a slot within
+    the mtime resolution with the same size would reuse a stale digest.
+    """
+    if in_scratch(path):
+        return _hash_file(path)
+    stat = os.stat(path)
+    return _file_digest(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+def connect() -> sqlite3.Connection:
+    """
+    Returns this process's connection to the store, creating the store if
+    needed, or None if the store is disabled. Connections are never shared
+    across processes since forked pool workers can not reuse them.
+    """
+    if _store_path is None:
+        return None
+    conn_key = (os.getpid(), _store_path)
+    if conn_key not in _connections:
+        conn = sqlite3.connect(_store_path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for table in STORE_TABLES:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                         "(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        conn.commit()
+        _connections[conn_key] = conn
+    return _connections[conn_key]
+
+def lookup(table : str, key : str) -> Any:
+    """
+    Returns the value stored under key in table, or None if it is not
+    stored or the store is disabled.
+    """
+    conn = connect()
+    if conn is None:
+        return None
+    row = conn.execute(f"SELECT value FROM {table} WHERE key = ?", (key,))\
+              .fetchone()
+    return None if row is None else json.loads(row[0])
+
+def store(table : str, key : str, value : Any) -> None:
+    """Stores the json serializable value under key in table"""
+    conn = connect()
+    if conn is None:
+        return
+    with conn:
+        conn.execute(f"INSERT OR REPLACE INTO {table} VALUES (?, ?)",
+                     (key, json.dumps(value)))
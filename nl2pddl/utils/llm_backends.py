@@ -0,0 +1,236 @@
+"""
+This file contains the inference backends the LLM client in llm_client.py
+generates outputs with. A backend takes a batch of (request id, prompt)
+pairs and returns an async iterator over (request id, generated text) pairs,
+so the client never depends on the order outputs are delivered in.
+
+Backends can also stream the output of a single prompt as (text, number of
+tokens) chunks, so the client can stop a generation it has seen enough of by
+closing the iterator, which drops the connection and cancels the request.
+
+Backends raise RetryableError for transient failures of a batch, after
+which the client retries the requests that have not been answered yet, and
+RuntimeError for failures that would happen again.
+
+GenAIBackend speaks the IBM GenAI generate REST API the genai SDK uses,
+OpenAIBackend any OpenAI compatible completions endpoint, and both can be
+pointed at the stand-in server in mock_llm_server.py.
+"""
+
+#Standard Libs
+import os
+import json
+import asyncio
+from typing import Any, AsyncIterator, Protocol
+
+#External Libs
+import aiohttp
+from dotenv import load_dotenv
+
+#Internal Libs
+from .response_cache import cache_namespace
+
+#Seconds a single request may take
+REQUEST_TIMEOUT = 120
+#HTTP statuses that signal a transient failure worth retrying
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+class RetryableError(Exception):
+    """A transient request failure, with the delay the server asked for"""
+    def __init__(self, message : str, retry_after : float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Backend(Protocol):
+    """
+    What the LLM client needs from an inference backend. generation_parameters
+    are in the GenAI format call_llm has always recorded with results.
+    cache_namespace separates cached responses of different services, see
+    response_cache.py, None never caches the backend's outputs.
+    """
+    model_name : str
+    generation_parameters : dict[str, Any]
+    cache_namespace : str
+
+    def generate(self, batch : list[tuple[int, str]]) \
+    -> AsyncIterator[tuple[int, str]]:
+        """Yields a (request id, generated text) pair for each prompt"""
+
+    def stream(self, prompt : str) -> AsyncIterator[tuple[str, int]]:
+        """Yields the output of a prompt as (text, number of tokens) chunks"""
+
+    async def close(self) -> None:
+        """Releases the connections of the backend"""
+
+def _retry_after(headers : Any) -> float:
+    """Parses a Retry-After header given in seconds"""
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+class HTTPBackend:
+    """
+    The shared part of backends that POST JSON to an HTTP API, a session
+    opened on first use and turning failures into the errors clients expect.
+    """
+    def __init__(self, model_name : str, generation_parameters : dict[str, Any],
+                 api_key : str = None):
+        self.model_name = model_name
+        self.generation_parameters = generation_parameters
+        self.api_key = api_key
+        self._session : aiohttp.ClientSession = None
+
+    def _post(self, url : str, payload : dict[str, Any]) -> Any:
+        """
+        Returns the context manager of a POST of payload to url, opening the
+        session on first use
+        """
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+        headers = {"Authorization" : f"Bearer {self.api_key}"} \
+            if self.api_key else {}
+        return self._session.post(url, json=payload, headers=headers)
+
+    @staticmethod
+    async def _check_status(response : aiohttp.ClientResponse) -> None:
+        """Raises the error a failed response calls for"""
+        if response.status in RETRY_STATUSES:
+            raise RetryableError(f"HTTP {response.status}",
+                                 _retry_after(response.headers))
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status}: "
+                               + await response.text())
+
+    async def post(self, url : str, payload : dict[str, Any]) -> Any:
+        """
+        POSTs payload to url and returns the decoded JSON response, raising
+        RetryableError for transient failures and RuntimeError otherwise.
+        """
+        try:
+            async with self._post(url, payload) as response:
+                await self._check_status(response)
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            raise RetryableError(f"{type(err).__name__}: {err}") from err
+
+    async def post_stream(self, url : str, payload : dict[str, Any]) \
+    -> AsyncIterator[Any]:
+        """
+        post for a response streamed as server-sent events, yields the
+        decoded JSON data of each event. Closing the iterator before the
+        stream ends closes the connection, cancelling the generation.
+        """
+        try:
+            async with self._post(url, payload) as response:
+                await self._check_status(response)
+                try:
+                    async for line in response.content:
+                        line = line.decode("utf-8").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            return
+                        yield json.loads(data)
+                finally:
+                    if not response.content.at_eof():
+                        response.close()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            raise RetryableError(f"{type(err).__name__}: {err}") from err
+
+    async def close(self) -> None:
+        """Closes the session if one was opened"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+class GenAIBackend(HTTPBackend):
+    """
+    The IBM GenAI generate REST API, GENAI_API and GENAI_KEY from .env are
+    used unless an api_url or api_key is given.
+    """
+    def __init__(self, model_name : str, generation_parameters : dict[str, Any],
+                 api_url : str = None, api_key : str = None):
+        load_dotenv()
+        super().__init__(model_name, generation_parameters,
+                         api_key or os.getenv("GENAI_KEY"))
+        self.api_url = (api_url or os.getenv("GENAI_API")).rstrip("/")
+        self.cache_namespace = cache_namespace("genai", self.api_url)
+
+    async def generate(self, batch : list[tuple[int, str]]) \
+    -> AsyncIterator[tuple[int, str]]:
+        """Sends the batch as the inputs of one request"""
+        body = await self.post(self.api_url + "/generate", {
+            "model_id" : self.model_name,
+            "inputs" : [prompt for _, prompt in batch],
+            "parameters" : self.generation_parameters,
+        })
+        #Results are in the order of the inputs
+        for (request_id, _), result in zip(batch, body["results"]):
+            yield request_id, result["generated_text"]
+
+    async def stream(self, prompt : str) -> AsyncIterator[tuple[str, int]]:
+        """Streams the output of one prompt"""
+        num_tokens = 0
+        async for event in self.post_stream(self.api_url + "/generate", {
+            "model_id" : self.model_name,
+            "inputs" : [prompt],
+            "parameters" : {**self.generation_parameters, "stream" : True},
+        }):
+            for result in event.get("results", []):
+                #The generated token count is a running total
+                count = result.get("generated_token_count")
+                count = num_tokens + 1 if count is None else count
+                yield result.get("generated_text") or "", count - num_tokens
+                num_tokens = count
+
+def openai_parameters(generation_parameters : dict[str, Any]) \
+-> dict[str, Any]:
+    """Translates GenAI generation parameters to OpenAI completion ones"""
+    params = {}
+    if "max_new_tokens" in generation_parameters:
+        params["max_tokens"] = generation_parameters["max_new_tokens"]
+    if generation_parameters.get("stop_sequences"):
+        params["stop"] = generation_parameters["stop_sequences"]
+    for name in ("temperature", "top_p", "seed"):
+        if name in generation_parameters:
+            params[name] = generation_parameters[name]
+    if generation_parameters.get("decoding_method", "greedy") == "greedy":
+        params["temperature"] = 0
+    return params
+
+class OpenAIBackend(HTTPBackend):
+    """
+    Any OpenAI compatible completions endpoint, such as vLLM or TGI,
+    base_url being the URL the /completions path is under.
+    """
+    def __init__(self, model_name : str, generation_parameters : dict[str, Any],
+                 base_url : str, api_key : str = None):
+        super().__init__(model_name, generation_parameters, api_key)
+        self.base_url = base_url.rstrip("/")
+        self.cache_namespace = cache_namespace("openai", self.base_url)
+
+    async def generate(self, batch : list[tuple[int, str]]) \
+    -> AsyncIterator[tuple[int, str]]:
+        """Sends the batch as the prompt list of one request"""
+        body = await self.post(self.base_url + "/completions", {
+            "model" : self.model_name,
+            "prompt" : [prompt for _, prompt in batch],
+            **openai_parameters(self.generation_parameters),
+        })
+        #Choices carry the index of their prompt
+        for choice in body["choices"]:
+            yield batch[choice["index"]][0], choice["text"]
+
+    async def stream(self, prompt : str) -> AsyncIterator[tuple[str, int]]:
+        """Streams the output of one prompt, a token per event"""
+        async for event in self.post_stream(self.base_url + "/completions", {
+            "model" : self.model_name,
+            "prompt" : prompt,
+            "stream" : True,
+            **openai_parameters(self.generation_parameters),
+        }):
+            for choice in event["choices"]:
+                yield choice["text"], 1
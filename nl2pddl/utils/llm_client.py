@@ -0,0 +1,438 @@
+"""
+This file contains an asyncio client that call_llm uses to run prompts
+concurrently on an inference backend from llm_backends.py. Requests are
+bounded by a concurrency cap and by request and token per second limits,
+failed requests are retried with exponential backoff, and every task is
+identified by an explicit id, so results can be appended to disk in
+whatever order they arrive and matched back to their task.
+
+In streaming mode each output is scanned as it arrives and the request is
+cancelled as soon as the first ( of the output is closed, since
+parse_llm_outputs.syntax_check ignores everything after it.
+"""
+
+#Standard Libs
+import os
+import json
+import copy
+import random
+import asyncio
+import hashlib
+from typing import Any, AsyncIterator, Callable, Union
+
+#External Libs
+from aiolimiter import AsyncLimiter
+
+#Internal Libs
+from .llm_backends import Backend, RetryableError
+from .response_cache import cacheable, lookup_response, store_response
+from ..parse_llm_outputs import ParenScanner
+
+#How many generate requests may be in flight at once
+MAX_CONCURRENCY = 8
+#Request and token rate limits, None for no limit
+REQUESTS_PER_SECOND = 10
+TOKENS_PER_SECOND = None
+#How many times a failed request is retried before its tasks record an error
+MAX_RETRIES = 5
+#Seconds the first retry waits at most, doubling with each retry up to
+#BACKOFF_MAX
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+#Rough number of characters per token, used to charge prompts against the
+#token limit before the service has tokenized them
+CHARS_PER_TOKEN = 4
+
+class RateLimiter:
+    """Limits requests and tokens per second, either limit may be None"""
+    def __init__(self, requests_per_second : float = REQUESTS_PER_SECOND,
+                 tokens_per_second : float = TOKENS_PER_SECOND):
+        self.requests = AsyncLimiter(requests_per_second, 1) \
+            if requests_per_second else None
+        self.tokens = AsyncLimiter(tokens_per_second, 1) \
+            if tokens_per_second else None
+
+    async def acquire(self, num_tokens : int) -> None:
+        """Waits until a request costing num_tokens tokens may be sent"""
+        if self.requests is not None:
+            await self.requests.acquire()
+        if self.tokens is not None:
+            #A request can never cost more than the whole budget
+            await self.tokens.acquire(min(num_tokens, self.tokens.max_rate))
+
+def estimate_tokens(prompt : str, generation_parameters : dict[str, Any]) \
+-> int:
+    """Estimates the tokens a request uses, its prompt and its output"""
+    return len(prompt) // CHARS_PER_TOKEN + \
+        generation_parameters.get("max_new_tokens", 0)
+
+def backoff_delay(attempt : int, retry_after : float = None) -> float:
+    """
+    Returns how long to wait before retry number attempt (from 0), with
+    full jitter so clients that failed together do not retry together.
+    A delay the server asked for is respected.
+    """
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    return max(delay, retry_after or 0)
+
+async def generate_with_retries(backend : Backend,
+                                prompts : dict[int, str],
+                                limiter : RateLimiter,
+                                max_retries : int = MAX_RETRIES) \
+-> AsyncIterator[tuple[int, str, str]]:
+    """
+    Generates with backend for a batch of prompts by request id, waiting on
+    the rate limiter before every attempt. Yields a (request id, output,
+    error message) triple per prompt as soon as it is known. After a
+    transient failure only the prompts without an output are retried, with
+    exponential backoff, up to max_retries times.
+    """
+    remaining = dict(prompts)
+    for attempt in range(max_retries + 1):
+        await limiter.acquire(sum(estimate_tokens(prompt,
+                                                  backend.generation_parameters)
+                                  for prompt in remaining.values()))
+        try:
+            async for request_id, text in backend.generate(
+                    list(remaining.items())):
+                if remaining.pop(request_id, None) is not None:
+                    yield request_id, text, ""
+            break
+        except RetryableError as err:
+            if attempt == max_retries:
+                for request_id in remaining:
+                    yield request_id, "", f"Gave up after {attempt + 1} " + \
+                        f"attempts, last error {err}"
+                return
+            await asyncio.sleep(backoff_delay(attempt, err.retry_after))
+        except RuntimeError as err:
+            for request_id in remaining:
+                yield request_id, "", str(err)
+            return
+    for request_id in remaining:
+        yield request_id, "", "No output was returned for this prompt"
+
+async def stream_with_retries(backend : Backend, prompt : str,
+                             limiter : RateLimiter,
+                             max_retries : int = MAX_RETRIES) \
+-> tuple[str, str, int, bool]:
+    """
+    Streams the output of backend for a prompt until the first ( of the
+    output is closed, then cancels the request. Returns the output up to the
+    closing ), or all of it if the paren is never closed, an error message,
+    the number of tokens received and if the request was cancelled early.
+    A failed stream is restarted from scratch like generate_with_retries.
+    """
+    for attempt in range(max_retries + 1):
+        await limiter.acquire(estimate_tokens(prompt,
+                                              backend.generation_parameters))
+        scanner = ParenScanner()
+        chunks, num_tokens = [], 0
+        stream = backend.stream(prompt)
+        try:
+            async for text, tokens in stream:
+                chunks.append(text)
+                num_tokens += tokens
+                end = scanner.feed(text)
+                if end is not None:
+                    return "".join(chunks)[:end], "", num_tokens, True
+            return "".join(chunks), "", num_tokens, False
+        except RetryableError as err:
+            if attempt == max_retries:
+                return "", f"Gave up after {attempt + 1} attempts, " + \
+                    f"last error {err}", num_tokens, False
+            await asyncio.sleep(backoff_delay(attempt, err.retry_after))
+        except RuntimeError as err:
+            return "", str(err), num_tokens, False
+        finally:
+            await stream.aclose()
+    return "", "No output was returned for this prompt", 0, False
+
+def _config_key(result : dict[str, Any]) -> str:
+    """Identifies the model and parameters a result was generated with"""
+    return json.dumps([result["model"], result["parameters"]], sort_keys=True)
+
+def _prompt_hash(prompt : str) -> str:
+    """A hex sha256 digest of a prompt, recorded to resume runs by"""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+def _resume_key(task_id : int, prompt_hash : str, config_key : str) \
+-> tuple[int, str, str]:
+    """
+    Identifies a result an interrupted run can reuse, only for the same
+    task, prompt, model and parameters
+    """
+    return task_id, prompt_hash, config_key
+
+def _finished_ids(outputs_path : str) -> dict[tuple[int, str, str], Any]:
+    """
+    Returns the tasks in an outputs file of call_llm_async by the
+    _resume_key of their last result, so an interrupted run can resume.
+    Error results are left out so they are requested again.
+    """
+    finished = {}
+    if outputs_path is None or not os.path.exists(outputs_path):
+        return finished
+    with open(outputs_path, "r", encoding="utf-8") as outputs_file:
+        for line in outputs_file:
+            try:
+                task = json.loads(line)
+            except json.JSONDecodeError:
+                #A partial record left by a crash mid write
+                continue
+            if not task["results"] or task["results"][-1]["error"]:
+                continue
+            key = _resume_key(task["taskId"], _prompt_hash(task["prompt"]),
+                              _config_key(task["results"][-1]))
+            finished[key] = task
+    return finished
+
+def _open_outputs(outputs_path : str) -> Any:
+    """
+    Opens an outputs file for appending JSON lines, or returns None if
+    outputs_path is None
+    """
+    if outputs_path is None:
+        return None
+    outputs_file = open(outputs_path, "a+", encoding="utf-8")  # pylint: disable=R1732
+    #Start on a fresh line if the last record was cut short
+    if outputs_file.tell() > 0:
+        outputs_file.seek(outputs_file.tell() - 1)
+        if outputs_file.read(1) != "\n":
+            outputs_file.write("\n")
+    return outputs_file
+
+async def generate_results(
+    backend : Backend, prompts : dict[int, str],
+    finish : Callable[[int, dict[str, Any]], None],
+    concurrency : int = MAX_CONCURRENCY, limiter : RateLimiter = None,
+    max_retries : int = MAX_RETRIES, batch_size : int = 1,
+    use_cache : bool = True, stream : bool = False
+) -> None:
+    """
+    Runs backend on prompts by task id, calling finish with the task id and
+    the result entry call_lmm would append to the task as soon as each is
+    known. Prompts are sent batch_size per request, with at most concurrency
+    requests in flight. Unless use_cache is False or the backend has no
+    cache_namespace, outputs cached in response_cache.py are reused and new
+    ones are cached.
+
+    With stream, every prompt is streamed on its own with
+    stream_with_retries, and its result also records outputTokens, the
+    tokens received, and tokensSaved, the max_new_tokens budget left unspent
+    by cancelling it, an upper bound on the tokens it saved. Outputs cut
+    short this way are not cached, and cached outputs, which were not
+    streamed, record outputTokens None and tokensSaved 0.
+    """
+    limiter = limiter if limiter is not None else RateLimiter()
+    model_name = backend.model_name
+    params = backend.generation_parameters
+    namespace = backend.cache_namespace
+    use_cache = use_cache and namespace is not None and cacheable(params)
+    semaphore = asyncio.Semaphore(concurrency)
+    cached = {task_id : lookup_response(namespace, model_name, params, prompt)
+              for task_id, prompt in prompts.items()} if use_cache else {}
+    cached = {task_id : text for task_id, text in cached.items()
+              if text is not None}
+    todo = [task_id for task_id in prompts if task_id not in cached]
+    batch_size = 1 if stream else batch_size
+    max_tokens = params.get("max_new_tokens", 0)
+    num_stopped = num_saved = 0
+
+    def result(text : str, err_msg : str = "",
+               **stream_stats : int) -> dict[str, Any]:
+        """Returns the result entry of an output"""
+        return {
+            "model" : model_name,
+            "parameters" : params,
+            "output" : text,
+            "error" : err_msg != "",
+            "errorMsg" : err_msg,
+            **stream_stats
+        }
+
+    async def run_streamed(task_id : int) -> None:
+        """Streams the output of a task, stopping once its action is closed"""
+        nonlocal num_stopped, num_saved
+        prompt = prompts[task_id]
+        async with semaphore:
+            text, err_msg, num_tokens, stopped = await stream_with_retries(
+                backend, prompt, limiter, max_retries)
+        saved = max(max_tokens - num_tokens, 0) if stopped else 0
+        num_stopped += stopped
+        num_saved += saved
+        if use_cache and not err_msg and not stopped:
+            store_response(namespace, model_name, params, prompt, text)
+        finish(task_id, result(text, err_msg, outputTokens=num_tokens,
+                               tokensSaved=saved))
+
+    async def run_batch(task_ids : list[int]) -> None:
+        """Runs a batch of tasks, finishing each as its output arrives"""
+        if stream:
+            await run_streamed(task_ids[0])
+            return
+        batch = {task_id : prompts[task_id] for task_id in task_ids}
+        async with semaphore:
+            async for task_id, text, err_msg in generate_with_retries(
+                    backend, batch, limiter, max_retries):
+                if use_cache and not err_msg:
+                    store_response(namespace, model_name, params,
+                                   batch[task_id], text)
+                finish(task_id, result(text, err_msg))
+
+    print(f"LLM responses for {model_name}: {len(cached)} cached, "
+          f"{len(todo)} requested")
+    #Results keep the same fields whether or not their output was cached
+    cached_stats = {"outputTokens" : None, "tokensSaved" : 0} if stream else {}
+    for task_id, text in cached.items():
+        finish(task_id, result(text, **cached_stats))
+    await asyncio.gather(*(run_batch(todo[i:i + batch_size])
+                           for i in range(0, len(todo), batch_size)))
+    if stream:
+        print(f"Streaming stopped {num_stopped} of {len(todo)} requests "
+              f"for {model_name} early, saving up to {num_saved} tokens")
+
+async def call_llm_async(
+    tasks : list[dict[str, Any]], backend : Backend,
+    outputs_path : str = None, concurrency : int = MAX_CONCURRENCY,
+    limiter : RateLimiter = None, max_retries : int = MAX_RETRIES,
+    batch_size : int = 1, use_cache : bool = True, stream : bool = False
+) -> list[dict[str, Any]]:
+    """
+    Runs backend on the prompt of every task with generate_results and
+    returns a copy of the tasks, in input order, each with its result
+    appended like call_lmm does and a taskId, its index in tasks.
+
+    If outputs_path is given each finished task is appended to it as a JSON
+    line as soon as its result arrives. Tasks that file already holds a
+    result for, of the same prompt, model and parameters, are not sent
+    again, so rerunning an interrupted call with the same tasks and
+    outputs_path resumes it and retries the tasks that ended in an error.
+    Records of an edited prompt or other parameters are never reused.
+    """
+    finished = _finished_ids(outputs_path)
+    config_key = _config_key({"model" : backend.model_name,
+                              "parameters" : backend.generation_parameters})
+    #Tasks finished by an earlier run keep their recorded result
+    outputs = [finished.get(_resume_key(task_id, _prompt_hash(task["prompt"]),
+                                        config_key))
+               for task_id, task in enumerate(tasks)]
+    prompts = {task_id : tasks[task_id]["prompt"]
+               for task_id, output in enumerate(outputs) if output is None}
+    if len(prompts) < len(tasks):
+        print(f"Resumed {len(tasks) - len(prompts)} tasks from {outputs_path}")
+    outputs_file = _open_outputs(outputs_path)
+
+    def finish(task_id : int, result : dict[str, Any]) -> None:
+        """Stores the finished copy of a task in outputs and on disk"""
+        task_copy = copy.deepcopy(tasks[task_id])
+        task_copy["taskId"] = task_id
+        task_copy["results"].append(result)
+        outputs[task_id] = task_copy
+        if outputs_file is not None:
+            outputs_file.write(json.dumps(task_copy) + "\n")
+            outputs_file.flush()
+
+    try:
+        await generate_results(backend, prompts, finish, concurrency, limiter,
+                               max_retries, batch_size, use_cache, stream)
+    finally:
+        if outputs_file is not None:
+            outputs_file.close()
+        await backend.close()
+    return outputs
+
+def _finished_results(outputs_path : str) -> dict[tuple[int, str, str], Any]:
+    """
+    Returns the results in an outputs file of fan_out_async by their
+    _resume_key, so an interrupted run can resume. Error results, and
+    records without a prompt hash, are left out so they are requested again.
+    """
+    finished = {}
+    if outputs_path is None or not os.path.exists(outputs_path):
+        return finished
+    with open(outputs_path, "r", encoding="utf-8") as outputs_file:
+        for line in outputs_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                #A partial record left by a crash mid write
+                continue
+            if record["result"]["error"] or "promptHash" not in record:
+                continue
+            key = _resume_key(record["taskId"], record["promptHash"],
+                              _config_key(record["result"]))
+            finished[key] = record["result"]
+    return finished
+
+async def fan_out_async(
+    tasks : list[dict[str, Any]], backends : list[Backend],
+    outputs_path : str = None,
+    concurrency : Union[int, list[int]] = MAX_CONCURRENCY,
+    limiters : list[RateLimiter] = None, max_retries : int = MAX_RETRIES,
+    batch_size : int = 1, use_cache : bool = True, stream : bool = False
+) -> list[dict[str, Any]]:
+    """
+    Runs every backend on the prompt of every task at the same time, with
+    generate_results, and appends their results to the results of the tasks
+    in place, in the order of backends, so the prompts are held once however
+    many models run. concurrency and limiters may be given per backend, by
+    default every backend gets its own RateLimiter(). Returns tasks.
+
+    If outputs_path is given each result is appended to it as soon as it
+    arrives, as a JSON line holding the taskId, the index of its task, the
+    promptHash of its prompt and the result only. Results that file already
+    holds for the same prompt, model and parameters are reused, so rerunning
+    an interrupted call resumes it and retries the results that were errors.
+    """
+    if isinstance(concurrency, int):
+        concurrency = [concurrency] * len(backends)
+    if limiters is None:
+        limiters = [RateLimiter() for _ in backends]
+    prompt_hashes = [_prompt_hash(task["prompt"]) for task in tasks]
+    finished = _finished_results(outputs_path)
+    outputs_file = _open_outputs(outputs_path)
+
+    def finisher(backend_results : dict[int, dict[str, Any]]) \
+    -> Callable[[int, dict[str, Any]], None]:
+        """Returns the finish callback storing the results of a backend"""
+        def finish(task_id : int, result : dict[str, Any]) -> None:
+            backend_results[task_id] = result
+            if outputs_file is not None:
+                outputs_file.write(json.dumps({
+                    "taskId" : task_id,
+                    "promptHash" : prompt_hashes[task_id],
+                    "result" : result}) + "\n")
+                outputs_file.flush()
+        return finish
+
+    #Results of each backend by task id, appended once all have finished
+    results : list[dict[int, dict[str, Any]]] = []
+    runs = []
+    for backend, backend_concurrency, limiter in zip(backends, concurrency,
+                                                     limiters):
+        config_key = _config_key({"model" : backend.model_name,
+                                  "parameters" : backend.generation_parameters})
+        backend_results, prompts = {}, {}
+        for task_id, task in enumerate(tasks):
+            key = _resume_key(task_id, prompt_hashes[task_id], config_key)
+            if key in finished:
+                backend_results[task_id] = finished[key]
+            else:
+                prompts[task_id] = task["prompt"]
+        results.append(backend_results)
+        runs.append(generate_results(backend, prompts,
+                                     finisher(backend_results),
+                                     backend_concurrency, limiter,
+                                     max_retries, batch_size, use_cache,
+                                     stream))
+    try:
+        await asyncio.gather(*runs)
+    finally:
+        if outputs_file is not None:
+            outputs_file.close()
+        await asyncio.gather(*(backend.close() for backend in backends))
+    for task_id, task in enumerate(tasks):
+        task["results"].extend(backend_results[task_id]
+                               for backend_results in results)
+    return tasks
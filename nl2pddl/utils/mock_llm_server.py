@@ -0,0 +1,231 @@
+"""
+This file contains a deterministic local stand-in for an inference server,
+for testing and benchmarking the generation stage offline. It serves both
+the GenAI generate API (POST /v1/generate) and the OpenAI completions API
+(POST /v1/completions), so GenAIBackend and OpenAIBackend can be pointed at
+http://host:port/v1.
+
+Outputs are replayed from a task file: a prompt gets the output a model
+produced for it in the file, or the ground truth pddl of its task if the
+file holds no output for it, as in a prompts file. Each request is delayed
+by an exponentially distributed latency and fails with HTTP 503 at a given
+error rate. Both are drawn from a generator seeded with the seed, the
+prompt and how often the prompt was requested, so a run is repeatable and
+a retried prompt can succeed.
+
+Requests asking to stream get their output as server-sent events, a token
+per event, each taking token_latency seconds. With pad, outputs run on to
+max_new_tokens by repeating themselves, like a model that ignores its stop
+sequences, so cancelling streams early can be measured.
+
+Run from the repository root with:
+python -m nl2pddl.utils.mock_llm_server --replay data/prompts/prompts-1713726880.json
+"""
+
+#Standard Libs
+import re
+import json
+import random
+import asyncio
+import argparse
+from typing import Any
+
+#External Libs
+from aiohttp import web
+
+#Internal Libs
+from .task_io import iter_tasks
+
+#A prompts file shipped with the repository, replayed as ground truth pddl
+DEFAULT_REPLAY_PATH = "data/prompts/prompts-1713726880.json"
+MOCK_PORT = 8910
+#What the server counts as a token, a word or a symbol with the whitespace
+#before it
+TOKEN_PATTERN = re.compile(r"\s*(?:\w+|[^\w\s])|\s+")
+
+def split_tokens(text : str) -> list[str]:
+    """Splits text into the tokens the server generates it as"""
+    return TOKEN_PATTERN.findall(text)
+
+def load_replay(replay_path : str) -> dict[tuple[str, str], str]:
+    """
+    Returns the outputs of a task file by (model, prompt), with the output
+    for any model, or the task's pddl, under (None, prompt).
+    """
+    replay = {}
+    for task in iter_tasks(replay_path):
+        prompt = task["prompt"]
+        for result in task["results"]:
+            if not result["error"]:
+                replay.setdefault((result["model"], prompt), result["output"])
+                replay.setdefault((None, prompt), result["output"])
+        replay.setdefault((None, prompt), task.get("pddl", ""))
+    return replay
+
+class MockLLMServer:
+    """
+    The stand-in server, replaying the outputs in replay with a mean
+    latency in seconds and an error rate between 0 and 1.
+    """
+    def __init__(self, replay : dict[tuple[str, str], str],
+                 latency : float = 0.0, error_rate : float = 0.0,
+                 seed : int = 0, token_latency : float = 0.0,
+                 pad : bool = False):
+        self.replay = replay
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        self.token_latency = token_latency
+        self.pad = pad
+        self.num_requests = 0
+        #Tokens sent in responses, streamed or not
+        self.num_tokens = 0
+        self._attempts : dict[str, int] = {}
+        self._runner : web.AppRunner = None
+
+    def output(self, model : str, prompt : str) -> str:
+        """Returns the replayed output of a model for a prompt"""
+        return self.replay.get((model, prompt),
+                               self.replay.get((None, prompt), ""))
+
+    def tokens(self, model : str, prompt : str, max_tokens : int) -> list[str]:
+        """Returns the tokens of an output, padded to max_tokens with pad"""
+        tokens = split_tokens(self.output(model, prompt))
+        if self.pad and tokens:
+            tokens = (tokens * (max_tokens // len(tokens) + 1))[:max_tokens]
+        return tokens
+
+    async def _generate(self, outputs : list[list[str]]) -> list[str]:
+        """
+        Waits for the tokens of a batch of outputs to be generated, side by
+        side, and returns their texts.
+        """
+        self.num_tokens += sum(len(tokens) for tokens in outputs)
+        await asyncio.sleep(self.token_latency *
+                            max((len(tokens) for tokens in outputs), default=0))
+        return ["".join(tokens) for tokens in outputs]
+
+    async def _stream(self, request : web.Request, tokens : list[str],
+                      event : Any) -> web.StreamResponse:
+        """
+        Streams the tokens as server-sent events with the data event(token,
+        tokens so far), stopping if the client disconnects.
+        """
+        response = web.StreamResponse(
+            headers={"Content-Type" : "text/event-stream"})
+        await response.prepare(request)
+        try:
+            for i, token in enumerate(tokens):
+                await asyncio.sleep(self.token_latency)
+                self.num_tokens += 1
+                data = json.dumps(event(token, i + 1))
+                await response.write(f"data: {data}\n\n".encode("utf-8"))
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionError:
+            pass
+        return response
+
+    async def _delay_or_fail(self, prompts : list[str]) -> bool:
+        """
+        Waits for the slowest prompt of a request, returns if the request
+        fails, which it does if any of its prompts does.
+        """
+        self.num_requests += 1
+        delay, failed = 0.0, False
+        for prompt in prompts:
+            attempt = self._attempts.get(prompt, 0)
+            self._attempts[prompt] = attempt + 1
+            rng = random.Random(f"{self.seed}:{attempt}:{prompt}")
+            if self.latency > 0:
+                delay = max(delay, rng.expovariate(1 / self.latency))
+            failed = failed or rng.random() < self.error_rate
+        await asyncio.sleep(delay)
+        return failed
+
+    async def generate(self, request : web.Request) -> web.Response:
+        """The GenAI generate endpoint"""
+        body : dict[str, Any] = await request.json()
+        model, params = body["model_id"], body.get("parameters", {})
+        if await self._delay_or_fail(body["inputs"]):
+            return web.Response(status=503)
+        max_tokens = params.get("max_new_tokens", 0)
+        if params.get("stream"):
+            return await self._stream(
+                request, self.tokens(model, body["inputs"][0], max_tokens),
+                lambda token, count : {"results" : [{
+                    "generated_text" : token,
+                    "generated_token_count" : count}]})
+        texts = await self._generate([self.tokens(model, p, max_tokens)
+                                      for p in body["inputs"]])
+        return web.json_response({
+            "model_id" : model,
+            "results" : [{"generated_text" : text, "stop_reason" : "EOS_TOKEN"}
+                         for text in texts],
+        })
+
+    async def completions(self, request : web.Request) -> web.Response:
+        """The OpenAI completions endpoint"""
+        body : dict[str, Any] = await request.json()
+        model, max_tokens = body["model"], body.get("max_tokens", 0)
+        prompts = body["prompt"]
+        prompts = [prompts] if isinstance(prompts, str) else prompts
+        if await self._delay_or_fail(prompts):
+            return web.Response(status=503)
+        if body.get("stream"):
+            return await self._stream(
+                request, self.tokens(model, prompts[0], max_tokens),
+                lambda token, _ : {"choices" : [{"index" : 0,
+                                                 "text" : token}]})
+        texts = await self._generate([self.tokens(model, p, max_tokens)
+                                      for p in prompts])
+        return web.json_response({
+            "model" : model,
+            "choices" : [{"index" : i, "text" : text, "finish_reason" : "stop"}
+                         for i, text in enumerate(texts)],
+        })
+
+    def app(self) -> web.Application:
+        """Returns the aiohttp application serving both APIs"""
+        app = web.Application()
+        app.router.add_post("/v1/generate", self.generate)
+        app.router.add_post("/v1/completions", self.completions)
+        return app
+
+    async def start(self, host : str = "127.0.0.1", port : int = MOCK_PORT) \
+    -> str:
+        """Starts serving in the running event loop, returns the API URL"""
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self) -> None:
+        """Stops a server started with start"""
+        await self._runner.cleanup()
+
+def main() -> None:
+    """Serves the replayed outputs until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--replay", default=DEFAULT_REPLAY_PATH,
+                        help="task file to replay outputs from")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="mean seconds a request takes")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests answered with HTTP 503")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--token-latency", type=float, default=0.0,
+                        help="seconds generating a token takes")
+    parser.add_argument("--pad", action="store_true",
+                        help="pad outputs to max_new_tokens")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=MOCK_PORT)
+    args = parser.parse_args()
+    server = MockLLMServer(load_replay(args.replay), args.latency,
+                           args.error_rate, args.seed, args.token_latency,
+                           args.pad)
+    web.run_app(server.app(), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -7,63 +7,153 @@ This file creates PDDL ASTs for all domains and problems
 in the pddl-domains folder and reads and catches them as a
 .pkl file. It is far faster to load the pickled domain ASTs
 than to reparse the domains each time they are needed. 
+The cache is regenerated when any of its source files change,
+reparsing only the changed files.
+
+Nothing is loaded when this file is imported, the domain maps below are
+views of a registry that loads the cache on first use and each domain's
+ASTs when they are first accessed.
 """
 
 import os
+import re
+import time
 import pickle
+import tempfile
 from pathlib import Path
-from typing import Generator
+from typing import Any, Generator, Iterator
+from collections.abc import Mapping
+from importlib.metadata import version
+from concurrent.futures import ProcessPoolExecutor
 
 from pddl.parser.domain import DomainParser
 from pddl.parser.problem import ProblemParser
 from pddl.core import Domain, Problem
 
+from .equiv_store import content_key, file_digest
+
 PDDL_CACHE_PATH = "pddl_cache.pkl"
+#Directory of the per file entries the PDDL cache is assembled from
+PDDL_ENTRY_DIR = "pddl_cache.d"
+#Entries are named by a content_key and this suffix
+ENTRY_NAME = re.compile(r"[0-9a-f]{64}\.pkl")
+#Temporary files older than this many seconds were left by a crashed parse,
+#younger ones may be an entry another process is still writing
+STALE_TMP_AGE = 3600
+#Parsed objects are only reused when parsed by the same pddl version
+PDDL_VERSION = version("pddl")
 PROBLEM_DIR = "data/pddlData/pddl-problems"
 PRED_NL_DIR = "data/pddlData/predicate-descriptions"
 
-#List of domain names
-domainNames : list[str] = []
-#Map of domain names to domain objects
-domainObjMap : dict[str, Domain] = {}
-#Map of domain names to domain file paths
-domainPathMap : dict[str, str] = {}
-#Map of domain names to domain predicate NL descriptions
-domainPredMap : dict[str, str] = {}
-#Map of domain names to list of problem objects for that domain
-domainProblemMap : dict[str, list[Problem]] = {}
-#Map of domain names to list of problem file paths
-domainProblemPathMap : dict[str, list[str]] = {}
-
-
 def all_files(root : str) -> Generator[str, None, None]:
     """ Generator for the paths of all files in root and all its subdirs"""
     for base_path, _, file_names in os.walk(root):
         for file_name in file_names:
             yield os.path.join(base_path, file_name)
 
-def extract_domains_and_problems(file_contents : dict[str, str]) \
+#Parsers of this process, created on first use
+_parsers : dict[str, Any] = {}
+
+def _parse_file(job : tuple[str, str]) -> Any:
+    """
+    Parses the PDDL file of a (file path, entry path) job into a domain or
+    problem object and saves it as a pickled entry at the entry path.
+    """
+    file_path, entry_path = job
+    with open(file_path, "r", encoding="utf-8") as file:
+        file_content = file.read()
+    if "(define (domain" in file_content:
+        parser = _parsers.setdefault("domain", DomainParser())
+    elif "(define (problem" in file_content:
+        parser = _parsers.setdefault("problem", ProblemParser())
+    else:
+        raise RuntimeError(f"Could not identify {file_path} as valid pddl")
+    pddl_obj = parser(file_content)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path),
+                                    suffix=".tmp")
+    with os.fdopen(fd, "wb") as entry:
+        pickle.dump(pddl_obj, entry)
+    os.replace(tmp_path, entry_path)
+    return pddl_obj
+
+def file_entry_path(file_path : str, entry_dir : str = PDDL_ENTRY_DIR) -> str:
+    """
+    Returns the path of the entry holding the parsed object of the PDDL file
+    at file_path, named by a hash of its contents and the pddl version
+    """
+    key = content_key("pddl-entry", file_digest(file_path), PDDL_VERSION)
+    return os.path.join(entry_dir, key + ".pkl")
+
+def _is_stale(entry_name : str, entry_dir : str, used_entries : set[str]) \
+-> bool:
+    """
+    Whether a file in entry_dir is an entry of no file in use or a
+    temporary file left by a crash. Nothing else in entry_dir is touched.
+    """
+    if ENTRY_NAME.fullmatch(entry_name):
+        return entry_name not in used_entries
+    if entry_name.endswith(".tmp"):
+        entry_path = os.path.join(entry_dir, entry_name)
+        return time.time() - os.path.getmtime(entry_path) > STALE_TMP_AGE
+    return False
+
+def load_entry(entry_path : str) -> Any:
+    """Loads the parsed domain or problem object of an entry"""
+    with open(entry_path, "rb") as entry:
+        return pickle.load(entry)
+
+def extract_domains_and_problems(file_paths : list[str],
+                                 entry_dir : str = PDDL_ENTRY_DIR,
+                                 workers : int = None) \
 -> tuple[dict[str, tuple[str, Domain]], dict[str, tuple[str,Problem]]]:
     """
-    Given a map of file names to file contents this function will parse
-    the contents and return a tuple of two dictionaries, the first
+    Given a list of PDDL file paths this function will parse the files
+    and return a tuple of two dictionaries, the first
     containing domain names mapped to their file paths and domain objects,
     and the second containing problem names mapped to their file paths
     and problem objects.
+
+    Parsed objects are kept as entries in entry_dir named by a hash of the
+    file contents and the pddl library version, so only new or changed files
+    are parsed. Those are parsed in parallel over `workers` processes, one
+    per core by default. Entries of files not in file_paths are removed,
+    as are temporary files older than STALE_TMP_AGE.
     """
-    problem_parser = ProblemParser()
-    domain_parser = DomainParser()
+    os.makedirs(entry_dir, exist_ok=True)
+    pddl_objs : dict[str, Any] = {}
+    jobs : dict[str, tuple[str, str]] = {}
+    entry_paths = []
+    for file_path in file_paths:
+        entry_path = file_entry_path(file_path, entry_dir)
+        entry_paths.append(entry_path)
+        if os.path.exists(entry_path):
+            pddl_objs[file_path] = load_entry(entry_path)
+        else:
+            jobs[file_path] = (file_path, entry_path)
+    if workers is None:
+        workers = os.cpu_count()
+    if workers <= 1 or len(jobs) <= 1:
+        parsed = [_parse_file(job) for job in jobs.values()]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            parsed = list(pool.map(_parse_file, jobs.values()))
+    pddl_objs.update(zip(jobs.keys(), parsed))
+    used_entries = {os.path.basename(entry_path) for entry_path in entry_paths}
+    for entry_name in os.listdir(entry_dir):
+        #Another process may remove the same files first
+        try:
+            if _is_stale(entry_name, entry_dir, used_entries):
+                os.remove(os.path.join(entry_dir, entry_name))
+        except FileNotFoundError:
+            pass
     domains : dict[str, tuple[str, Domain]] = {}
     problems : dict[str, tuple[str,Problem]] = {}
-    for file_path, file_content in file_contents.items():
-        if "(define (domain" in file_content:
-            domain : Domain = domain_parser(file_content)
-            domains[domain.name] = (file_path, domain)
-        elif "(define (problem" in file_content:
-            problem : Problem = problem_parser(file_content)
-            problems[problem.name] = (file_path, problem)
+    for file_path in file_paths:
+        pddl_obj = pddl_objs[file_path]
+        if isinstance(pddl_obj, Domain):
+            domains[pddl_obj.name] = (file_path, pddl_obj)
         else:
-            raise f"Could not identify {file_path} as valid pddl"
+            problems[pddl_obj.name] = (file_path, pddl_obj)
     return domains, problems
 
 
@@ -77,30 +167,54 @@ def associate_problems_with_domains(domains, problems) \
     """
     domain_problems : dict[str, list[tuple[str, Problem]]] = {}
     for _, (p_path, p_obj) in problems.items():
-        for domain_name, _ in domains.items():
-            if p_obj.domain_name in domain_name:
-                domain_problems.setdefault(p_obj.domain_name, [])\
-                               .append((p_path, p_obj))
-            # else:
-            #     print(f"Could not find domain {p_obj.domain_name} for {p_path}")
-            #     raise RuntimeError()
+        #Problems of domains we do not have are skipped
+        if p_obj.domain_name in domains:
+            domain_problems.setdefault(p_obj.domain_name, [])\
+                           .append((p_path, p_obj))
     return domain_problems
 
-def generate_pddl_cache(filename : str = PDDL_CACHE_PATH) -> None:
+def source_manifest(previous : dict[str, Any] = None) -> dict[str, Any]:
+    """
+    Returns the manifest of the files the PDDL cache is generated from, the
+    pddl library version and a map of every file path to its (mtime, size,
+    content hash). Hashes in a previous manifest are reused for files whose
+    mtime and size did not change.
+    """
+    previous_files = previous["files"] if previous else {}
+    files = {}
+    for full_path in sorted([*all_files(PROBLEM_DIR), *all_files(PRED_NL_DIR)]):
+        stat = os.stat(full_path)
+        mtime_size = [stat.st_mtime_ns, stat.st_size]
+        old = previous_files.get(full_path)
+        if old is not None and old[:2] == mtime_size:
+            files[full_path] = old
+        else:
+            files[full_path] = mtime_size + [file_digest(full_path)]
+    return {"version" : PDDL_VERSION, "files" : files}
+
+def manifest_is_current(manifest : dict[str, Any]) -> bool:
+    """Returns if no source file changed since manifest was taken"""
+    def digests(m):
+        return m["version"], {path : f[2] for path, f in m["files"].items()}
+    return manifest is not None and \
+        digests(source_manifest(manifest)) == digests(manifest)
+
+def generate_pddl_cache(filename : str = PDDL_CACHE_PATH,
+                        entry_dir : str = PDDL_ENTRY_DIR,
+                        workers : int = None) -> None:
     """
     Given a filename, this function will parse all the PDDL files in 
-    the PROBLEM_DIR and PRED_NL_DIR directories and save the parsed
-    objects in a pickle file with the given filename.
+    the PROBLEM_DIR and PRED_NL_DIR directories and save an index of the
+    parsed objects' entries in a pickle file with the given filename, along
+    with the predicate NL descriptions and a manifest of the source files to
+    detect when the cache is stale.
     """
-    #Extract all the file contents
-    file_contents : dict[str, str] = {}
-    for full_path in all_files(PROBLEM_DIR):
-        with open(full_path, "r", encoding="utf-8") as file:
-            file_contents[full_path] = file.read()
+    manifest = source_manifest()
 
     #Map domain names to domain paths and objects &
     #problem names to problem paths and objects
-    domains, problems = extract_domains_and_problems(file_contents)
+    domains, problems = extract_domains_and_problems(
+        list(all_files(PROBLEM_DIR)), entry_dir, workers)
 
     #Associate each problem with its domain
     domain_problems = associate_problems_with_domains(domains, problems)
@@ -116,28 +230,157 @@ def generate_pddl_cache(filename : str = PDDL_CACHE_PATH) -> None:
             with open(d_pred_nl_path, "r", encoding="utf-8") as pred_nl_file:
                 domain_pred_nl[domain_name] = pred_nl_file.read()
         else:
-            raise f"{d_pred_nl_path} was not found but is required to exist"
-    with open(filename, "wb") as domain_cache:
-        pickle.dump((domains, domain_pred_nl, domain_problems), domain_cache)
+            raise RuntimeError(f"{d_pred_nl_path} was not found but is required to exist")
+    index = {
+        "domains" : {d_name : (d_path, file_entry_path(d_path, entry_dir))
+                     for d_name, (d_path, _) in domains.items()},
+        "problems" : {d_name : [(p_path, file_entry_path(p_path, entry_dir))
+                                for p_path, _ in p_list]
+                      for d_name, p_list in domain_problems.items()},
+        "predicates" : domain_pred_nl,
+        "manifest" : manifest,
+    }
+    #Written to a temp file and moved into place, since several workers may
+    #regenerate the cache at once
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp")
+    with os.fdopen(fd, "wb") as domain_cache:
+        pickle.dump(index, domain_cache)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, filename)
+
+def _index_is_current(index : Any) -> bool:
+    """
+    Returns if index is a cache index whose source files did not change and
+    whose entries all exist
+    """
+    #Caches from before the index format are never current
+    if not isinstance(index, dict) or not manifest_is_current(index["manifest"]):
+        return False
+    entry_paths = [e for _, e in index["domains"].values()] + \
+        [e for p_list in index["problems"].values() for _, e in p_list]
+    return all(os.path.exists(entry_path) for entry_path in entry_paths)
+
+def load_pddl_cache(filename : str = PDDL_CACHE_PATH) -> dict[str, Any]:
+    """
+    Loads the index of the PDDL cache, regenerating the cache first if it is
+    missing or its source files changed since it was generated.
+    """
+    index = None
+    if os.path.exists(filename):
+        with open(filename, "rb") as domain_data:
+            index = pickle.load(domain_data)
+    if not _index_is_current(index):
+        print(f"{filename} is missing or stale, generating now...")
+        generate_pddl_cache(filename)
+        print("Done, cache generated.")
+        with open(filename, "rb") as domain_data:
+            index = pickle.load(domain_data)
+    return index
+
+class CachedDomain:
+    """
+    A domain of the PDDL cache with its problems and predicate NL
+    description. The domain and problem ASTs are loaded from their cache
+    entries on first access.
+    """
+    def __init__(self, name : str, path : str, entry_path : str,
+                 problem_entries : list[tuple[str, str]], pred_nl : str):
+        self.name = name
+        self.path = path
+        self.pred_nl = pred_nl
+        self.problem_paths : tuple[str, ...] = \
+            tuple(p_path for p_path, _ in problem_entries)
+        self._entry_path = entry_path
+        self._problem_entry_paths = tuple(e for _, e in problem_entries)
+        self._domain : Domain = None
+        self._problems : tuple[Problem, ...] = None
+
+    @property
+    def domain(self) -> Domain:
+        """The domain AST"""
+        if self._domain is None:
+            self._domain = load_entry(self._entry_path)
+        return self._domain
+
+    @property
+    def problems(self) -> tuple[Problem, ...]:
+        """The problem ASTs, in the same order as problem_paths"""
+        if self._problems is None:
+            self._problems = tuple(load_entry(entry_path)
+                                   for entry_path in self._problem_entry_paths)
+        return self._problems
+
+class PDDLRegistry(Mapping):
+    """
+    A map of domain names to the CachedDomain of each domain in the PDDL
+    cache. Nothing is loaded until the registry is first used, then only the
+    cache index is, each domain's ASTs are loaded when they are accessed.
+    """
+    def __init__(self, cache_path : str = PDDL_CACHE_PATH):
+        self._cache_path = cache_path
+        self._domains : dict[str, CachedDomain] = None
+
+    def _load(self) -> dict[str, CachedDomain]:
+        """Loads the cache index on first use"""
+        if self._domains is None:
+            index = load_pddl_cache(self._cache_path)
+            self._domains = {
+                d_name : CachedDomain(d_name, d_path, entry_path,
+                                      index["problems"].get(d_name, []),
+                                      index["predicates"][d_name])
+                for d_name, (d_path, entry_path) in index["domains"].items()
+            }
+        return self._domains
+
+    def __getitem__(self, domain_name : str) -> CachedDomain:
+        return self._load()[domain_name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._load())
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+    def warm(self, domain_names : Any = None) -> None:
+        """
+        Loads the ASTs of domain_names, all domains by default, so that
+        process pool workers forked afterwards share them instead of each
+        loading their own.
+        """
+        for domain_name in self if domain_names is None else domain_names:
+            _ = self[domain_name].domain, self[domain_name].problems
+
+class _RegistryView(Mapping):
+    """A read only map of domain names to an attribute of their CachedDomain"""
+    def __init__(self, attr : str):
+        self._attr = attr
+
+    def __getitem__(self, domain_name : str) -> Any:
+        return getattr(registry[domain_name], self._attr)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(registry)
+
+    def __len__(self) -> int:
+        return len(registry)
+
+#The PDDL cache of this process
+registry = PDDLRegistry()
+
+#List of domain names
+domainNames = registry.keys()
+#Map of domain names to domain objects
+domainObjMap : Mapping[str, Domain] = _RegistryView("domain")
+#Map of domain names to domain file paths
+domainPathMap : Mapping[str, str] = _RegistryView("path")
+#Map of domain names to domain predicate NL descriptions
+domainPredMap : Mapping[str, str] = _RegistryView("pred_nl")
+#Map of domain names to list of problem objects for that domain
+domainProblemMap : Mapping[str, tuple[Problem, ...]] = _RegistryView("problems")
+#Map of domain names to list of problem file paths
+domainProblemPathMap : Mapping[str, tuple[str, ...]] = \
+    _RegistryView("problem_paths")
 
 if __name__ == "__main__":
     generate_pddl_cache()
-else:
-    if not os.path.exists(PDDL_CACHE_PATH):
-        print(f"Could not find {PDDL_CACHE_PATH}, generating now...")
-        generate_pddl_cache()
-        print("Done, cache generated.")
-    domainObjMap = {}
-    domainPathMap = {}
-    domainPredMap = {}
-    domainProblemMap = {}
-    domainProblemPathMap = {}
-    with open(PDDL_CACHE_PATH, "rb") as domain_data:
-        _domain_map, domainPredMap, _problem_map = pickle.load(domain_data)
-    for d_name, (d_path, d_obj) in _domain_map.items():
-        domainPathMap[d_name] = d_path
-        domainObjMap[d_name] = d_obj
-    for d_name, p_list in _problem_map.items():
-        #unzip list of tuples into problem objects and path lists
-        domainProblemPathMap[d_name], domainProblemMap[d_name] = zip(*p_list)
-    domainNames = domainObjMap.keys()
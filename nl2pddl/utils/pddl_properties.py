@@ -6,7 +6,9 @@ and various properties from PDDL objects.
 
 from pddl.core import Domain, Action, Formula
 from pddl.logic.predicates import Predicate
-from pddl.logic.base import Not
+from pddl.logic.base import Not, And
+from pddl.logic.effects import AndEffect
+from pddl.logic.terms import Variable
 
 def preds_pos_neg(p : Formula) -> tuple[set[Predicate], set[Predicate]]:
     """
@@ -28,6 +30,20 @@ def preds_pos_neg(p : Formula) -> tuple[set[Predicate], set[Predicate]]:
             aux(operand)
     return pos, neg
 
+def literal_conjunction(p : Formula) -> bool:
+    """
+    Returns if the formula p is a literal or a conjunction of literals,
+    the formulas that preds_pos_neg captures completely.
+    """
+    def is_literal(pn : Formula) -> bool:
+        """Returns if pn is a predicate or a negated predicate"""
+        return isinstance(pn, Predicate) or \
+            (isinstance(pn, Not) and isinstance(pn.argument, Predicate))
+    if is_literal(p):
+        return True
+    return isinstance(p, (And, AndEffect)) and \
+        all(is_literal(operand) for operand in p.operands)
+
 def preds(p : Formula) -> set[Predicate]:
     """
     given a effect or precondition formula p, return the set of all
@@ -113,3 +129,35 @@ def flipped(action : Action) -> set[Predicate]:
         if pre_ni in eff_p:
             flipped_set.add(pre_ni)
     return flipped_set
+
+def canonical_action_str(action : Action) -> str:
+    """
+    Given an action, return a canonical string for it that is the same
+    for all actions differing only in parameter names, literal order, or
+    whitespace. Parameters are renamed positionally to ?x0, ?x1, ... (as
+    param_map pairs parameters by position) and literals are sorted.
+    Returns None when the precondition or effect is not a conjunction of
+    literals, since those are not captured by preds_pos_neg.
+    """
+    if not literal_conjunction(action.precondition) or \
+       not literal_conjunction(action.effect):
+        return None
+    p_map = {param.name : f"?x{i}" for i, param in enumerate(action.parameters)}
+    def term_str(t) -> str:
+        """Renamed parameter, or the name of a constant or free variable"""
+        if isinstance(t, Variable):
+            return p_map.get(t.name, "?" + t.name)
+        return t.name
+    def literal_strs(p : Formula) -> str:
+        """Sorted S-Expressions of the literals in p"""
+        pos, neg = preds_pos_neg(p)
+        strs = ["(" + " ".join([pred.name] + [term_str(t) for t in pred.terms])
+                + ")" for pred in pos]
+        strs += ["(not (" + " ".join([pred.name] + [term_str(t) for t in pred.terms])
+                 + "))" for pred in neg]
+        return " ".join(sorted(strs))
+    params = " ".join(f"?x{i} - " + "|".join(sorted(param.type_tags))
+                      for i, param in enumerate(action.parameters))
+    return f"(:action {action.name.lower()} :parameters ({params})" + \
+           f" :precondition (and {literal_strs(action.precondition)})" + \
+           f" :effect (and {literal_strs(action.effect)}))"
@@ -4,21 +4,37 @@ the K* planner and VAL plan validator. It is important to note
 that as val is not a python package, it is expected to be at 
 VAL_PATH, which is set to where it is expected to be 
 built in a git submodule during setup.
+
+Asyncio counterparts of the planner and validator calls (suffixed _async)
+let a single process keep many K* and VAL runs in flight, bounded by
+MAX_PROCESSES, with per call timeouts.
 """
 
 #Standard Libs
 import os
 import sys
 import json
-import shutil
-import tempfile
+import signal
+import asyncio
+import weakref
+import contextlib
 import subprocess
 from typing import Any
 from subprocess import CalledProcessError
 
+#Internal Libs
+from .equiv_store import content_key, file_digest, lookup, store
+from .scratch import scratch_slot
+
 #The location of VAL relative to where this is being run from
 VAL_PATH = "VAL/build/bin/Validate"
 
+#How long K* may search for plans
+SEARCH_TIME_LIMIT = "30s"
+#Identifies the planner setup in equivalence store keys, so results
+#planned under a different setup are never reused
+PLANNER_CONFIG = f"kstar(lmcut()),search-time-limit={SEARCH_TIME_LIMIT}"
+
 def new_pipe(tmpdir : str, pipe_name : str, contents : str) -> str:
     """
     Creates a new pipe in the tempdir at tmpdir with filename,
@@ -29,50 +45,71 @@ def new_pipe(tmpdir : str, pipe_name : str, contents : str) -> str:
         pipe.write(contents)
     return pipe_path
 
-def plan_file(domain_path : str, problem_path : str, k : int = 100) \
--> tuple[dict[str, Any], str, str, str]:
+def _fresh_path(slot : str, file_name : str) -> str:
     """
-    Given a domain path and a problem invoke K* and produce k optimal plans as
-    a json plans object.
+    Returns the path of file_name in a scratch slot after removing what an
+    earlier call may have left there, for files a subprocess writes.
     """
-    tmpdir = tempfile.mkdtemp()
-    plan_pipe_path = os.path.join(tmpdir, 'plan.json')
-    args = [
+    path = os.path.join(slot, file_name)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+    return path
+
+def _planner_args(domain_path : str, problem_path : str, k : int,
+                  plan_json_path : str) -> list[str]:
+    """The K* command line that dumps k plans to plan_json_path"""
+    return [
         sys.executable,
         "-m", "kstar_planner.driver.main",
-        "--search-time-limit", "30s",
-        domain_path, problem_path,
+        "--search-time-limit", SEARCH_TIME_LIMIT,
+        os.path.abspath(domain_path), os.path.abspath(problem_path),
         "--search", f"kstar(lmcut(),k={k},"
-        + f"dump_plan_files=false,json_file_to_dump={plan_pipe_path})"
+        + f"dump_plan_files=false,json_file_to_dump={plan_json_path})"
     ]
+
+def _planner_errors(return_code : int, output : bytes) -> tuple[str, str, str]:
+    """Classifies a failed K* run by its exit code"""
+    #These error codes from KStar seem to line up with the error codes
+    #that FD uses, see: https://www.fast-downward.org/ExitCodes
+    if return_code == 12:
+        return "DifDomain", "NoPlan", output.decode()
+    if return_code == 23:
+        #We get this if the planner runs out of time while searching
+        #This is extraordinarily rare for the data we look at,
+        #we give search 30s and only 1 out of all 13000 the new domains
+        #we look at causes it.
+        return "DifDomain", "NoPlan", output.decode()
+    if return_code == 30:
+        #Translation error into SAS+, happens when the PDDL is not well formed
+        return "SemanticError", "BadPDDL", output.decode()
+    if return_code == 34:
+        #We get this if it tries to put a negated precondition in the STRIPS
+        return "SemanticError", "NegPrecond", output.decode()
+    print("Unexpected Error occurred " + output.decode())
+    return "PlanError", "", f"Error code {return_code}" + output.decode()
+
+def plan_file(domain_path : str, problem_path : str, k : int = 100) \
+-> tuple[dict[str, Any], str, str, str]:
+    """
+    Given a domain path and a problem invoke K* and produce k optimal plans as
+    a json plans object.
+
+    K* runs inside its own scratch slot since it writes intermediate files
+    (output.sas, sas_plan, found_plans) to its working directory, which would
+    race between concurrent planner calls.
+    """
     plan_obj = None
     errs = "", "", ""
-    try:
-        _ = subprocess.check_output(args, stderr=subprocess.DEVNULL)
-        with open(plan_pipe_path, 'r', encoding="utf-8") as json_plan_pipe:
-            plan_obj = json.load(json_plan_pipe)
-    except CalledProcessError as err:
-        #These error codes from KStar seem to line up with the error codes
-        #that FD uses, see: https://www.fast-downward.org/ExitCodes
-        return_code = err.returncode
-        if return_code == 12:
-            errs = "DifDomain", "NoPlan", err.output.decode()
-        elif return_code == 23:
-            #We get this if the planner runs out of time while searching
-            #This is extraordinarily rare for the data we look at,
-            #we give search 30s and only 1 out of all 13000 the new domains
-            #we look at causes it.
-            errs = "DifDomain", "NoPlan", err.output.decode()
-        elif return_code == 30:
-            #Translation error into SAS+, happens when the PDDL is not well formed
-            errs = "SemanticError", "BadPDDL", err.output.decode()
-        elif return_code == 34:
-            #We get this if it tries to put a negated precondition in the STRIPS
-            errs = "SemanticError", "NegPrecond", err.output.decode()
-        else:
-            print("Unexpected Error occurred " + err.output.decode())
-            errs = "PlanError", "", f"Error code {return_code}" + err.output.decode()
-    shutil.rmtree(tmpdir)
+    with scratch_slot() as slot:
+        plan_pipe_path = _fresh_path(slot, 'plan.json')
+        args = _planner_args(domain_path, problem_path, k, plan_pipe_path)
+        try:
+            _ = subprocess.check_output(args, stderr=subprocess.DEVNULL,
+                                        cwd=slot)
+            with open(plan_pipe_path, 'r', encoding="utf-8") as json_plan_pipe:
+                plan_obj = json.load(json_plan_pipe)
+        except CalledProcessError as err:
+            errs = _planner_errors(err.returncode, err.output)
     return plan_obj, *errs
 
 def plan_str(domain_str : str, problem_path : str, k : int = 100) \
@@ -81,12 +118,21 @@ def plan_str(domain_str : str, problem_path : str, k : int = 100) \
     Given a domain string and a problem path, invoke K* and produce a json
     plans object. This is useful since generated domains come to us as
     strings without their own files.
+
+    Results are looked up in and saved to the equivalence store, except for
+    unexpected planner errors.
     """
-    tmpdir = tempfile.mkdtemp()
-    domain_pipe_path = os.path.join(tmpdir, 'domain.pddl')
-    with open(domain_pipe_path, "w", encoding="utf-8") as domain_pipe:
-        domain_pipe.write(domain_str)
-    return plan_file(domain_pipe_path, problem_path, k)
+    key = content_key("plan", domain_str, problem_path,
+                      file_digest(problem_path), k, PLANNER_CONFIG)
+    stored = lookup("plans", key)
+    if stored is not None:
+        return tuple(stored)
+    with scratch_slot() as slot:
+        domain_pipe_path = new_pipe(slot, 'domain.pddl', domain_str)
+        result = plan_file(domain_pipe_path, problem_path, k)
+    if result[1] != "PlanError":
+        store("plans", key, result)
+    return result
 
 def plan_to_string(plan_obj : dict[str, Any]) -> str:
     """
@@ -105,18 +151,92 @@ def validate(domain_path : str, problem_path : str, plan : str) \
     a boolean indicating if the plan is valid and a string
     containing an error message if the plan is invalid.
     """
-    tmpdir = tempfile.mkdtemp()
-    new_plan_path = new_pipe(tmpdir, 'new_plan.pddl', plan)
-    try:
-        #Forward direction, try plan from the new domain in the original domain
-        args = [VAL_PATH, domain_path, problem_path, new_plan_path]
-        _ = subprocess.check_output(args, stderr=subprocess.DEVNULL)
-        shutil.rmtree(tmpdir)
-        return True, ""
-    except CalledProcessError as err:
-        shutil.rmtree(tmpdir)
-        return False, err.output.decode()
+    with scratch_slot() as slot:
+        new_plan_path = new_pipe(slot, 'new_plan.pddl', plan)
+        try:
+            #Forward direction, try plan from the new domain in the original domain
+            args = [VAL_PATH, domain_path, problem_path, new_plan_path]
+            _ = subprocess.check_output(args, stderr=subprocess.DEVNULL)
+            return True, ""
+        except CalledProcessError as err:
+            return False, err.output.decode()
+
+def _val_verdicts(output : str, plan_paths : list[str]) -> list[tuple[bool, str]]:
+    """
+    Splits the output of a VAL run over several plan files into the
+    (valid, output) verdict for each plan. VAL starts the report of each plan
+    with a "Checking plan: <path>" line, plans it never reports on (for
+    example because the domain did not parse) are invalid with the whole
+    output as error message.
+    """
+    reports : dict[str, str] = {}
+    for report in output.split("Checking plan: ")[1:]:
+        path, _, body = report.partition("\n")
+        reports[path.strip()] = body
+    verdicts = []
+    for plan_path in plan_paths:
+        report = reports.get(plan_path)
+        if report is None:
+            verdicts.append((False, output))
+        elif "Plan valid" in report:
+            verdicts.append((True, ""))
+        else:
+            verdicts.append((False, report))
+    return verdicts
 
+def validate_plans(domain_path : str, problem_path : str, plans : list[str]) \
+-> list[tuple[bool, str]]:
+    """
+    Validate several plans on a domain and problem with a single VAL
+    process, returns a (valid, error message) tuple for each plan like
+    validate does. Outcomes are cached in the equivalence store.
+    """
+    if len(plans) == 0:
+        return []
+    key = content_key("val-plans", file_digest(domain_path), problem_path,
+                      file_digest(problem_path), plans)
+    stored = lookup("validations", key)
+    if stored is not None:
+        return [tuple(result) for result in stored]
+    with scratch_slot() as slot:
+        plan_paths = [new_pipe(slot, f'plan-{i}.pddl', plan)
+                      for i, plan in enumerate(plans)]
+        args = [VAL_PATH, domain_path, problem_path, *plan_paths]
+        completed = subprocess.run(args, stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL, check=False)
+    if completed.returncode == 0:
+        results = [(True, "")] * len(plans)
+    else:
+        results = _val_verdicts(completed.stdout.decode(), plan_paths)
+    store("validations", key, results)
+    return results
+
+def can_apply_plans(
+    original_domain_path : str, new_domain : str,
+    problem_path : str,
+    original_plans : list[str], new_plans : list[str],
+) -> list[tuple[bool, str, str, str]]:
+    """
+    Batched can_apply_plan, checks every (original plan, new plan) pair
+    with one VAL process per direction instead of two per pair. Returns the
+    can_apply_plan result for each pair.
+    """
+    with scratch_slot() as slot:
+        new_domain_path = new_pipe(slot, 'new_domain.pddl', new_domain)
+        #Forward direction, try plans from the new domain in the original domain
+        forward = validate_plans(original_domain_path, problem_path, new_plans)
+        #Backward direction, try plans from the original domain in the new domain
+        backward = validate_plans(new_domain_path, problem_path, original_plans)
+    results = []
+    for (new_valid, new_err), (original_valid, original_err) in \
+    zip(forward, backward):
+        if not new_valid:
+            results.append((False, "DifDomain", "NewToOriginal", new_err))
+        elif not original_valid:
+            results.append((False, "DifDomain", "OriginalToNew", original_err))
+        else:
+            results.append((True, "EqDomain", "", ""))
+    return results
 
 def can_apply_plan(
     original_domain_path : str, new_domain : str,
@@ -126,27 +246,231 @@ def can_apply_plan(
     """
     Given an original domain (path) and a new domain (string) problem,
     check if the the plan from the original can be used in
-    the new domain and vice versa.
+    the new domain and vice versa. Outcomes are cached in the
+    equivalence store.
+    """
+    key = content_key("val", file_digest(original_domain_path), new_domain,
+                      problem_path, file_digest(problem_path),
+                      original_plan, new_plan)
+    stored = lookup("validations", key)
+    if stored is not None:
+        return tuple(stored)
+    result = _can_apply_plan(original_domain_path, new_domain, problem_path,
+                             original_plan, new_plan)
+    store("validations", key, result)
+    return result
+
+def _can_apply_plan(
+    original_domain_path : str, new_domain : str,
+    problem_path : str,
+    original_plan : str, new_plan : str,
+) -> tuple[bool, str, str, str]:
+    """can_apply_plan without consulting the equivalence store"""
+    with scratch_slot() as slot:
+        new_domain_path = new_pipe(slot, 'new_domain.pddl', new_domain)
+        new_plan_path = new_pipe(slot, 'new_plan.pddl', new_plan)
+        original_plan_path = new_pipe(slot, 'original_plan.pddl', original_plan)
+        try:
+            #Forward direction, try plan from the new domain in the original domain
+            args = [VAL_PATH, original_domain_path, problem_path, new_plan_path]
+            _ = subprocess.check_output(args, stderr=subprocess.DEVNULL)
+        except CalledProcessError as err:
+            return False, "DifDomain", "NewToOriginal", err.output.decode()
+        try:
+            #Backward direction, try plan from the original domain in the new domain
+            args = [VAL_PATH, new_domain_path, problem_path, original_plan_path]
+            _ = subprocess.check_output(args, stderr=subprocess.DEVNULL)
+        except CalledProcessError as err:
+            return False, "DifDomain", "OriginalToNew", err.output.decode()
+    return True, "EqDomain", "", ""
+
+# Asyncio Engine ===============================================================
+
+#How many K* and VAL processes the async functions run at once
+MAX_PROCESSES = os.cpu_count() or 1
+#Wall clock seconds a K* process may take, on top of its search time limit
+#it needs time to translate the task and dump plans
+PLAN_TIMEOUT = 120
+#Wall clock seconds a VAL process may take
+VAL_TIMEOUT = 60
+
+#One semaphore per event loop, as asyncio primitives are bound to the loop
+#they are first used in
+_semaphores : weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+def process_semaphore() -> asyncio.Semaphore:
     """
-    tmpdir = tempfile.mkdtemp()
-    new_domain_path = new_pipe(tmpdir, 'new_domain.pddl', new_domain)
-    new_plan_path = new_pipe(tmpdir, 'new_plan.pddl', new_plan)
-    original_plan_path = new_pipe(tmpdir, 'original_plan.pddl', original_plan)
+    Returns the semaphore limiting the running event loop to MAX_PROCESSES
+    concurrent planner and validator processes.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(MAX_PROCESSES)
+    return _semaphores[loop]
+
+def _kill_process_group(process : asyncio.subprocess.Process) -> None:
+    """Kills a process started in its own session and all its children"""
     try:
-        #Forward direction, try plan from the new domain in the original domain
-        args = [VAL_PATH, original_domain_path, problem_path, new_plan_path]
-        _ = subprocess.check_output(args, stderr=subprocess.DEVNULL)
-    except CalledProcessError as err:
-        shutil.rmtree(tmpdir)
-        return False, "DifDomain", "NewToOriginal", err.output.decode()
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+async def run_process(args : list[str], timeout : float, cwd : str = None) \
+-> tuple[int, bytes]:
+    """
+    Runs a command once a process slot is free and returns its exit code
+    and stdout. The command runs in its own process group, which is killed
+    if it is still running after timeout seconds, raising TimeoutError, or
+    if the calling task is cancelled. K* forks its translator and search
+    components, so killing only the driver would leave them running.
+    """
+    async with process_semaphore():
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL, cwd=cwd,
+            start_new_session=True)
+        try:
+            output, _ = await asyncio.wait_for(process.communicate(), timeout)
+        except BaseException:
+            #Timed out or cancelled
+            _kill_process_group(process)
+            await asyncio.shield(process.wait())
+            raise
+        return process.returncode, output
+
+async def plan_file_async(domain_path : str, problem_path : str,
+                          k : int = 100, timeout : float = PLAN_TIMEOUT) \
+-> tuple[dict[str, Any], str, str, str]:
+    """
+    The asyncio counterpart of plan_file. A K* run that exceeds timeout is
+    killed and reported as a PlanError, so it is never saved as a result.
+    """
+    with scratch_slot() as slot:
+        plan_pipe_path = _fresh_path(slot, 'plan.json')
+        args = _planner_args(domain_path, problem_path, k, plan_pipe_path)
+        try:
+            return_code, output = await run_process(args, timeout, cwd=slot)
+        except asyncio.TimeoutError:
+            return None, "PlanError", "Timeout", \
+                f"K* took more than {timeout}s on {problem_path}"
+        if return_code != 0:
+            return None, *_planner_errors(return_code, output)
+        with open(plan_pipe_path, 'r', encoding="utf-8") as json_plan_pipe:
+            return json.load(json_plan_pipe), "", "", ""
+
+async def plan_str_async(domain_str : str, problem_path : str, k : int = 100,
+                         timeout : float = PLAN_TIMEOUT) \
+-> tuple[dict[str, Any], str, str, str]:
+    """
+    The asyncio counterpart of plan_str, sharing its equivalence store
+    entries.
+    """
+    key = content_key("plan", domain_str, problem_path,
+                      file_digest(problem_path), k, PLANNER_CONFIG)
+    stored = lookup("plans", key)
+    if stored is not None:
+        return tuple(stored)
+    with scratch_slot() as slot:
+        domain_pipe_path = new_pipe(slot, 'domain.pddl', domain_str)
+        result = await plan_file_async(domain_pipe_path, problem_path, k,
+                                       timeout)
+    if result[1] != "PlanError":
+        store("plans", key, result)
+    return result
+
+async def _validate_async(domain_path : str, problem_path : str, plan : str,
+                          timeout : float) -> tuple[bool, str]:
+    """validate_async raising TimeoutError if VAL exceeds timeout"""
+    with scratch_slot() as slot:
+        new_plan_path = new_pipe(slot, 'new_plan.pddl', plan)
+        args = [VAL_PATH, domain_path, problem_path, new_plan_path]
+        return_code, output = await run_process(args, timeout)
+    return (True, "") if return_code == 0 else (False, output.decode())
+
+async def validate_async(domain_path : str, problem_path : str, plan : str,
+                         timeout : float = VAL_TIMEOUT) -> tuple[bool, str]:
+    """
+    The asyncio counterpart of validate, a VAL run that exceeds timeout
+    counts as an invalid plan.
+    """
     try:
-        #Backward direction, try plan from the original domain in the new domain
-        args = [VAL_PATH, new_domain_path, problem_path, original_plan_path]
-        _ = subprocess.check_output(args, stderr=subprocess.DEVNULL)
-    except CalledProcessError as err:
-        shutil.rmtree(tmpdir)
-        return False, "DifDomain", "OriginalToNew", err.output.decode()
-    shutil.rmtree(tmpdir)
-    if os.path.exists("found_plans"):
-        shutil.rmtree("found_plans")
-    return True, "EqDomain", "", ""
+        return await _validate_async(domain_path, problem_path, plan, timeout)
+    except asyncio.TimeoutError:
+        return False, f"VAL took more than {timeout}s"
+
+async def validate_plans_async(domain_path : str, problem_path : str,
+                               plans : list[str],
+                               timeout : float = VAL_TIMEOUT) \
+-> list[tuple[bool, str]]:
+    """
+    The asyncio counterpart of validate_plans, sharing its equivalence
+    store entries. A VAL run exceeding timeout raises TimeoutError rather
+    than reporting the plans invalid, so it is never saved as an outcome.
+    """
+    if len(plans) == 0:
+        return []
+    key = content_key("val-plans", file_digest(domain_path), problem_path,
+                      file_digest(problem_path), plans)
+    stored = lookup("validations", key)
+    if stored is not None:
+        return [tuple(result) for result in stored]
+    with scratch_slot() as slot:
+        plan_paths = [new_pipe(slot, f'plan-{i}.pddl', plan)
+                      for i, plan in enumerate(plans)]
+        args = [VAL_PATH, domain_path, problem_path, *plan_paths]
+        try:
+            return_code, output = await run_process(args, timeout)
+        except asyncio.TimeoutError as err:
+            raise asyncio.TimeoutError(
+                f"VAL took more than {timeout}s on {problem_path}") from err
+    if return_code == 0:
+        results = [(True, "")] * len(plans)
+    else:
+        results = _val_verdicts(output.decode(), plan_paths)
+    store("validations", key, results)
+    return results
+
+async def can_apply_plan_async(
+    original_domain_path : str, new_domain : str,
+    problem_path : str,
+    original_plan : str, new_plan : str,
+    timeout : float = VAL_TIMEOUT
+) -> tuple[bool, str, str, str]:
+    """
+    The asyncio counterpart of can_apply_plan, sharing its equivalence
+    store entries. Both directions are validated concurrently, a VAL run
+    exceeding timeout gives an unsaved PlanError.
+    """
+    key = content_key("val", file_digest(original_domain_path), new_domain,
+                      problem_path, file_digest(problem_path),
+                      original_plan, new_plan)
+    stored = lookup("validations", key)
+    if stored is not None:
+        return tuple(stored)
+    with scratch_slot() as slot:
+        new_domain_path = new_pipe(slot, 'new_domain.pddl', new_domain)
+        #Both runs finish before the slot is handed back, even if one fails
+        verdicts = await asyncio.gather(
+            #Forward direction, plan from the new domain in the original
+            _validate_async(original_domain_path, problem_path, new_plan,
+                            timeout),
+            #Backward direction, plan from the original domain in the new
+            _validate_async(new_domain_path, problem_path, original_plan,
+                            timeout),
+            return_exceptions=True)
+    for verdict in verdicts:
+        if isinstance(verdict, asyncio.TimeoutError):
+            #Not saved, a later run may finish in time
+            return False, "PlanError", "Timeout", \
+                f"VAL took more than {timeout}s"
+        if isinstance(verdict, BaseException):
+            raise verdict
+    (new_valid, new_err), (original_valid, original_err) = verdicts
+    if not new_valid:
+        result = False, "DifDomain", "NewToOriginal", new_err
+    elif not original_valid:
+        result = False, "DifDomain", "OriginalToNew", original_err
+    else:
+        result = True, "EqDomain", "", ""
+    store("validations", key, result)
+    return result
@@ -1,55 +1,367 @@
 """
 This file includes utilities for caching plans to prevent 
 the need to replan. If run standalone it will generate a plan
-cache file for every problem contained in the problem cache. 
+cache file for every problem contained in the problem cache,
+replanning only the problems whose files changed since the last run.
 
-Can import load_original_plan_map to extract the cache
+Can import load_original_plan_map to extract the cache, or plan_store for
+a map of the cache that is loaded once per process. The plan store holds
+the plans of each problem as a compact PlanSet and can be read from a
+memory mapped store file, where the arrays of a PlanSet are views of the
+file that are shared by all processes reading it.
 """
 
 #Standard Libs
+import os
+import json
+import mmap
 import pickle
-from typing import Any
+import struct
+import tempfile
+from typing import Any, Iterator
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ProcessPoolExecutor
+
+#External Libs
+import numpy as np
 
 #Internal Libs
 from .pddl_cache import domainProblemPathMap, domainPathMap
-from .plan_and_val import plan_file, validate, plan_to_string
+from .plan_and_val import plan_file, validate_plans, plan_to_string, \
+    PLANNER_CONFIG
+from .equiv_store import content_key, file_digest
 
 PLAN_CACHE_PATH = "plan_cache.pkl"
+#Directory of the per problem entries the plan cache is assembled from
+PLAN_ENTRY_DIR = "plan_cache.d"
+#Memory mapped version of the plan cache, see PlanStore
+PLAN_STORE_PATH = "plan_cache.store"
+#Bumped whenever the layout of store files changes
+PLAN_STORE_FORMAT = 2
+
+#Store files start with the byte length of their json header as a u64
+_HEADER_LEN = struct.Struct("<Q")
+#Alignment of arrays in store files
+_ALIGN = 8
 
 def load_original_plan_map() -> dict[str, list[dict[str, Any]]]:
     """
     Loads the plan cache, a map from domain names to lists of
-    json object plan outputs from kstar for each plan in that domain
+    json object plan outputs from kstar for each plan in that domain.
+    The cache is generated first if it does not exist.
     """
+    if not os.path.exists(PLAN_CACHE_PATH):
+        print("Generating Plan Cache")
+        generate_plan_cache()
     with open(PLAN_CACHE_PATH, "rb") as cache:
         plan_map = pickle.load(cache)
         return plan_map
 
-def generate_plan_cache(k : int = 100, cache_path : str = PLAN_CACHE_PATH):
+class PlanSet(Sequence):
+    """
+    The plans K* found for one problem in a compact form. Ground actions are
+    interned in a vocabulary, all plans are stored as vocabulary indices in
+    one tokens array with offsets[i]:offsets[i + 1] delimiting plan i, and
+    the VAL plan text of every plan is precomputed into one utf-8 blob
+    delimited the same way by text_offsets.
+
+    Indexing returns the json plan object K* would have output for the plan.
+    """
+    def __init__(self, vocab : bytes, tokens : np.ndarray, offsets : np.ndarray,
+                 costs : np.ndarray, text : np.ndarray, text_offsets : np.ndarray):
+        #The newline separated vocabulary, only split on first use
+        self._vocab_blob = vocab
+        self._vocab : list[str] = None
+        self.tokens = tokens
+        self.offsets = offsets
+        self.costs = costs
+        self.text = text
+        self.text_offsets = text_offsets
+        #The decoded VAL text of each plan, only split on first use
+        self._texts : list[str] = None
+
+    @classmethod
+    def from_json(cls, plans_obj : dict[str, Any]) -> "PlanSet":
+        """Builds a PlanSet from a json plans object output by K*"""
+        vocab_index : dict[str, int] = {}
+        tokens, offsets, costs, texts = [], [0], [], []
+        for plan in plans_obj["plans"]:
+            tokens.extend(vocab_index.setdefault(action, len(vocab_index))
+                          for action in plan["actions"])
+            offsets.append(len(tokens))
+            costs.append(plan["cost"])
+            texts.append(plan_to_string(plan).encode("utf-8"))
+        text_offsets = np.cumsum([0] + [len(text) for text in texts])
+        return cls("\n".join(vocab_index).encode("utf-8"),
+                   np.array(tokens, dtype=np.int32),
+                   np.array(offsets, dtype=np.int64),
+                   np.array(costs, dtype=np.int64),
+                   np.frombuffer(b"".join(texts), dtype=np.uint8),
+                   text_offsets.astype(np.int64))
+
+    @property
+    def vocab(self) -> list[str]:
+        """The ground actions the plans are made of"""
+        if self._vocab is None:
+            self._vocab = bytes(self._vocab_blob).decode("utf-8").split("\n")
+        return self._vocab
+
+    def actions(self, i : int) -> list[str]:
+        """Returns the ground actions of plan i"""
+        vocab = self.vocab
+        return [vocab[t] for t in
+                self.tokens[self.offsets[i] : self.offsets[i + 1]].tolist()]
+
+    def val_text(self, i : int) -> str:
+        """Returns plan i as VAL parsable text, as plan_to_string would"""
+        if self._texts is None:
+            blob = self.text.tobytes()
+            bounds = self.text_offsets.tolist()
+            self._texts = [blob[start : end].decode("utf-8")
+                           for start, end in zip(bounds, bounds[1:])]
+        return self._texts[i]
+
+    def __getitem__(self, i : int) -> dict[str, Any]:
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        i %= len(self)
+        return {"cost" : int(self.costs[i]), "actions" : self.actions(i)}
+
+    def __len__(self) -> int:
+        return len(self.costs)
+
+    def to_json(self) -> dict[str, Any]:
+        """Returns the json plans object this PlanSet was built from"""
+        return {"plans" : list(self)}
+
+def write_plan_store(plan_map : dict[str, list[dict[str, Any]]],
+                     store_path : str = PLAN_STORE_PATH) -> None:
+    """
+    Writes plan_map to a store file readable by PlanStore. The file is a json
+    header, mapping each domain name to the (offset, length) of the parts of
+    the PlanSet of each of its problems, followed by those parts. Arrays are
+    aligned so they can be viewed in place. The file is written to a temp
+    file and moved into place so readers never see a partial store.
+    """
+    parts : list[bytes] = []
+    offset = 0
+    domains = {}
+    for domain_name, problem_plans in plan_map.items():
+        domains[domain_name] = []
+        for plans_obj in problem_plans:
+            plan_set = PlanSet.from_json(plans_obj)
+            entry = {}
+            for name in ("vocab", "tokens", "offsets", "costs", "text",
+                         "text_offsets"):
+                value = plan_set._vocab_blob if name == "vocab" \
+                    else getattr(plan_set, name)
+                data = value if isinstance(value, bytes) else value.tobytes()
+                entry[name] = (offset, len(data))
+                padding = -len(data) % _ALIGN
+                parts.append(data + b"\0" * padding)
+                offset += len(data) + padding
+            domains[domain_name].append(entry)
+    header = json.dumps({"format" : PLAN_STORE_FORMAT,
+                         "domains" : domains}).encode("utf-8")
+    header += b" " * (-(_HEADER_LEN.size + len(header)) % _ALIGN)
+    store_dir = os.path.dirname(os.path.abspath(store_path))
+    fd, tmp_path = tempfile.mkstemp(dir=store_dir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as store_file:
+        store_file.write(_HEADER_LEN.pack(len(header)))
+        store_file.write(header)
+        for part in parts:
+            store_file.write(part)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, store_path)
+
+def _read_header(store_file : Any) -> dict[str, Any]:
+    """Reads the json header of an open store file"""
+    (header_len,) = _HEADER_LEN.unpack(store_file.read(_HEADER_LEN.size))
+    return json.loads(store_file.read(header_len))
+
+class PlanStore(Mapping):
+    """
+    A read only map of domain names to the PlanSet of each of their problems
+    backed by a memory mapped store file written by write_plan_store. Only
+    the header is read up front, the arrays of each PlanSet are views of
+    the mapped file made on first lookup of its domain.
+    """
+    def __init__(self, store_path : str = PLAN_STORE_PATH):
+        with open(store_path, "rb") as store_file:
+            header = _read_header(store_file)
+            self._data_start = store_file.tell()
+            self._mmap = mmap.mmap(store_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        self._domains : dict[str, list[dict[str, list[int]]]] = header["domains"]
+        self._plan_sets : dict[str, list[PlanSet]] = {}
+
+    def _view(self, part : list[int], dtype : Any) -> Any:
+        """Returns a zero copy view of a (offset, length) part of the file"""
+        offset, length = part
+        start = self._data_start + offset
+        if dtype is None:
+            return memoryview(self._mmap)[start : start + length]
+        return np.frombuffer(self._mmap, dtype=dtype,
+                             count=length // np.dtype(dtype).itemsize,
+                             offset=start)
+
+    def __getitem__(self, domain_name : str) -> list[PlanSet]:
+        plan_sets = self._plan_sets.get(domain_name)
+        if plan_sets is None:
+            plan_sets = [PlanSet(self._view(entry["vocab"], None),
+                                 self._view(entry["tokens"], np.int32),
+                                 self._view(entry["offsets"], np.int64),
+                                 self._view(entry["costs"], np.int64),
+                                 self._view(entry["text"], np.uint8),
+                                 self._view(entry["text_offsets"], np.int64))
+                         for entry in self._domains[domain_name]]
+            self._plan_sets[domain_name] = plan_sets
+        return plan_sets
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._domains)
+
+    def __len__(self) -> int:
+        return len(self._domains)
+
+def _store_is_current(store_path : str = PLAN_STORE_PATH) -> bool:
+    """
+    Returns if the store file and plan cache exist, the store file is in
+    the current format, and is not older than the plan cache.
+    """
+    if not os.path.exists(store_path) or \
+       not os.path.exists(PLAN_CACHE_PATH) or \
+       os.path.getmtime(store_path) < os.path.getmtime(PLAN_CACHE_PATH):
+        return False
+    with open(store_path, "rb") as store_file:
+        try:
+            return _read_header(store_file).get("format") == PLAN_STORE_FORMAT
+        except ValueError:
+            return False
+
+def convert_plan_cache(cache_path : str = PLAN_CACHE_PATH,
+                       store_path : str = PLAN_STORE_PATH) -> None:
+    """
+    Writes the store file for the plan cache pickle, both are generated if
+    the pickle does not exist
+    """
+    if not os.path.exists(cache_path):
+        print("Generating Plan Cache")
+        generate_plan_cache(cache_path=cache_path, store_path=store_path)
+        return
+    with open(cache_path, "rb") as cache:
+        write_plan_store(pickle.load(cache), store_path)
+
+#Map of (process id, mmap mode) to that process's loaded plan store
+_plan_stores : dict[tuple[int, bool], Mapping] = {}
+
+def plan_store(mmap_mode : bool = True) -> Mapping[str, list[PlanSet]]:
+    """
+    Returns the plan cache as a map from domain names to the PlanSet of
+    each of their problems, loaded only once per process.
+
+    If mmap_mode is set the cache is read through a PlanStore, which is
+    converted from the plan cache first if PLAN_STORE_PATH is missing, stale
+    or in an old format. Otherwise the whole plan cache is unpickled.
+    """
+    store_key = (os.getpid(), mmap_mode)
+    if store_key not in _plan_stores:
+        if not mmap_mode:
+            _plan_stores[store_key] = {
+                domain_name : [PlanSet.from_json(p) for p in problem_plans]
+                for domain_name, problem_plans in load_original_plan_map().items()
+            }
+        else:
+            if not _store_is_current():
+                convert_plan_cache()
+            _plan_stores[store_key] = PlanStore()
+    return _plan_stores[store_key]
+
+def _entry_path(entry_dir : str, domain_path : str, problem_path : str,
+                k : int) -> str:
+    """
+    Returns the path of the plan cache entry for planning the problem in
+    the domain, named by a hash of the file contents, k and the planner setup
+    so that an entry is only reused while none of them changed.
+    """
+    key = content_key("plan-entry", file_digest(domain_path),
+                      file_digest(problem_path), k, PLANNER_CONFIG)
+    return os.path.join(entry_dir, key + ".json")
+
+def _build_entry(job : tuple[str, str, str, int, str]) -> dict[str, Any]:
+    """
+    Plans and validates one (domain name, domain path, problem path, k,
+    entry path) job and writes the plans to its entry, returns the plans.
+    """
+    domain_name, domain_path, problem_path, k, entry_path = job
+    print(domain_name, problem_path.split("/")[-1])
+    plans, err_class, _, err_msg = plan_file(domain_path, problem_path, k)
+    if err_class != "":
+        print(f"Error: {err_class}, {err_msg}")
+        raise RuntimeError()
+    #Validate all plans with a single VAL call
+    plan_strs = [plan_to_string(plan) for plan in plans["plans"]]
+    for valid, err in validate_plans(domain_path, problem_path, plan_strs):
+        if not valid:
+            raise RuntimeError(f"plan produced by K* not valid: {err}")
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path),
+                                    suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as entry:
+        json.dump(plans, entry)
+    os.replace(tmp_path, entry_path)
+    return plans
+
+def generate_plan_cache(k : int = 100, cache_path : str = PLAN_CACHE_PATH,
+                        store_path : str = PLAN_STORE_PATH,
+                        entry_dir : str = PLAN_ENTRY_DIR,
+                        workers : int = None):
     """
     Given a k and a cache path, this function will generate the top k plans and
     cache them in a file at cache_path for all the problems in the pddl
-    problem cache. 
+    problem cache. The plans are also written as a store file at store_path
+    for plan_store.
+
+    The plans of each problem are kept as an entry in entry_dir, so only
+    problems whose domain or problem file changed, or that are new, are
+    planned again. Those are planned in parallel over `workers` processes,
+    one per core by default. Entries no longer used are removed.
     """
-    plan_map : dict[str, list[dict[str, Any]]]  = {}
+    os.makedirs(entry_dir, exist_ok=True)
+    #Map of (domain name, problem index) to the plans of that problem
+    found : dict[tuple[str, int], dict[str, Any]] = {}
+    jobs : dict[tuple[str, int], tuple[str, str, str, int, str]] = {}
+    entry_paths = set()
     for domain_name, problem_paths in domainProblemPathMap.items():
         domain_path = domainPathMap[domain_name]
-        plan_map[domain_name] = []
-        for problem_path in problem_paths:
-            print(domain_name, problem_path.split("/")[-1])
-            plans, err_class, _, err_msg = plan_file(domain_path, problem_path, k)
-            if err_class != "":
-                print(f"Error: {err_class}, {err_msg}")
-                raise RuntimeError()
-            #Validate all plans
-            for plan in plans["plans"]:
-                plan_str = plan_to_string(plan)
-                valid, err = validate(domain_path, problem_path, plan_str)
-                if not valid:
-                    raise f"plan produced by K* not valid: {err}"
-            plan_map[domain_name].append(plans)
+        for i, problem_path in enumerate(problem_paths):
+            entry_path = _entry_path(entry_dir, domain_path, problem_path, k)
+            entry_paths.add(entry_path)
+            if os.path.exists(entry_path):
+                with open(entry_path, "r", encoding="utf-8") as entry:
+                    found[domain_name, i] = json.load(entry)
+            else:
+                jobs[domain_name, i] = (domain_name, domain_path, problem_path,
+                                        k, entry_path)
+    print(f"Planning {len(jobs)} problems, reusing {len(found)}")
+    if workers is None:
+        workers = os.cpu_count()
+    if workers <= 1 or len(jobs) <= 1:
+        built = [_build_entry(job) for job in jobs.values()]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            built = list(pool.map(_build_entry, jobs.values()))
+    found.update(zip(jobs.keys(), built))
+    plan_map : dict[str, list[dict[str, Any]]]  = {
+        domain_name : [found[domain_name, i] for i in range(len(problem_paths))]
+        for domain_name, problem_paths in domainProblemPathMap.items()
+    }
     with open(cache_path, "wb") as cache:
         pickle.dump(plan_map, cache)
+    write_plan_store(plan_map, store_path)
+    for entry_name in os.listdir(entry_dir):
+        entry_path = os.path.join(entry_dir, entry_name)
+        if entry_path not in entry_paths:
+            os.remove(entry_path)
 
 #Generate the plan cache if run directly
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+"""
+This file contains the persistent cache of LLM responses that call_llm
+consults before sending prompts. Responses are kept in the "responses" table
+of the equivalence store, keyed by the namespace of the service that
+generated them (its kind and URL, see cache_namespace), the model name, the
+canonicalized generation parameters and a hash of the prompt, so outputs of
+a local stand-in or another provider serving the same model name are never
+mixed up with the real ones.
+
+Only deterministic generations are cached: greedy decoding, or sampling with
+a pinned seed. Other sampling runs always bypass the cache, since asking
+again is expected to give a different output.
+"""
+
+#Standard Libs
+import hashlib
+from typing import Any
+
+#Internal Libs
+from .equiv_store import content_key, lookup, store
+
+#Generation parameters only sampling depends on, dropped for greedy decoding
+SAMPLING_PARAMETERS = ("temperature", "top_k", "top_p", "typical_p",
+                       "random_seed", "seed")
+#Generation parameters that pin the seed of sampling
+SEED_PARAMETERS = ("random_seed", "seed")
+
+def is_greedy(generation_parameters : dict[str, Any]) -> bool:
+    """Returns if the parameters use greedy decoding, the GenAI default"""
+    return generation_parameters.get("decoding_method", "greedy") == "greedy"
+
+def cacheable(generation_parameters : dict[str, Any]) -> bool:
+    """Returns if generating with the parameters is deterministic"""
+    return is_greedy(generation_parameters) or \
+        any(generation_parameters.get(name) is not None
+            for name in SEED_PARAMETERS)
+
+def canonical_parameters(generation_parameters : dict[str, Any]) \
+-> dict[str, Any]:
+    """
+    Returns the parameters without what can not change the output, unset
+    parameters and sampling parameters under greedy decoding, and with stop
+    sequences in a fixed order.
+    """
+    greedy = is_greedy(generation_parameters)
+    params = {"decoding_method" : "greedy"} if greedy else {}
+    for name, value in generation_parameters.items():
+        if value is None or (greedy and name in SAMPLING_PARAMETERS):
+            continue
+        if name == "stop_sequences":
+            value = sorted(value)
+        params[name] = value
+    return params
+
+def cache_namespace(kind : str, url : str) -> str:
+    """Returns the namespace of responses from the kind of API at url"""
+    return f"{kind}:{(url or '').rstrip('/')}"
+
+def response_key(namespace : str, model_name : str,
+                 generation_parameters : dict[str, Any], prompt : str) -> str:
+    """Returns the cache key of a prompt's response"""
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return content_key("llm", namespace, model_name,
+                       canonical_parameters(generation_parameters),
+                       prompt_hash)
+
+def lookup_response(namespace : str, model_name : str,
+                    generation_parameters : dict[str, Any],
+                    prompt : str) -> str:
+    """
+    Returns the cached output of a model for a prompt, or None if there
+    is none or the parameters are not cacheable.
+    """
+    if not cacheable(generation_parameters):
+        return None
+    return lookup("responses", response_key(namespace, model_name,
+                                            generation_parameters, prompt))
+
+def store_response(namespace : str, model_name : str,
+                   generation_parameters : dict[str, Any],
+                   prompt : str, output : str) -> None:
+    """Caches the output of a model for a prompt if it is cacheable"""
+    if cacheable(generation_parameters):
+        store("responses", response_key(namespace, model_name,
+                                        generation_parameters, prompt), output)
@@ -0,0 +1,87 @@
+"""
+This file contains the scratch workspace that planner and validator calls
+write their domain, problem, plan and JSON files to. Every process gets its
+own scratch directory, on tmpfs (/dev/shm) when available, holding reusable
+slot directories. A call takes a slot for as long as it needs its files,
+writes them under fixed names, and hands the slot back for the next call,
+so the hot loop never creates or removes directories and nothing is ever
+written to the working directory.
+
+A process removes its scratch directory once when it exits, which includes
+process pool workers.
+"""
+
+#Standard Libs
+import os
+import shutil
+import tempfile
+from typing import Iterator
+from contextlib import contextmanager
+from multiprocessing import util
+
+#Directories on RAM backed file systems to keep scratch directories in,
+#the first writable one is used, otherwise the system temp directory
+SCRATCH_PARENTS = ("/dev/shm",)
+
+#The scratch directory of this process and its free slots, reset in
+#forked children by checking the pid they belong to
+_pid : int = None
+_root : str = None
+_free_slots : list[str] = []
+_num_slots : int = 0
+
+def _scratch_parent() -> str:
+    """Returns the directory new scratch directories are created in"""
+    for parent in SCRATCH_PARENTS:
+        if os.path.isdir(parent) and os.access(parent, os.W_OK | os.X_OK):
+            return parent
+    return tempfile.gettempdir()
+
+def scratch_root() -> str:
+    """
+    Returns the scratch directory of this process, creating it the first
+    time it is needed.
+    """
+    global _pid, _root, _free_slots, _num_slots  # pylint: disable=global-statement
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _root = tempfile.mkdtemp(prefix=f"nl2pddl-{_pid}-",
+                                 dir=_scratch_parent())
+        _free_slots = []
+        _num_slots = 0
+        #Finalizers run when the main process or a pool worker exits, and
+        #only in the process that registered them, never in forked children
+        util.Finalize(None, shutil.rmtree, args=(_root, True),
+                      exitpriority=0)
+    return _root
+
+@contextmanager
+def scratch_slot() -> Iterator[str]:
+    """
+    Yields a scratch directory that no other call in this process uses
+    until the context exits. Slots are reused, so files in them are
+    overwritten by later calls and must be written before being read.
+    """
+    global _num_slots  # pylint: disable=global-statement
+    root = scratch_root()
+    if _free_slots:
+        slot = _free_slots.pop()
+    else:
+        slot = os.path.join(root, f"slot-{_num_slots}")
+        _num_slots += 1
+        os.mkdir(slot)
+    try:
+        yield slot
+    finally:
+        #A slot handed out before a fork belongs to the parent
+        if _root == root:
+            _free_slots.append(slot)
+
+def in_scratch(path : str) -> bool:
+    """
+    Returns if path is inside the scratch directory of this process. Such
+    files are rewritten under the same names by every call using the slot.
+    """
+    if _root is None:
+        return False
+    return os.path.abspath(path).startswith(_root + os.sep)
@@ -0,0 +1,243 @@
+"""
+This file contains an in process plan validator for the STRIPS and typing
+subset of PDDL that our domains use. It simulates plans on sets of ground
+atoms using the pddl library Domain and Problem objects, which is orders of
+magnitude cheaper than writing plan files and forking VAL for every plan.
+
+Domains or problems outside the supported subset are reported by
+`supported`, callers are expected to fall back to VAL for those.
+"""
+
+#Standard Libs
+from typing import Any
+
+#External Libs
+from pddl.core import Domain, Problem, Formula
+from pddl.logic.base import And, Or, Not, Imply
+from pddl.logic.effects import AndEffect
+from pddl.logic.predicates import Predicate, EqualTo
+from pddl.logic.terms import Variable
+from pddl.parser.domain import DomainParser
+
+#A ground atom, the lowercase predicate name followed by its object names
+Atom = tuple[str, ...]
+
+_domain_parser : DomainParser = None
+
+def parse_domain(domain_str : str) -> Domain:
+    """
+    Parses a domain string, returns None if the domain can not be parsed
+    or uses PDDL outside of what this validator supports.
+    """
+    global _domain_parser  # pylint: disable=global-statement
+    if _domain_parser is None:
+        _domain_parser = DomainParser()
+    try:
+        domain = _domain_parser(domain_str)
+    except Exception:  # pylint: disable=broad-exception-caught
+        return None
+    return domain if supported(domain) else None
+
+def _supported_condition(p : Formula) -> bool:
+    """Returns if the condition p only uses supported connectives"""
+    if p is None or isinstance(p, (Predicate, EqualTo)):
+        return True
+    if isinstance(p, Not):
+        return _supported_condition(p.argument)
+    if isinstance(p, (And, Or, Imply)):
+        return all(_supported_condition(o) for o in p.operands)
+    return False
+
+def _supported_effect(p : Formula) -> bool:
+    """Returns if the effect p is a conjunction of literals"""
+    if p is None or isinstance(p, Predicate):
+        return True
+    if isinstance(p, Not):
+        return isinstance(p.argument, Predicate)
+    if isinstance(p, (And, AndEffect)):
+        return all(_supported_effect(o) for o in p.operands)
+    #The parser represents an empty effect () as an empty Or
+    return isinstance(p, Or) and len(p.operands) == 0
+
+def _atoms(p : Formula) -> list[Predicate]:
+    """Returns the atoms of a supported condition or effect"""
+    if p is None or isinstance(p, EqualTo):
+        return []
+    if isinstance(p, Predicate):
+        return [p]
+    if isinstance(p, Not):
+        return _atoms(p.argument)
+    return [atom for operand in p.operands for atom in _atoms(operand)]
+
+def _well_formed(domain : Domain) -> bool:
+    """
+    Returns if every atom of every action uses a declared predicate with
+    its number of arguments, which the K* translator rejects otherwise.
+    """
+    arities = {p.name.lower() : p.arity for p in domain.predicates}
+    return all(arities.get(atom.name.lower()) == atom.arity
+               for action in domain.actions
+               for part in (action.precondition, action.effect)
+               for atom in _atoms(part))
+
+def supported(domain : Domain, problem : Problem = None) -> bool:
+    """
+    Returns if the domain, and optionally a problem, only use the STRIPS,
+    typing, negative precondition, disjunctive precondition and equality
+    features this validator implements, with atoms that match the
+    predicates the domain declares.
+    """
+    if len(domain.derived_predicates) > 0:
+        return False
+    for action in domain.actions:
+        if not _supported_condition(action.precondition) or \
+           not _supported_effect(action.effect):
+            return False
+    if not _well_formed(domain):
+        return False
+    return problem is None or _supported_condition(problem.goal)
+
+def _object(t : Any, binding : dict[str, str]) -> str:
+    """Returns the object a term denotes, mapping variables with binding"""
+    return binding[t.name] if isinstance(t, Variable) else t.name.lower()
+
+def _ground(p : Predicate, binding : dict[str, str]) -> Atom:
+    """Grounds the predicate p, mapping its variables with binding"""
+    return (p.name.lower(),) + tuple(_object(t, binding) for t in p.terms)
+
+def _holds(p : Formula, binding : dict[str, str], state : set[Atom]) -> bool:
+    """Returns if the condition p holds in state under binding"""
+    if p is None:
+        return True
+    if isinstance(p, Predicate):
+        return _ground(p, binding) in state
+    if isinstance(p, EqualTo):
+        return _object(p.left, binding) == _object(p.right, binding)
+    if isinstance(p, Not):
+        return not _holds(p.argument, binding, state)
+    if isinstance(p, And):
+        return all(_holds(o, binding, state) for o in p.operands)
+    if isinstance(p, Or):
+        #The parser represents an empty precondition () as an empty Or
+        return len(p.operands) == 0 or \
+            any(_holds(o, binding, state) for o in p.operands)
+    if isinstance(p, Imply):
+        return not _holds(p.operands[0], binding, state) or \
+            _holds(p.operands[1], binding, state)
+    raise ValueError(f"Unsupported condition {p}")
+
+def _effects(p : Formula, binding : dict[str, str],
+             adds : set[Atom], dels : set[Atom]) -> None:
+    """Collects the ground add and delete effects of p into adds and dels"""
+    if p is None:
+        return
+    if isinstance(p, Predicate):
+        adds.add(_ground(p, binding))
+    elif isinstance(p, Not):
+        dels.add(_ground(p.argument, binding))
+    else:
+        for operand in p.operands:
+            _effects(operand, binding, adds, dels)
+
+class GroundTask:
+    """
+    The parts of a domain and problem needed to simulate plans, with all
+    names lowercased as VAL and K* treat PDDL as case insensitive.
+    """
+    def __init__(self, domain : Domain, problem : Problem):
+        self.actions = {a.name.lower() : a for a in domain.actions}
+        #Map of each type to its parent type
+        self.parents = {t.lower() : (p.lower() if p else "object")
+                        for t, p in domain.types.items()}
+        #Map of each object to its type
+        self.object_types = {}
+        for obj in list(domain.constants) + list(problem.objects):
+            type_tag = obj.type_tag.lower() if obj.type_tag else "object"
+            self.object_types[obj.name.lower()] = type_tag
+        self.init = frozenset(_ground(p, {}) for p in problem.init
+                              if isinstance(p, Predicate))
+        self.goal = problem.goal
+
+    def is_a(self, obj : str, type_tags : set[str]) -> bool:
+        """Returns if the object obj has one of type_tags or a subtype"""
+        if len(type_tags) == 0 or "object" in type_tags:
+            return True
+        type_tag = self.object_types[obj]
+        seen = set()
+        while type_tag not in seen:
+            if type_tag in type_tags:
+                return True
+            seen.add(type_tag)
+            type_tag = self.parents.get(type_tag, "object")
+        return False
+
+    def run(self, plan : list[str]) -> tuple[bool, str]:
+        """
+        Simulates plan, a list of ground actions as output by K*, from the
+        initial state and returns if it is a valid plan and why not.
+        """
+        state = set(self.init)
+        for step, action_str in enumerate(plan, 1):
+            action_name, *args = action_str.lower().strip("() ").split()
+            action = self.actions.get(action_name)
+            if action is None:
+                return False, f"Step {step}: unknown action {action_name}"
+            params = action.parameters
+            if len(params) != len(args):
+                return False, f"Step {step}: wrong number of arguments " + \
+                    f"for ({action_str})"
+            for param, arg in zip(params, args):
+                if arg not in self.object_types or \
+                   not self.is_a(arg, {t.lower() for t in param.type_tags}):
+                    return False, f"Step {step}: bad argument {arg} " + \
+                        f"for ({action_str})"
+            binding = {param.name : arg for param, arg in zip(params, args)}
+            if not _holds(action.precondition, binding, state):
+                return False, f"Step {step}: precondition of ({action_str})" + \
+                    " not satisfied"
+            adds, dels = set(), set()
+            _effects(action.effect, binding, adds, dels)
+            #Deletes are applied before adds
+            state.difference_update(dels)
+            state.update(adds)
+        if not _holds(self.goal, {}, state):
+            return False, "Goal not satisfied"
+        return True, ""
+
+def validate_plans(domain : Domain, problem : Problem,
+                   plans : list[list[str]]) -> list[tuple[bool, str]]:
+    """
+    Validates each plan, a list of ground action strings, on the domain and
+    problem. Returns a (valid, error message) tuple for each plan.
+    """
+    task = GroundTask(domain, problem)
+    return [task.run(plan) for plan in plans]
+
+def can_apply_plan(
+    original_task : GroundTask, new_task : GroundTask,
+    original_plan : dict[str, Any], new_plan : dict[str, Any]
+) -> tuple[bool, str, str, str]:
+    """
+    The in process counterpart of plan_and_val.can_apply_plan for K* plan
+    objects, given the problem grounded in the original and new domain.
+    Checks if the new plan works in the original domain and then if
+    the original plan works in the new domain.
+    """
+    valid, err_msg = original_task.run(new_plan["actions"])
+    if not valid:
+        return False, "DifDomain", "NewToOriginal", err_msg
+    valid, err_msg = new_task.run(original_plan["actions"])
+    if not valid:
+        return False, "DifDomain", "OriginalToNew", err_msg
+    return True, "EqDomain", "", ""
+
+def can_apply_plans(
+    original_task : GroundTask, new_task : GroundTask,
+    original_plans : list[dict[str, Any]], new_plans : list[dict[str, Any]]
+) -> list[tuple[bool, str, str, str]]:
+    """
+    can_apply_plan for each (original plan, new plan) pair, mirroring
+    plan_and_val.can_apply_plans.
+    """
+    return [can_apply_plan(original_task, new_task, original_plan, new_plan)
+            for original_plan, new_plan in zip(original_plans, new_plans)]
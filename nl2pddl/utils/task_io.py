@@ -0,0 +1,132 @@
+"""
+This file contains streaming readers and writers for the task files passed
+between pipeline stages. Task files are either a JSON array of tasks, as
+every stage has always written, or JSON lines (a `.jsonl` path) with one
+task per line.
+
+Both formats are read one task at a time and written as tasks arrive, so
+stages chained through generators only ever hold a bounded number of tasks
+in memory regardless of the size of the run.
+"""
+
+#Standard Libs
+import os
+import json
+import tempfile
+from typing import Any, Iterable, Iterator
+
+#The suffix of task files written as JSON lines
+JSONL_SUFFIX = ".jsonl"
+#How many characters the JSON array reader reads at a time
+READ_CHUNK_SIZE = 1 << 20
+
+_decoder = json.JSONDecoder()
+#Characters that may follow an element of a JSON array
+_DELIMITERS = frozenset(",] \t\r\n")
+
+def is_jsonl(path : str) -> bool:
+    """Returns if the task file at path is in the JSON lines format"""
+    return path.endswith(JSONL_SUFFIX)
+
+def _iter_json_array(file) -> Iterator[Any]:
+    """
+    Yields the elements of the JSON array in file one at a time, reading
+    READ_CHUNK_SIZE characters at a time so only the element being decoded
+    and one chunk are ever held in memory.
+    """
+    buffer = ""
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        #Skip whitespace and the commas between elements
+        while pos < len(buffer) and (buffer[pos].isspace() or
+                                     (started and buffer[pos] == ",")):
+            pos += 1
+        if pos < len(buffer):
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Task file is not a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                element, end = _decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                #Objects, arrays and strings end with a closing character,
+                #other values only once a delimiter follows, since a number
+                #like 1 may continue as 1e10 in the next chunk
+                if eof or buffer[end - 1] in "}]\"" or \
+                   (end < len(buffer) and buffer[end] in _DELIMITERS):
+                    yield element
+                    pos = end
+                    continue
+        elif eof:
+            if not started:
+                raise ValueError("Task file is not a JSON array")
+            raise ValueError("Task file ends before its JSON array does")
+        chunk = file.read(READ_CHUNK_SIZE)
+        eof = chunk == ""
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+def iter_tasks(path : str) -> Iterator[dict[str, Any]]:
+    """Yields the tasks in the task file at path one at a time"""
+    with open(path, "r", encoding="utf-8") as task_file:
+        if is_jsonl(path):
+            for line in task_file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from _iter_json_array(task_file)
+
+def write_tasks(tasks : Iterable[dict[str, Any]], path : str,
+                append : bool = False) -> int:
+    """
+    Writes tasks to the task file at path as they are produced, flushing
+    after each one, and returns how many were written. JSON arrays are
+    written exactly as json.dump(tasks, indent=2) would write them, to a
+    temp file that replaces path once the array is complete, so a crash
+    mid run leaves the previous file in place rather than a broken array.
+
+    If append is set, tasks are added to the end of an existing JSON lines
+    file instead of replacing it.
+    """
+    jsonl = is_jsonl(path)
+    if append and not jsonl:
+        raise ValueError("Only JSON lines task files can be appended to")
+    if jsonl:
+        with open(path, "a" if append else "w", encoding="utf-8") as outfile:
+            return _write_tasks(tasks, outfile, jsonl)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as outfile:
+            count = _write_tasks(tasks, outfile, jsonl)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return count
+
+def _write_tasks(tasks : Iterable[dict[str, Any]], outfile : Any,
+                 jsonl : bool) -> int:
+    """Writes tasks to an open file, returns how many were written"""
+    count = 0
+    for task in tasks:
+        if jsonl:
+            outfile.write(json.dumps(task) + "\n")
+        else:
+            text = json.dumps(task, indent=2).replace("\n", "\n  ")
+            outfile.write(("[\n  " if count == 0 else ",\n  ") + text)
+        outfile.flush()
+        count += 1
+    if not jsonl:
+        outfile.write("\n]" if count > 0 else "[]")
+    return count
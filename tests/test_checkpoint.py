@@ -0,0 +1,148 @@
+"""
+This file contains tests for the journal compute_metrics checkpoints to in
+checkpoint, and for resuming an interrupted metric run from it. Heuristic
+domain equivalence is replaced by a stand-in that counts its jobs, so no
+planner is needed.
+"""
+
+#Standard Libs
+import copy
+import json
+import importlib
+from typing import Any, Iterator
+
+#External Libs
+import pytest
+
+#Internal Libs
+from nl2pddl.utils import equiv_store
+from nl2pddl.utils.checkpoint import Journal, task_id
+from nl2pddl.parse_llm_outputs import parse_lmm_outputs
+
+compute_metrics = importlib.import_module("nl2pddl.compute_metrics")
+
+PROMPTS_PATH = "data/prompts/prompts-1713726880.json"
+NUM_TASKS = 6
+
+@pytest.fixture(scope="module")
+def parsed_tasks() -> list[dict[str, Any]]:
+    """Parsed outputs with a correct, an unparsable and a failed result"""
+    with open(PROMPTS_PATH, "r", encoding="utf-8") as prompts_file:
+        #One task of each action, as tasks of the same action share a job
+        tasks = list({(task["domain"], task["action"]) : task
+                      for task in json.load(prompts_file)}.values())
+        tasks = tasks[:NUM_TASKS]
+    for task in tasks:
+        task["results"] = [
+            {"model" : "m", "parameters" : {}, "output" : task["pddl"],
+             "error" : False, "errorMsg" : ""},
+            {"model" : "m", "parameters" : {}, "output" : "(:action",
+             "error" : False, "errorMsg" : ""},
+            {"model" : "m", "parameters" : {}, "output" : "",
+             "error" : True, "errorMsg" : "Gave up"}]
+    return parse_lmm_outputs(tasks)
+
+class EquivStandIn:
+    """
+    Stands in for iter_equiv_jobs, answering each job with EqDomain, or
+    a PlanError for the jobs of plan_errors. Raises KeyboardInterrupt
+    after crash_after jobs if it is set.
+    """
+    def __init__(self, crash_after : int = None,
+                 plan_errors : frozenset[str] = frozenset()):
+        self.crash_after = crash_after
+        self.plan_errors = plan_errors
+        self.jobs : list[tuple[str, str]] = []
+
+    def __call__(self, jobs, *_) -> Iterator[tuple[int, str, str, str]]:
+        for job in jobs:
+            if len(self.jobs) == self.crash_after:
+                raise KeyboardInterrupt
+            self.jobs.append(job)
+            if job[0] in self.plan_errors:
+                yield 0, "PlanError", "Timeout", "K* timed out"
+            else:
+                yield 1, "EqDomain", "", ""
+
+@pytest.fixture(autouse=True)
+def no_store():
+    equiv_store.set_store_path(None)
+
+def run(tasks : list[dict[str, Any]], journal_path : str, monkeypatch,
+        stand_in : EquivStandIn) -> list[dict[str, Any]]:
+    """Runs compute_metrics with stand_in checking domain equivalence"""
+    monkeypatch.setattr(compute_metrics, "iter_equiv_jobs", stand_in)
+    return compute_metrics.compute_metrics(tasks, dedupe=False,
+                                           journal_path=journal_path)
+
+def test_truncated_last_record(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    with Journal(path) as journal:
+        journal.record("a", 0, {"resultClass" : "EqDomain", "error" : False})
+        journal.record("a", 1, {"resultClass" : "DifDomain", "error" : True})
+    with open(path, "r", encoding="utf-8") as journal_file:
+        text = journal_file.read()
+    with open(path, "w", encoding="utf-8") as journal_file:
+        journal_file.write(text[:-10])
+
+    #The partial record is dropped and the next one starts a fresh line
+    with Journal(path) as journal:
+        assert len(journal) == 1
+        assert journal.get("a", 1) is None
+        journal.record("a", 1, {"resultClass" : "DifDomain", "error" : True})
+    with Journal(path) as journal:
+        assert journal.get("a", 0) == {"resultClass" : "EqDomain",
+                                       "error" : False}
+        assert journal.get("a", 1) == {"resultClass" : "DifDomain",
+                                       "error" : True}
+
+def test_plan_errors_are_not_journaled(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    with Journal(path) as journal:
+        journal.record("a", 0, {"resultClass" : "PlanError", "error" : True})
+        assert journal.get("a", 0) is None
+    with Journal(path) as journal:
+        assert len(journal) == 0
+
+def test_changed_task_gets_new_id(parsed_tasks):
+    task = parsed_tasks[0]
+    assert task_id(copy.deepcopy(task)) == task_id(task)
+    changed = copy.deepcopy(task)
+    changed["results"][0]["output"] += " "
+    assert task_id(changed) != task_id(task)
+    assert len({task_id(task) for task in parsed_tasks}) == len(parsed_tasks)
+
+def test_resume_merges_with_uninterrupted_run(parsed_tasks, tmp_path,
+                                              monkeypatch):
+    expected = run(parsed_tasks, None, monkeypatch, EquivStandIn())
+    num_jobs = sum(not result["error"] for task in parsed_tasks
+                   for result in task["results"])
+
+    path = str(tmp_path / "journal.jsonl")
+    with pytest.raises(KeyboardInterrupt):
+        run(parsed_tasks, path, monkeypatch, EquivStandIn(crash_after=2))
+    stand_in = EquivStandIn()
+    resumed = run(parsed_tasks, path, monkeypatch, stand_in)
+    #Only the jobs not finished before the crash are evaluated again
+    assert len(stand_in.jobs) == num_jobs - 2
+    assert json.dumps(resumed, sort_keys=True, default=str) == \
+        json.dumps(expected, sort_keys=True, default=str)
+
+    #A third run on the same input restores every result
+    stand_in = EquivStandIn()
+    assert json.dumps(run(parsed_tasks, path, monkeypatch, stand_in),
+                      sort_keys=True, default=str) == \
+        json.dumps(expected, sort_keys=True, default=str)
+    assert not stand_in.jobs
+
+def test_plan_errors_are_evaluated_again(parsed_tasks, tmp_path, monkeypatch):
+    path = str(tmp_path / "journal.jsonl")
+    domain_name = parsed_tasks[0]["domain"]
+    run(parsed_tasks, path, monkeypatch,
+        EquivStandIn(plan_errors=frozenset([domain_name])))
+    stand_in = EquivStandIn()
+    resumed = run(parsed_tasks, path, monkeypatch, stand_in)
+    assert stand_in.jobs and \
+        all(job[0] == domain_name for job in stand_in.jobs)
+    assert all(result["resultClass"] != "PlanError"
+               for task in resumed for result in task["results"])
@@ -0,0 +1,38 @@
+"""
+This file contains tests for the content keys of the equivalence store, in
+particular file digests of scratch files, which are rewritten in place.
+"""
+
+#Standard Libs
+import os
+
+#Internal Libs
+from nl2pddl.utils import equiv_store
+from nl2pddl.utils.scratch import scratch_slot, in_scratch
+
+def write(path : str, contents : str, mtime_ns : int) -> None:
+    """Writes contents to path and sets its modification time"""
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(contents)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+def test_rewritten_scratch_file_is_rehashed():
+    with scratch_slot() as slot:
+        path = os.path.join(slot, "new_domain.pddl")
+        assert in_scratch(path)
+        #Same path, size and mtime, which a memo on them can not tell apart
+        write(path, "(define (domain a))", 10**18)
+        first = equiv_store.file_digest(path)
+        write(path, "(define (domain b))", 10**18)
+        assert equiv_store.file_digest(path) != first
+
+def test_data_files_are_memoized(tmp_path):
+    path = str(tmp_path / "domain.pddl")
+    assert not in_scratch(path)
+    write(path, "(define (domain a))", 10**18)
+    first = equiv_store.file_digest(path)
+    write(path, "(define (domain b))", 2 * 10**18)
+    assert equiv_store.file_digest(path) != first
+    hits = equiv_store._file_digest.cache_info().hits
+    equiv_store.file_digest(path)
+    assert equiv_store._file_digest.cache_info().hits == hits + 1
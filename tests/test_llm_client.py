@@ -0,0 +1,197 @@
+"""
+This file contains offline tests for the asyncio LLM client in llm_client,
+run against the stand-in server in mock_llm_server: retries with backoff,
+rate limiting, and resuming interrupted runs from their outputs file.
+"""
+
+#Standard Libs
+import json
+import time
+import socket
+import asyncio
+
+#External Libs
+import pytest
+
+#Internal Libs
+from nl2pddl.utils import llm_client
+from nl2pddl.utils.llm_client import call_llm_async, RateLimiter
+from nl2pddl.utils.llm_backends import GenAIBackend
+from nl2pddl.utils.mock_llm_server import MockLLMServer
+
+PARAMS = {"decoding_method" : "greedy", "max_new_tokens" : 20}
+NUM_TASKS = 12
+
+def make_tasks(num_tasks : int = NUM_TASKS) -> list[dict]:
+    """Prompt only tasks, as in a prompts file"""
+    return [{"prompt" : f"prompt {i}", "results" : []}
+            for i in range(num_tasks)]
+
+def replay(tasks : list[dict]) -> dict[tuple[str, str], str]:
+    """A replay answering every prompt with an output naming it"""
+    return {(None, task["prompt"]) : f"(output of {task['prompt']})"
+            for task in tasks}
+
+def free_port() -> int:
+    """Returns a port nothing is listening on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(llm_client, "BACKOFF_BASE", 0.001)
+
+async def run_client(server : MockLLMServer, tasks : list[dict], **kwargs) \
+-> list[dict]:
+    """Runs call_llm_async on tasks against server"""
+    url = await server.start(port=free_port())
+    try:
+        backend = GenAIBackend("model", kwargs.pop("params", PARAMS), url, "x")
+        return await call_llm_async(tasks, backend,
+                                    limiter=RateLimiter(None, None),
+                                    use_cache=False, **kwargs)
+    finally:
+        await server.stop()
+
+def outputs_of(outputs : list[dict]) -> list[str]:
+    """The output of the last result of each task"""
+    return [task["results"][-1]["output"] for task in outputs]
+
+def test_retries_recover_from_errors():
+    tasks = make_tasks()
+    server = MockLLMServer(replay(tasks), error_rate=0.4)
+    outputs = asyncio.run(run_client(server, tasks, max_retries=20))
+    assert outputs_of(outputs) == [f"(output of {t['prompt']})" for t in tasks]
+    assert not any(task["results"][-1]["error"] for task in outputs)
+    assert [task["taskId"] for task in outputs] == list(range(len(tasks)))
+    #Some requests failed and were sent again
+    assert server.num_requests > len(tasks)
+
+def test_gives_up_after_max_retries():
+    tasks = make_tasks()
+    server = MockLLMServer(replay(tasks), error_rate=1.0)
+    outputs = asyncio.run(run_client(server, tasks, max_retries=2))
+    for task in outputs:
+        assert task["results"][-1]["error"]
+        assert task["results"][-1]["errorMsg"].startswith(
+            "Gave up after 3 attempts")
+    assert server.num_requests == 3 * len(tasks)
+
+def test_backoff_delay(monkeypatch):
+    monkeypatch.setattr(llm_client, "BACKOFF_BASE", 1.0)
+    monkeypatch.setattr(llm_client, "BACKOFF_MAX", 8.0)
+    for attempt in range(8):
+        delays = [llm_client.backoff_delay(attempt) for _ in range(50)]
+        assert all(0 <= d <= min(8.0, 2 ** attempt) for d in delays)
+    #A delay the server asked for is always respected
+    assert llm_client.backoff_delay(0, retry_after=5.0) == 5.0
+
+def test_rate_limiter_bounds_requests():
+    async def acquire_all(limiter : RateLimiter, num_requests : int) -> float:
+        start = time.perf_counter()
+        for _ in range(num_requests):
+            await limiter.acquire(0)
+        return time.perf_counter() - start
+    #A burst of 20 is allowed, the 10 after it take half a second
+    assert asyncio.run(acquire_all(RateLimiter(20, None), 30)) >= 0.4
+    assert asyncio.run(acquire_all(RateLimiter(None, None), 30)) < 0.1
+
+def test_resume_after_interrupt(tmp_path):
+    tasks = make_tasks()
+    outputs_path = str(tmp_path / "outputs.jsonl")
+    server = MockLLMServer(replay(tasks), latency=0.05)
+
+    async def interrupted() -> None:
+        #One request at a time, cancelled part way through the tasks
+        await asyncio.wait_for(run_client(server, tasks, concurrency=1,
+                                          outputs_path=outputs_path), 0.3)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(interrupted())
+    with open(outputs_path, "r", encoding="utf-8") as outputs_file:
+        num_finished = len(outputs_file.readlines())
+    assert 0 < num_finished < len(tasks)
+
+    server = MockLLMServer(replay(tasks))
+    outputs = asyncio.run(run_client(server, tasks, outputs_path=outputs_path))
+    assert server.num_requests == len(tasks) - num_finished
+    assert outputs_of(outputs) == [f"(output of {t['prompt']})" for t in tasks]
+
+def test_resume_retries_errors(tmp_path):
+    tasks = make_tasks()
+    outputs_path = str(tmp_path / "outputs.jsonl")
+    server = MockLLMServer(replay(tasks), error_rate=1.0)
+    asyncio.run(run_client(server, tasks, outputs_path=outputs_path,
+                           max_retries=0))
+    server = MockLLMServer(replay(tasks))
+    outputs = asyncio.run(run_client(server, tasks, outputs_path=outputs_path))
+    assert server.num_requests == len(tasks)
+    assert not any(task["results"][-1]["error"] for task in outputs)
+
+def test_resume_ignores_changed_prompts_and_parameters(tmp_path):
+    tasks = make_tasks()
+    outputs_path = str(tmp_path / "outputs.jsonl")
+    asyncio.run(run_client(MockLLMServer(replay(tasks)), tasks,
+                           outputs_path=outputs_path))
+    #Only the edited prompt is requested again
+    edited = make_tasks()
+    edited[3]["prompt"] = "an edited prompt"
+    server = MockLLMServer(replay(edited))
+    outputs = asyncio.run(run_client(server, edited,
+                                     outputs_path=outputs_path))
+    assert server.num_requests == 1
+    assert outputs[3]["results"][-1]["output"] == "(output of an edited prompt)"
+    #Other parameters reuse nothing
+    server = MockLLMServer(replay(tasks))
+    outputs = asyncio.run(run_client(server, tasks, outputs_path=outputs_path,
+                                     params={**PARAMS, "max_new_tokens" : 30}))
+    assert server.num_requests == len(tasks)
+    assert all(task["results"][-1]["parameters"]["max_new_tokens"] == 30
+               for task in outputs)
+
+async def run_fan_out(servers : list[MockLLMServer], tasks : list[dict],
+                      outputs_path : str) -> list[dict]:
+    """Runs fan_out_async on tasks with one model per server"""
+    urls = [await server.start(port=free_port()) for server in servers]
+    try:
+        backends = [GenAIBackend(f"model-{i}", PARAMS, url, "x")
+                    for i, url in enumerate(urls)]
+        return await llm_client.fan_out_async(
+            tasks, backends, outputs_path,
+            limiters=[RateLimiter(None, None) for _ in backends],
+            use_cache=False)
+    finally:
+        for server in servers:
+            await server.stop()
+
+def test_fan_out_appends_in_place_and_resumes(tmp_path):
+    tasks = make_tasks()
+    outputs_path = str(tmp_path / "fan-out.jsonl")
+    servers = [MockLLMServer(replay(tasks)) for _ in range(2)]
+    outputs = asyncio.run(run_fan_out(servers, tasks, outputs_path))
+    #Results are appended to the given tasks, in the order of backends
+    assert outputs is tasks
+    for task in tasks:
+        assert [r["model"] for r in task["results"]] == ["model-0", "model-1"]
+        assert all(r["output"] == f"(output of {task['prompt']})"
+                   for r in task["results"])
+
+    #A crash mid write leaves the first records and a partial line
+    with open(outputs_path, "r", encoding="utf-8") as outputs_file:
+        lines = outputs_file.readlines()
+    assert len(lines) == 2 * len(tasks)
+    assert all("promptHash" in json.loads(line) for line in lines)
+    with open(outputs_path, "w", encoding="utf-8") as outputs_file:
+        outputs_file.writelines(lines[:5])
+        outputs_file.write(lines[5][:10])
+
+    tasks = make_tasks()
+    tasks[0]["prompt"] = "an edited prompt"
+    servers = [MockLLMServer(replay(tasks)) for _ in range(2)]
+    outputs = asyncio.run(run_fan_out(servers, tasks, outputs_path))
+    resumed = sum(json.loads(line)["taskId"] != 0 for line in lines[:5])
+    assert sum(server.num_requests for server in servers) == \
+        2 * len(tasks) - resumed
+    for task in outputs:
+        assert [r["output"] for r in task["results"]] == \
+            [f"(output of {task['prompt']})"] * 2
@@ -0,0 +1,50 @@
+"""
+This file contains tests for the lazily imported API of the nl2pddl module,
+each run in a fresh interpreter so nothing is already imported.
+"""
+
+#Standard Libs
+import os
+import sys
+import subprocess
+
+#Heavy dependencies importing nl2pddl must not load
+HEAVY_MODULES = ("pandas", "lark", "numpy", "tqdm", "matplotlib", "genai")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run(code : str) -> None:
+    """Runs code in a fresh interpreter from the repository root"""
+    subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, check=True)
+
+def test_import_loads_no_heavy_modules():
+    run(f"""
+import sys
+import nl2pddl
+loaded = [name for name in {HEAVY_MODULES!r} if name in sys.modules]
+assert not loaded, loaded
+""")
+
+def test_submodule_import_does_not_shadow_function():
+    run("""
+import types
+import nl2pddl
+import nl2pddl.compute_metrics
+import nl2pddl.generate_prompts
+assert isinstance(nl2pddl.compute_metrics, types.FunctionType)
+assert isinstance(nl2pddl.generate_prompts, types.FunctionType)
+from nl2pddl.utils import equiv_store
+equiv_store.set_store_path(None)
+assert nl2pddl.compute_metrics([]) == []
+""")
+
+def test_function_survives_later_submodule_import():
+    run("""
+import sys, types
+import nl2pddl
+compute_metrics = nl2pddl.compute_metrics
+from nl2pddl.compute_metrics import heuristic_equiv
+assert nl2pddl.compute_metrics is compute_metrics
+assert isinstance(nl2pddl.compute_metrics, types.FunctionType)
+assert isinstance(sys.modules["nl2pddl.compute_metrics"], types.ModuleType)
+""")
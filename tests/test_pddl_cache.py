@@ -0,0 +1,96 @@
+"""
+This file contains tests for the PDDL cache in pddl_cache: the per file
+entries it is assembled from, the cleanup of stale entries, and the registry
+that loads the ASTs of one domain at a time.
+"""
+
+#Standard Libs
+import os
+import time
+import shutil
+
+#External Libs
+import pytest
+from pddl.formatter import domain_to_string, problem_to_string
+
+#Internal Libs
+from nl2pddl.utils import pddl_cache
+
+DOMAIN_PATH = "data/pddlData/pddl-problems/blocks.pddl"
+
+def test_cleanup_only_removes_stale_entries(tmp_path):
+    entry_dir = str(tmp_path / "entries")
+    domain_path = str(tmp_path / "domain.pddl")
+    shutil.copy(DOMAIN_PATH, domain_path)
+    pddl_cache.extract_domains_and_problems([domain_path], entry_dir, 1)
+    entry_name = os.path.basename(pddl_cache.file_entry_path(domain_path,
+                                                             entry_dir))
+
+    stale_entry = "0" * 64 + ".pkl"
+    writing_tmp = "abc.tmp"
+    crashed_tmp = "def.tmp"
+    other_file = "notes.txt"
+    for name in (stale_entry, writing_tmp, crashed_tmp, other_file):
+        with open(os.path.join(entry_dir, name), "w", encoding="utf-8"):
+            pass
+    old = time.time() - pddl_cache.STALE_TMP_AGE - 60
+    os.utime(os.path.join(entry_dir, crashed_tmp), (old, old))
+
+    domains, _ = pddl_cache.extract_domains_and_problems([domain_path],
+                                                         entry_dir, 1)
+    assert [path for path, _ in domains.values()] == [domain_path]
+    assert sorted(os.listdir(entry_dir)) == \
+        sorted([entry_name, writing_tmp, other_file])
+
+@pytest.fixture(scope="module")
+def eager_maps(tmp_path_factory) -> tuple[dict, dict]:
+    """
+    The domains and problems of each domain parsed eagerly from the sources,
+    as the domain maps held them before the registry
+    """
+    entry_dir = str(tmp_path_factory.mktemp("entries"))
+    domains, problems = pddl_cache.extract_domains_and_problems(
+        list(pddl_cache.all_files(pddl_cache.PROBLEM_DIR)), entry_dir, 1)
+    return domains, pddl_cache.associate_problems_with_domains(domains,
+                                                               problems)
+
+@pytest.fixture
+def registry(monkeypatch) -> pddl_cache.PDDLRegistry:
+    """A fresh registry the domain maps are views of"""
+    fresh = pddl_cache.PDDLRegistry()
+    monkeypatch.setattr(pddl_cache, "registry", fresh)
+    return fresh
+
+def loaded(registry : pddl_cache.PDDLRegistry) -> set[str]:
+    """The domains whose domain or problem ASTs are loaded"""
+    return {name for name, cached in registry._domains.items()
+            if cached._domain is not None or cached._problems is not None}
+
+def test_registry_loads_one_domain_at_a_time(registry):
+    assert registry._domains is None
+    domain_names = list(pddl_cache.domainPathMap)
+    assert len(domain_names) > 1 and not loaded(registry)
+
+    first, second = domain_names[:2]
+    _ = pddl_cache.domainObjMap[first]
+    assert loaded(registry) == {first}
+    _ = pddl_cache.domainProblemMap[second]
+    assert loaded(registry) == {first, second}
+    assert registry[second]._domain is None
+    #Loaded ASTs are kept
+    assert pddl_cache.domainObjMap[first] is registry[first].domain
+
+def test_registry_views_match_eager_maps(registry, eager_maps):
+    domains, domain_problems = eager_maps
+    assert sorted(pddl_cache.domainNames) == sorted(domains)
+    for name, (path, domain) in domains.items():
+        assert pddl_cache.domainPathMap[name] == path
+        assert domain_to_string(pddl_cache.domainObjMap[name]) == \
+            domain_to_string(domain)
+        problems = domain_problems.get(name, [])
+        assert pddl_cache.domainProblemPathMap[name] == \
+            tuple(p_path for p_path, _ in problems)
+        assert [problem_to_string(p) for p in
+                pddl_cache.domainProblemMap[name]] == \
+            [problem_to_string(p) for _, p in problems]
+        assert pddl_cache.domainPredMap[name]
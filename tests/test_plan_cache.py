@@ -0,0 +1,109 @@
+"""
+This file contains tests for the plan cache in plan_cache: the compact
+PlanSet form of K* plans, and the memory mapped store file plan_store reads
+them from, which is rebuilt whenever the plan cache pickle changes.
+"""
+
+#Standard Libs
+import os
+import pickle
+
+#External Libs
+import pytest
+
+#Internal Libs
+from nl2pddl.utils import plan_cache
+from nl2pddl.utils.plan_cache import PlanSet, PlanStore, write_plan_store
+
+def plans_obj(*plans : list[str]) -> dict:
+    """A json plans object as output by K*, costing each plan its length"""
+    return {"plans" : [{"cost" : len(actions), "actions" : list(actions)}
+                       for actions in plans]}
+
+PLAN_MAP = {
+    "blocks" : [plans_obj(["pick-up a", "stack a b"], ["pick-up a"]),
+                plans_obj(["unstack b a", "put-down b", "pick-up a"])],
+    "gripper" : [plans_obj(["move rooma roomb"], [], ["move rooma roomb"])],
+    #Domains without plans and problems without plans are kept
+    "hiking" : [plans_obj()],
+    "depot" : [],
+}
+
+def write_plan_cache(path : str, plan_map : dict) -> None:
+    """Writes plan_map as the plan cache pickle"""
+    with open(path, "wb") as cache:
+        pickle.dump(plan_map, cache)
+
+@pytest.fixture
+def in_tmp_path(tmp_path, monkeypatch):
+    """Runs in tmp_path, where plan_store finds no cache of this process"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(plan_cache, "_plan_stores", {})
+    return tmp_path
+
+def test_store_round_trip(tmp_path):
+    store_path = str(tmp_path / "plans.store")
+    write_plan_store(PLAN_MAP, store_path)
+    store = PlanStore(store_path)
+    assert list(store) == list(PLAN_MAP)
+    for domain_name, problem_plans in PLAN_MAP.items():
+        assert [plan_set.to_json() for plan_set in store[domain_name]] == \
+            problem_plans
+        for plan_set, plans in zip(store[domain_name], problem_plans):
+            assert [plan_set.val_text(i) for i in range(len(plan_set))] == \
+                ["".join(f"({a})\n" for a in p["actions"])
+                 for p in plans["plans"]]
+    #Lookups return the same views
+    assert store["blocks"] is store["blocks"]
+
+def test_store_is_rebuilt_when_the_pickle_changes(in_tmp_path):
+    write_plan_cache(plan_cache.PLAN_CACHE_PATH, PLAN_MAP)
+    assert not plan_cache._store_is_current()
+    store = plan_cache.plan_store()
+    assert plan_cache._store_is_current()
+    assert store["blocks"][1].to_json() == PLAN_MAP["blocks"][1]
+    #Only loaded once per process
+    assert plan_cache.plan_store() is store
+
+    changed = {**PLAN_MAP, "blocks" : [plans_obj(["pick-up c"])] * 2}
+    write_plan_cache(plan_cache.PLAN_CACHE_PATH, changed)
+    #The store is now older than the pickle
+    mtime = os.path.getmtime(plan_cache.PLAN_CACHE_PATH) - 10
+    os.utime(plan_cache.PLAN_STORE_PATH, (mtime, mtime))
+    assert not plan_cache._store_is_current()
+    plan_cache._plan_stores.clear()
+    store = plan_cache.plan_store()
+    assert plan_cache._store_is_current()
+    assert store["blocks"][1].to_json() == changed["blocks"][1]
+
+def test_store_in_an_old_format_is_rebuilt(in_tmp_path, monkeypatch):
+    write_plan_cache(plan_cache.PLAN_CACHE_PATH, PLAN_MAP)
+    with monkeypatch.context() as patch:
+        patch.setattr(plan_cache, "PLAN_STORE_FORMAT",
+                      plan_cache.PLAN_STORE_FORMAT - 1)
+        plan_cache.convert_plan_cache()
+    assert not plan_cache._store_is_current()
+    assert plan_cache.plan_store()["gripper"][0].to_json() == \
+        PLAN_MAP["gripper"][0]
+    assert plan_cache._store_is_current()
+
+@pytest.mark.parametrize("domain_name", list(PLAN_MAP))
+def test_plan_set_round_trip(domain_name):
+    for plans in PLAN_MAP[domain_name]:
+        plan_set = PlanSet.from_json(plans)
+        assert plan_set.to_json() == plans
+        assert len(plan_set) == len(plans["plans"])
+        assert list(plan_set) == plans["plans"]
+        if plans["plans"]:
+            assert plan_set[-1] == plans["plans"][-1]
+        with pytest.raises(IndexError):
+            _ = plan_set[len(plan_set)]
+
+def test_plan_set_interns_actions():
+    plan_set = PlanSet.from_json(PLAN_MAP["blocks"][0])
+    assert plan_set.vocab == ["pick-up a", "stack a b"]
+    assert plan_set.tokens.tolist() == [0, 1, 0]
+    assert plan_set.offsets.tolist() == [0, 2, 3]
+    assert plan_set.val_text(1) == "(pick-up a)\n"
+    #Costs survive as ints, as K* outputs them
+    assert all(isinstance(plan["cost"], int) for plan in plan_set)
@@ -0,0 +1,180 @@
+"""
+This file contains tests for the in process plan validator strips_val,
+mainly the plans it has to reject, since accepting an invalid plan would
+make heuristic_equiv report different domains as equivalent.
+"""
+
+#External Libs
+import pytest
+from pddl.parser.problem import ProblemParser
+
+#Internal Libs
+from nl2pddl.utils import strips_val
+
+DOMAIN = """
+(define (domain rooms)
+  (:requirements :strips :typing :negative-preconditions :equality)
+  (:types ball room gripper - object)
+  (:predicates (at-robby ?r - room) (at ?b - ball ?r - room)
+               (free ?g - gripper) (carry ?b - ball ?g - gripper))
+  (:action move
+    :parameters (?from - room ?to - room)
+    :precondition (and (at-robby ?from) (not (= ?from ?to)))
+    :effect (and (at-robby ?to) (not (at-robby ?from))))
+  (:action pick
+    :parameters (?b - ball ?r - room ?g - gripper)
+    :precondition (and (at ?b ?r) (at-robby ?r) (free ?g))
+    :effect (and (carry ?b ?g) (not (at ?b ?r)) (not (free ?g))))
+  (:action drop
+    :parameters (?b - ball ?r - room ?g - gripper)
+    :precondition (and (carry ?b ?g) (at-robby ?r))
+    :effect (and (at ?b ?r) (free ?g) (not (carry ?b ?g))))
+  (:action stay
+    :parameters (?r - room)
+    :precondition (and (at-robby ?r) (not (at-robby ?r)))
+    :effect ())
+  (:action touch
+    :parameters (?r - room)
+    :precondition (at-robby ?r)
+    :effect (and (not (at-robby ?r)) (at-robby ?r))))
+"""
+
+PROBLEM = """
+(define (problem deliver)
+  (:domain rooms)
+  (:objects rooma roomb - room ball1 - ball left - gripper)
+  (:init (at-robby rooma) (at ball1 rooma) (free left))
+  (:goal (at ball1 roomb)))
+"""
+
+#PROBLEM with a second ball, which one gripper can not hold at once
+TWO_BALLS = PROBLEM.replace("ball1 - ball", "ball1 ball2 - ball") \
+    .replace("(free left)", "(free left) (at ball2 rooma)")
+
+PLAN = ["(pick ball1 rooma left)", "(move rooma roomb)",
+        "(drop ball1 roomb left)"]
+
+def task(domain_str : str = DOMAIN, problem_str : str = PROBLEM) \
+-> strips_val.GroundTask:
+    """Grounds a problem in a domain, both given as strings"""
+    domain = strips_val.parse_domain(domain_str)
+    assert domain is not None
+    return strips_val.GroundTask(domain, ProblemParser()(problem_str))
+
+def variant(old : str, new : str, problem_str : str = PROBLEM) \
+-> strips_val.GroundTask:
+    """Grounds a problem in DOMAIN with one part of an action replaced"""
+    assert old in DOMAIN
+    return task(DOMAIN.replace(old, new), problem_str)
+
+def applies(ground_task : strips_val.GroundTask, plan : list[str]) -> bool:
+    """Returns if every step of plan applies, reaching the goal or not"""
+    valid, err_msg = ground_task.run(plan)
+    return valid or err_msg == "Goal not satisfied"
+
+def test_valid_plan():
+    assert task().run(PLAN) == (True, "")
+
+def test_names_are_case_insensitive():
+    assert task().run([step.upper() for step in PLAN]) == (True, "")
+
+def test_unsatisfied_goal():
+    valid, err_msg = task().run(PLAN[:2])
+    assert not valid and err_msg == "Goal not satisfied"
+
+def test_unsatisfied_precondition():
+    valid, err_msg = task().run(["(move rooma roomb)",
+                                 "(pick ball1 rooma left)"])
+    assert not valid and err_msg.startswith("Step 2: precondition")
+
+@pytest.mark.parametrize("plan, message", [
+    (["(jump rooma)"], "unknown action"),
+    (["(move rooma)"], "wrong number of arguments"),
+    (["(move rooma roomc)"], "bad argument roomc"),
+    #A ball is not a room, nor is a room a ball
+    (["(move rooma ball1)"], "bad argument ball1"),
+    (["(pick rooma rooma left)"], "bad argument rooma"),
+])
+def test_bad_actions(plan, message):
+    valid, err_msg = task().run(plan)
+    assert not valid and message in err_msg
+
+def test_equality_precondition():
+    valid, err_msg = task().run(["(move rooma rooma)"])
+    assert not valid and "precondition" in err_msg
+
+def test_negative_precondition():
+    assert not task().run(["(stay rooma)"])[0]
+
+def test_deletes_apply_before_adds():
+    #touch deletes and adds at-robby, which must stay true
+    assert task().run(["(touch rooma)"] + PLAN) == (True, "")
+
+def test_missing_precondition():
+    #Without (at-robby ?r) the ball can be picked from anywhere
+    plan = ["(move rooma roomb)", "(pick ball1 rooma left)",
+            "(drop ball1 roomb left)"]
+    assert not task().run(plan)[0]
+    assert variant("(and (at ?b ?r) (at-robby ?r) (free ?g))",
+                   "(and (at ?b ?r) (free ?g))").run(plan)[0]
+
+def test_missing_add():
+    new_task = variant("(and (at ?b ?r) (free ?g) (not (carry ?b ?g)))",
+                       "(and (free ?g) (not (carry ?b ?g)))")
+    valid, err_msg = new_task.run(PLAN)
+    assert not valid and err_msg == "Goal not satisfied"
+
+def test_extra_add():
+    #Adding free back, which wins over deleting it, frees the gripper
+    plan = ["(pick ball1 rooma left)", "(pick ball2 rooma left)"]
+    new_task = variant("(not (at ?b ?r)) (not (free ?g)))",
+                       "(not (at ?b ?r)) (not (free ?g)) (free ?g))",
+                       TWO_BALLS)
+    assert applies(new_task, plan)
+    assert not applies(task(problem_str=TWO_BALLS), plan)
+
+def test_extra_delete():
+    new_task = variant("(not (at ?b ?r)) (not (free ?g)))",
+                       "(not (at ?b ?r)) (not (free ?g)) (not (at-robby ?r)))")
+    valid, err_msg = new_task.run(PLAN)
+    assert not valid and err_msg.startswith("Step 2: precondition")
+
+def test_missing_delete():
+    #Moving without deleting at-robby leaves the robot in both rooms
+    plan = ["(move rooma roomb)", "(pick ball1 rooma left)",
+            "(drop ball1 roomb left)"]
+    assert variant("(and (at-robby ?to) (not (at-robby ?from)))",
+                   "(and (at-robby ?to))").run(plan)[0]
+    assert not task().run(plan)[0]
+
+def test_typed_parameter_mismatch():
+    #Retyping ?to lets move take the ball as a destination
+    new_task = variant("(?from - room ?to - room)", "(?from - room ?to)")
+    assert applies(new_task, ["(move rooma ball1)"])
+    assert not applies(task(), ["(move rooma ball1)"])
+
+def test_can_apply_plan_directions():
+    original_task = task()
+    new_task = variant("(and (at ?b ?r) (free ?g) (not (carry ?b ?g)))",
+                       "(and (free ?g) (not (carry ?b ?g)))")
+    plan = {"actions" : PLAN}
+    def outcome(original, new):
+        return strips_val.can_apply_plan(original, new, plan, plan)[1:3]
+    assert outcome(original_task, original_task) == ("EqDomain", "")
+    assert outcome(original_task, new_task) == ("DifDomain", "OriginalToNew")
+    assert outcome(new_task, original_task) == ("DifDomain", "NewToOriginal")
+
+def test_unsupported_domains_are_rejected():
+    conditional = DOMAIN.replace(
+        "(and (at-robby ?to) (not (at-robby ?from)))",
+        "(and (at-robby ?to) (when (at-robby ?to) (not (at-robby ?from))))")
+    assert strips_val.parse_domain(conditional) is None
+    assert strips_val.parse_domain("(define (domain broken)") is None
+
+def test_malformed_atoms_are_rejected():
+    #K* rejects these domains as bad PDDL, they are left to it
+    wrong_arity = DOMAIN.replace("(not (free ?g)))", "(not (free ?g ?b)))")
+    undeclared = DOMAIN.replace("(not (at-robby ?from))",
+                                "(not (atrobby ?from))")
+    assert strips_val.parse_domain(wrong_arity) is None
+    assert strips_val.parse_domain(undeclared) is None
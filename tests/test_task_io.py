@@ -0,0 +1,108 @@
+"""
+This file contains tests for the streaming task file reader and writer in
+task_io, in particular the JSON array reader, which decodes elements that
+may be split across any number of chunks.
+"""
+
+#Standard Libs
+import io
+import os
+import json
+
+#External Libs
+import pytest
+
+#Internal Libs
+from nl2pddl.utils import task_io
+
+TASKS = [
+    {"prompt" : "Input: (:action pick) [x], y", "results" : []},
+    {"domain" : "gripper", "escaped" : "say \"}]\" \\ done", "n" : 12345},
+    {"nested" : [[1, 2.5, -3e2], {"a" : None, "b" : True}], "unicode" : "é✓"},
+    {},
+]
+
+def read_array(text : str, chunk_size : int, monkeypatch) -> list:
+    """Reads a JSON array from text chunk_size characters at a time"""
+    monkeypatch.setattr(task_io, "READ_CHUNK_SIZE", chunk_size)
+    return list(task_io._iter_json_array(io.StringIO(text)))
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, 1 << 20])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_chunk_boundaries(chunk_size, indent, monkeypatch):
+    text = json.dumps(TASKS, indent=indent)
+    assert read_array(text, chunk_size, monkeypatch) == TASKS
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 5])
+def test_numbers_split_across_chunks(chunk_size, monkeypatch):
+    values = [1, 23, 456, -7.25, 1e10, True, False, None, "9"]
+    text = json.dumps(values)
+    assert read_array(text, chunk_size, monkeypatch) == values
+    #A number ending the buffer right before the closing bracket
+    assert read_array("[12345]", chunk_size, monkeypatch) == [12345]
+
+@pytest.mark.parametrize("text", ["[]", "[ ]", "  \n[\n]\n", "[\n\n]"])
+def test_empty_arrays(text, monkeypatch):
+    assert read_array(text, 1, monkeypatch) == []
+
+@pytest.mark.parametrize("text", [
+    '[{"a" : 1}, {"b" :',
+    '[{"a" : 1}, {"b" : "unterminated',
+    '[{"a" : 1},',
+    '[{"a" : 1}',
+    '[123',
+    '[',
+])
+@pytest.mark.parametrize("chunk_size", [1, 4, 64])
+def test_truncated_files(text, chunk_size, monkeypatch):
+    with pytest.raises(ValueError):
+        read_array(text, chunk_size, monkeypatch)
+
+@pytest.mark.parametrize("text", ["", "   ", '{"a" : 1}', '"tasks"'])
+def test_not_an_array(text, monkeypatch):
+    with pytest.raises(ValueError):
+        read_array(text, 4, monkeypatch)
+
+def test_elements_are_yielded_before_the_end(monkeypatch):
+    text = json.dumps(TASKS) + "garbage"
+    monkeypatch.setattr(task_io, "READ_CHUNK_SIZE", 8)
+    elements = task_io._iter_json_array(io.StringIO(text))
+    assert next(elements) == TASKS[0]
+
+@pytest.mark.parametrize("suffix", [".json", ".jsonl"])
+def test_round_trip(suffix, tmp_path):
+    path = str(tmp_path / ("tasks" + suffix))
+    assert task_io.write_tasks(iter(TASKS), path) == len(TASKS)
+    assert list(task_io.iter_tasks(path)) == TASKS
+
+def test_json_array_matches_json_dump(tmp_path):
+    path = str(tmp_path / "tasks.json")
+    for tasks in (TASKS, []):
+        task_io.write_tasks(tasks, path)
+        with open(path, "r", encoding="utf-8") as task_file:
+            assert task_file.read() == json.dumps(tasks, indent=2)
+
+def test_jsonl_append_and_blank_lines(tmp_path):
+    path = str(tmp_path / "tasks.jsonl")
+    task_io.write_tasks(TASKS[:2], path)
+    with open(path, "a", encoding="utf-8") as task_file:
+        task_file.write("\n")
+    task_io.write_tasks(TASKS[2:], path, append=True)
+    assert list(task_io.iter_tasks(path)) == TASKS
+
+def test_json_arrays_can_not_be_appended_to(tmp_path):
+    with pytest.raises(ValueError):
+        task_io.write_tasks(TASKS, str(tmp_path / "tasks.json"), append=True)
+
+def test_failed_write_keeps_previous_file(tmp_path):
+    path = str(tmp_path / "tasks.json")
+    task_io.write_tasks(TASKS, path)
+
+    def failing_tasks():
+        yield TASKS[0]
+        raise RuntimeError("stage crashed")
+
+    with pytest.raises(RuntimeError):
+        task_io.write_tasks(failing_tasks(), path)
+    assert list(task_io.iter_tasks(path)) == TASKS
+    assert os.listdir(tmp_path) == ["tasks.json"]